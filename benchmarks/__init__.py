@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+"""
+Офлайн-бенчмарки WC — TG Sync.
+
+Локальные заменители Telegram, WooCommerce и Cloudinary лежат в benchmarks.stubs,
+сам прогон — в benchmarks.run (python -m benchmarks.run --help).
+Время запуска (import main) и его бюджет — benchmarks.startup (python -m benchmarks.startup).
+Воспроизведение записанного прогона (RECORD_CASSETTE) без сети — benchmarks.replay.
+"""
@@ -0,0 +1,416 @@
+# -*- coding: utf-8 -*-
+"""
+Воспроизведение записанного прогона (кассеты RECORD_CASSETTE) через SyncWorker._main без сети.
+
+Telegram, WooCommerce и Cloudinary отвечают из кассеты: одинаковые вызовы получают записанные
+ответы в том же порядке, скачанные фото берутся из blobs/, файлы состояния — из state/. Задержки
+по умолчанию не воспроизводятся (прогон упирается только в CPU и диск); --latency-scale 1 повторяет
+записанные задержки сервисов, --tg-latency/--wc-latency/--cdn-latency добавляют фиксированную.
+
+Кроме скорости отчёт показывает расхождения с записью: вызовы, которых нет в кассете (промахи),
+неиспользованные ответы, запросы к WooCommerce с другим телом и отличие итогов по товарам.
+С --strict любое расхождение — код 1; с --baseline — сравнение скорости как в benchmarks.run.
+
+Пример:
+    python -m benchmarks.run --products 50 --record cassettes
+    python -m benchmarks.replay cassettes/cassette_20260101_120000 --json replay.json
+    python -m benchmarks.replay cassettes/cassette_20260101_120000 --latency-scale 1 --baseline replay.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import tempfile
+import threading
+import contextlib
+from collections import deque
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cloudinary.exceptions
+
+import main
+from benchmarks.run import percentile, peak_rss_mb, compare_with_baseline, report_latencies
+
+SERVICES = ("telegram", "woocommerce", "cloudinary")
+
+
+class ReplayError(Exception):
+    """Ошибка, записанная в кассете: тип исходного исключения и его текст."""
+
+    def __init__(self, name, message):
+        super().__init__(f"{name}: {message}")
+        self.name = name
+
+
+class Cassette:
+    """Кассета в памяти: очереди ответов по (сервис, ключ вызова) и счётчики воспроизведения."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, "config.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        self.config = meta["config"]
+        self.state = meta.get("state") or []
+        self.summary = {}
+        summary_path = os.path.join(directory, "summary.json")
+        if os.path.exists(summary_path):
+            with open(summary_path, "r", encoding="utf-8") as f:
+                self.summary = json.load(f)
+        self.calls = {}
+        with open(os.path.join(directory, "calls.jsonl"), "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    self.calls.setdefault((entry["service"], entry["key"]), deque()).append(entry)
+        self.lock = threading.Lock()
+        self.stats = {s: {"replayed": 0, "missed": 0} for s in SERVICES}
+        self.missed_keys = []
+        self.body_diffs = 0
+
+    def take(self, service, key):
+        with self.lock:
+            queue = self.calls.get((service, key))
+            if not queue:
+                self.stats[service]["missed"] += 1
+                if len(self.missed_keys) < 20:
+                    self.missed_keys.append(f"{service} {key}")
+                return None
+            self.stats[service]["replayed"] += 1
+            return queue.popleft()
+
+    def unused(self):
+        out = {s: 0 for s in SERVICES}
+        for (service, _), queue in self.calls.items():
+            out[service] = out.get(service, 0) + len(queue)
+        return out
+
+    def blob(self, sha1):
+        return os.path.join(self.directory, "blobs", sha1)
+
+
+class Latency:
+    """Задержка ответа: записанная (с множителем scale) плюс фиксированная по сервису."""
+
+    def __init__(self, scale=0.0, fixed=None):
+        self.scale = scale
+        self.fixed = fixed or {}
+
+    def delay(self, service, entry):
+        recorded = (entry or {}).get("ms", 0) / 1000.0 * self.scale
+        return recorded + self.fixed.get(service, 0.0)
+
+
+def raise_recorded(entry):
+    if entry and entry.get("error"):
+        raise ReplayError(*entry["error"])
+
+
+class ReplayEntity:
+    """Чат из кассеты: entity_key даёт тот же peer id, что был при записи."""
+
+    def __init__(self, peer_id):
+        self.id = peer_id
+
+
+class ReplayTelegramClient:
+    """Клиент с поверхностью Telethon, который отвечает из кассеты (сообщения — StoredMessage)."""
+
+    def __init__(self, cassette, latency):
+        self.cassette = cassette
+        self.latency = latency
+
+    async def _take(self, *key):
+        entry = self.cassette.take("telegram", main.cassette_key(*key))
+        delay = self.latency.delay("telegram", entry)
+        if delay:
+            await asyncio.sleep(delay)
+        return entry
+
+    @staticmethod
+    def _message(chat_id, record):
+        return main.StoredMessage(chat_id, *record) if record else None
+
+    async def start(self, phone=None, *args, **kwargs):
+        return self
+
+    async def connect(self):
+        return None
+
+    async def disconnect(self):
+        return None
+
+    async def is_user_authorized(self):
+        return True
+
+    @contextlib.asynccontextmanager
+    async def takeout(self, *args, **kwargs):
+        yield self
+
+    async def get_entity(self, entity):
+        entry = await self._take("get_entity", entity)
+        if entry is None:
+            raise ValueError(f"Нет в кассете: get_entity({entity!r})")
+        raise_recorded(entry)
+        return ReplayEntity(entry["result"]["id"])
+
+    async def iter_messages(self, entity, limit=None, **kwargs):
+        chat_id = main.entity_key(entity)
+        entry = await self._take("iter_messages", chat_id, limit, kwargs)
+        for record in (entry or {}).get("result") or []:
+            yield self._message(chat_id, record)
+        raise_recorded(entry)
+
+    async def get_messages(self, entity, *args, ids=None, **kwargs):
+        chat_id = main.entity_key(entity)
+        entry = await self._take("get_messages", chat_id, args, ids, kwargs)
+        if entry is None:
+            if isinstance(ids, int):
+                return None
+            return [None] * len(ids) if ids is not None else []
+        raise_recorded(entry)
+        result = entry["result"]
+        if "one" in result:
+            return self._message(chat_id, result["one"])
+        return [self._message(chat_id, r) for r in result["list"]]
+
+    async def download_media(self, media, file=None, **kwargs):
+        entry = await self._take("download_media", main.media_photo_id(media))
+        raise_recorded(entry)
+        sha1 = ((entry or {}).get("result") or {}).get("blob")
+        if not sha1:
+            return None
+        if file is None:
+            with open(self.cassette.blob(sha1), "rb") as f:
+                return f.read()
+        shutil.copyfile(self.cassette.blob(sha1), file)
+        return file
+
+
+class ReplayWooCommerce:
+    """Синхронный клиент WooCommerce (как woocommerce.API): wc_request вызывает его в отдельном потоке."""
+
+    def __init__(self, cassette, url, latency):
+        self.cassette = cassette
+        self.url = (url or "").rstrip("/")
+        self.latency = latency
+
+    def _request(self, method, endpoint, data=None, params=None):
+        key = main.cassette_key("wc", self.url, method, endpoint, params or {})
+        entry = self.cassette.take("woocommerce", key)
+        delay = self.latency.delay("woocommerce", entry)
+        if delay:
+            time.sleep(delay)
+        if entry is None:
+            return main.WCResponse(404, json.dumps({"code": "cassette_miss", "message": key}), {})
+        raise_recorded(entry)
+        result = entry["result"]
+        if result.get("body_sha1") != main.wc_body_sha1(data):
+            with self.cassette.lock:
+                self.cassette.body_diffs += 1
+        return main.WCResponse(result["status"], result["text"], result.get("headers") or {})
+
+    def get(self, endpoint, params=None):
+        return self._request("GET", endpoint, params=params)
+
+    def post(self, endpoint, data, params=None):
+        return self._request("POST", endpoint, data, params)
+
+    def put(self, endpoint, data, params=None):
+        return self._request("PUT", endpoint, data, params)
+
+    def delete(self, endpoint, params=None):
+        return self._request("DELETE", endpoint, params=params)
+
+
+def replay_cloudinary(cassette, latency):
+    """Замена main.cloudinary_call: ответ Cloudinary из кассеты по тому же ключу, что при записи."""
+    def call(name, *args, **kwargs):
+        entry = cassette.take("cloudinary", main.cloudinary_call_key(name, args, kwargs))
+        delay = latency.delay("cloudinary", entry)
+        if delay:
+            time.sleep(delay)
+        if entry is None:
+            # explicit без записи — ресурса нет; загрузка без записи — ошибка, как у недоступного сервиса
+            if name == "explicit":
+                raise cloudinary.exceptions.NotFound(f"Нет в кассете: {args[0]}")
+            raise cloudinary.exceptions.Error(f"Нет в кассете: {name} {args[0] if isinstance(args[0], str) else args[0][0]}")
+        if entry.get("error"):
+            kind, message = entry["error"]
+            raise getattr(cloudinary.exceptions, kind, cloudinary.exceptions.Error)(message)
+        return entry["result"]
+    return call
+
+
+def replay_config(cassette, workdir, args):
+    """Настройки записи с путями состояния в workdir; пауз нет, запись кассеты выключена."""
+    cfg = main.DEFAULT_CONFIG.copy()
+    cfg.update(cassette.config)
+    for key in main.CASSETTE_STATE_KEYS:
+        cfg[key] = os.path.join(workdir, os.path.basename(cfg.get(key) or key))
+    for name in cassette.state:
+        shutil.copyfile(os.path.join(cassette.directory, "state", name), os.path.join(workdir, name))
+    cfg.update({
+        "RECORD_CASSETTE": "",
+        "TG_SESSIONS": [],
+        "PAUSE_BETWEEN_PRODUCTS": 0,
+        "PAUSE_BETWEEN_PHOTOS": 0,
+        "DESC_FAST_PAUSE": 0,
+        "METRICS_DIR": os.path.join(workdir, "reports"),
+        "REPORT_DIR": os.path.join(workdir, "reports"),
+        "PROFILE_MODE": args.profile,
+        "SLOW_CALLBACK_MS": args.slow_callback_ms,
+    })
+    return cfg
+
+
+def run_replay(args):
+    cassette = Cassette(args.cassette)
+    latency = Latency(args.latency_scale, {"telegram": args.tg_latency, "woocommerce": args.wc_latency,
+                                           "cloudinary": args.cdn_latency})
+    workdir = tempfile.mkdtemp(prefix="wc_tg_replay_")
+    downloads = os.path.join(workdir, "downloads")
+    os.makedirs(downloads, exist_ok=True)
+    cfg = replay_config(cassette, workdir, args)
+    tg = ReplayTelegramClient(cassette, latency)
+
+    patched = {
+        "create_telegram_client": lambda cfg, session="user_session": tg,
+        "create_wc_client": lambda cfg: ReplayWooCommerce(cassette, cfg.get("WC_URL"), latency),
+        "cloudinary_call": replay_cloudinary(cassette, latency),
+        "DOWNLOAD_DIR": downloads,
+    }
+    saved = {k: getattr(main, k) for k in patched}
+    log_path = os.path.join(workdir, "run.log")
+    try:
+        for k, v in patched.items():
+            setattr(main, k, v)
+        worker = main.SyncWorker(cfg, lambda s: None, lambda prompt: "", None)
+        with open(log_path, "w", encoding="utf-8") as log_file:
+            with contextlib.redirect_stdout(sys.stdout if args.verbose else log_file):
+                t0 = time.perf_counter()
+                main.run_profiled(worker._main, cfg)
+                elapsed = time.perf_counter() - t0
+    finally:
+        for k, v in saved.items():
+            setattr(main, k, v)
+
+    snapshot = main.METRICS.to_json()
+    latencies = report_latencies(worker)
+    n = len(latencies)
+    unused = cassette.unused()
+    recorded_outcomes = cassette.summary.get("outcomes") or {}
+    return {
+        "cassette": os.path.abspath(args.cassette),
+        "products": n,
+        "elapsed_s": round(elapsed, 3),
+        "recorded_elapsed_s": cassette.summary.get("elapsed_s"),
+        "products_per_min": round(n / elapsed * 60, 2) if elapsed > 0 else 0.0,
+        "latency_p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "latency_p95_ms": round(percentile(latencies, 95) * 1000, 1),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "outcomes": snapshot["outcomes"],
+        "recorded_outcomes": recorded_outcomes,
+        "calls": {s: dict(cassette.stats[s], unused=unused.get(s, 0)) for s in SERVICES},
+        "wc_body_diffs": cassette.body_diffs,
+        "missed_keys": cassette.missed_keys,
+        "stages": {k: {"count": v["count"], "sum": v["sum"], "p50": v["p50"], "p95": v["p95"]}
+                   for k, v in snapshot["stages"].items()},
+        "params": {k: v for k, v in vars(args).items() if k not in ("json", "baseline", "verbose")},
+        "log": log_path,
+    }
+
+
+def divergences(report):
+    """Расхождения воспроизведения с записью (пусто — прогон повторил запись)."""
+    problems = []
+    for service, st in report["calls"].items():
+        if st["missed"]:
+            problems.append(f"{service}: вызовов нет в кассете — {st['missed']}")
+        if st["unused"]:
+            problems.append(f"{service}: записанных ответов не понадобилось — {st['unused']}")
+    if report["wc_body_diffs"]:
+        problems.append(f"woocommerce: запросов с другим телом — {report['wc_body_diffs']}")
+    recorded = {k: v for k, v in report["recorded_outcomes"].items() if v}
+    replayed = {k: v for k, v in report["outcomes"].items() if v}
+    if recorded and recorded != replayed:
+        problems.append(f"итоги: запись {recorded}, воспроизведение {replayed}")
+    return problems
+
+
+def print_report(report):
+    print("=== ВОСПРОИЗВЕДЕНИЕ WC — TG Sync ===")
+    print(f"Кассета: {report['cassette']}")
+    recorded = f" (при записи {report['recorded_elapsed_s']} с)" if report["recorded_elapsed_s"] is not None else ""
+    print(f"Товаров: {report['products']} за {report['elapsed_s']} с{recorded}")
+    print(f"Скорость: {report['products_per_min']} товаров/мин")
+    print(f"Время на товар: p50={report['latency_p50_ms']} мс, p95={report['latency_p95_ms']} мс")
+    print(f"Пиковый RSS: {report['peak_rss_mb']} МБ")
+    print(f"Итоги: {report['outcomes']}")
+    for service, st in report["calls"].items():
+        print(f"{service}: воспроизведено {st['replayed']}, промахов {st['missed']}, не использовано {st['unused']}")
+    print("Этапы (всего, с):")
+    for stage, st in sorted(report["stages"].items(), key=lambda kv: kv[1]["sum"], reverse=True):
+        print(f"  {stage}: {st['sum']:.3f} ({st['count']} выз., p95={st['p95']:.3f})")
+    print(f"Лог прогона: {report['log']}")
+
+
+def build_parser():
+    p = argparse.ArgumentParser(description="Воспроизведение записанного прогона WC — TG Sync из кассеты.")
+    p.add_argument("cassette", help="Папка кассеты (cassette_<время> внутри RECORD_CASSETTE)")
+    p.add_argument("--latency-scale", type=float, default=0.0,
+                   help="Множитель записанных задержек сервисов: 0 — без задержек, 1 — как при записи")
+    p.add_argument("--tg-latency", type=float, default=0.0, help="Дополнительная задержка Telegram на вызов, с")
+    p.add_argument("--wc-latency", type=float, default=0.0, help="Дополнительная задержка WooCommerce на запрос, с")
+    p.add_argument("--cdn-latency", type=float, default=0.0, help="Дополнительная задержка Cloudinary на вызов, с")
+    p.add_argument("--profile", default="off", choices=["off", "cprofile", "sample"],
+                   help="Профиль воспроизведения (PROFILE_MODE): файлы .prof/.folded в папке отчётов")
+    p.add_argument("--slow-callback-ms", type=int, default=0,
+                   help="Писать в лог стек, если цикл событий заблокирован дольше N мс (SLOW_CALLBACK_MS)")
+    p.add_argument("--strict", action="store_true", help="Код 1 при любом расхождении с записью")
+    p.add_argument("--json", help="Сохранить отчёт в JSON")
+    p.add_argument("--baseline", help="JSON-отчёт прошлого воспроизведения для сравнения")
+    p.add_argument("--tolerance", type=float, default=0.2, help="Допустимое ухудшение (доля), по умолчанию 0.2")
+    p.add_argument("--verbose", action="store_true", help="Выводить лог синхронизации в консоль")
+    return p
+
+
+def main_cli(argv=None):
+    args = build_parser().parse_args(argv)
+    report = run_replay(args)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    code = 0
+    problems = divergences(report)
+    if problems:
+        print("Расхождения с записью:")
+        for line in problems:
+            print(f"  - {line}")
+        for key in report["missed_keys"][:5]:
+            print(f"    промах: {key}")
+        if args.strict:
+            code = 1
+    else:
+        print("Прогон повторил запись без расхождений.")
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare_with_baseline(report, baseline, args.tolerance)
+        if regressions:
+            print("РЕГРЕССИЯ производительности:")
+            for line in regressions:
+                print(f"  - {line}")
+            code = 1
+        else:
+            print("Регрессий относительно baseline нет.")
+    return code
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -0,0 +1,335 @@
+# -*- coding: utf-8 -*-
+"""
+Офлайн-бенчмарк полного прохода SyncWorker._main / process_one_product.
+
+Telegram, WooCommerce и Cloudinary заменены локальными заглушками (benchmarks.stubs),
+поэтому прогон не трогает боевые сервисы. Отчёт: товаров в минуту, p50/p95 времени
+обработки одного товара и пиковый RSS. С --baseline сравнивает с прошлым отчётом и
+завершается с кодом 1 при регрессии больше допуска.
+
+Пример:
+    python -m benchmarks.run --products 200 --tg-latency 0.02 --json bench.json
+    python -m benchmarks.run --products 200 --baseline bench.json --tolerance 0.15
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import copy
+import tempfile
+import contextlib
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cloudinary
+
+import main
+from benchmarks.stubs import FakeTelegramClient, WooCommerceStub, CloudinaryStub, build_synthetic_chat
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = max(0, min(len(ordered) - 1, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[k]
+
+
+def peak_rss_mb():
+    if resource is None:
+        return 0.0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux отдаёт килобайты, macOS — байты
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+def report_latencies(worker):
+    """Время на товар (product_total, секунды) из JSONL-отчёта последнего прогона."""
+    jsonl = next((p for p in worker.report_paths if p.endswith(".jsonl")), None)
+    if not jsonl:
+        return []
+    with open(jsonl, encoding="utf-8") as f:
+        rows = [json.loads(line) for line in f if line.strip()]
+    return [(row.get("stages") or {}).get("product_total", 0.0) for row in rows]
+
+
+def bench_config(args, wc_url, chat_id, workdir):
+    cfg = main.DEFAULT_CONFIG.copy()
+    cfg.update({
+        "TG_API_ID": 1,
+        "TG_API_HASH": "bench",
+        "TG_PHONE": "+000",
+        "COMMENT_GROUP_ID": chat_id,
+        "TG_CHANNEL_ID": 0,
+        "WC_URL": wc_url,
+        "WC_KEY": "ck_bench",
+        "WC_SECRET": "cs_bench",
+        "CLOUDINARY_CLOUD_NAME": "bench",
+        "CLOUDINARY_API_KEY": "bench",
+        "CLOUDINARY_API_SECRET": "bench",
+        "PAUSE_BETWEEN_PRODUCTS": 0,
+        "PAUSE_BETWEEN_PHOTOS": 0,
+        "DESC_FAST_PAUSE": 0,
+        "UPDATE_STRATEGY": args.strategy,
+        "UPDATE_WHAT": args.what,
+        "OPERATION_MODE": "comments",
+        "PHOTO_SOURCE_MODE": "auto",
+        "UPDATED_FILE": os.path.join(workdir, "updated_products.json"),
+        "VERBOSE_LOG": False,
+        "METRICS_DIR": os.path.join(workdir, "reports"),
+        "REPORT_DIR": os.path.join(workdir, "reports"),
+        "CHECKPOINT_FILE": os.path.join(workdir, "checkpoint.json"),
+        "MEDIA_MAP_FILE": os.path.join(workdir, "wc_media_map.json"),
+        "SKU_CACHE_FILE": os.path.join(workdir, "sku_message_cache.json"),
+        "HISTORY_MODE": "takeout" if args.history else "off",
+        "HISTORY_STORE_FILE": os.path.join(workdir, "tg_history.sqlite3"),
+        "CLOUDINARY_FORMAT_MODE": args.format_mode,
+        # процессы-сессии наследуют подменённый клиент Telegram только при fork
+        "TG_SESSIONS": [{"session": f"bench_session_{i + 1}"} for i in range(1, max(1, args.sessions))],
+        "SHARD_START_METHOD": "fork",
+        "PRODUCT_PRIORITY": args.priority,
+        "RECORD_CASSETTE": args.record or "",
+        "PREFLIGHT_ENABLED": not args.no_preflight,
+        "PROFILE_MODE": args.profile,
+        "SLOW_CALLBACK_MS": args.slow_callback_ms,
+    })
+    return cfg
+
+
+def stats_delta(after, before):
+    return {k: v - before.get(k, 0) for k, v in after.items() if v - before.get(k, 0)}
+
+
+def wc_stats(shops):
+    """Счётчики всех заглушек WooCommerce вместе."""
+    total = {}
+    for shop in shops:
+        for k, v in shop.stats.items():
+            total[k] = total.get(k, 0) + v
+    return total
+
+
+def run_benchmark(args):
+    chat, products = build_synthetic_chat(
+        args.products, seed=args.seed, album=args.album, replies=args.replies, trailing=args.trailing,
+        missing_rate=args.missing_rate, dup_rate=args.dup_rate,
+    )
+    workdir = tempfile.mkdtemp(prefix="wc_tg_bench_")
+    downloads = os.path.join(workdir, "downloads")
+    os.makedirs(downloads, exist_ok=True)
+
+    wc = WooCommerceStub(products, latency=args.wc_latency).start()
+    cdn = CloudinaryStub(latency=args.cdn_latency).start()
+    cdn.down = args.cdn_down
+    tg = FakeTelegramClient(chat, latency=args.tg_latency, download_latency=args.download_latency)
+    cfg = bench_config(args, wc.url, chat.entity.id, workdir)
+    # --shops: те же товары в нескольких магазинах, у каждого своя заглушка WooCommerce
+    extra_shops = [WooCommerceStub(copy.deepcopy(products), latency=args.wc_latency).start()
+                   for _ in range(max(1, args.shops) - 1)]
+    cfg["WC_SHOPS"] = [{"name": f"shop{i + 2}", "WC_URL": shop.url, "WC_KEY": "ck_bench", "WC_SECRET": "cs_bench"}
+                       for i, shop in enumerate(extra_shops)]
+    shops = [wc] + extra_shops
+
+    latencies = []
+    outcomes = {"updated": 0, "review": 0, "failed": 0}
+    orig_process = main.process_one_product
+
+    async def timed_process(*a, **kw):
+        t0 = time.perf_counter()
+        result = None
+        try:
+            result = await orig_process(*a, **kw)
+            return result
+        finally:
+            latencies.append(time.perf_counter() - t0)
+            if result and result.get("review_reason"):
+                outcomes["review"] += 1
+            elif result and result.get("updated"):
+                outcomes["updated"] += 1
+            else:
+                outcomes["failed"] += 1
+
+    patched = {
+        "process_one_product": timed_process,
+        "create_telegram_client": lambda cfg, session="user_session": tg,
+        "DOWNLOAD_DIR": downloads,
+    }
+    saved = {k: getattr(main, k) for k in patched}
+    cloudinary.config(upload_prefix=cdn.url)
+    log_path = os.path.join(workdir, "run.log")
+    try:
+        for k, v in patched.items():
+            setattr(main, k, v)
+        worker = main.SyncWorker(cfg, lambda s: None, lambda prompt: "", None)
+        passes = []
+        with open(log_path, "w", encoding="utf-8") as log_file:
+            out = sys.stdout if args.verbose else log_file
+            for n in range(max(1, args.passes)):
+                if n and args.fresh_state:
+                    # как второй компьютер с тем же Cloudinary: локальные карты и история обновлений пусты
+                    for key in ("UPDATED_FILE", "MEDIA_MAP_FILE", "CHECKPOINT_FILE", "SKU_CACHE_FILE"):
+                        with contextlib.suppress(FileNotFoundError):
+                            os.remove(cfg[key])
+                # повторные проходы с --retry-failed берут только товары с пометкой failed
+                cfg["RETRY_FAILED_ONLY"] = bool(n and args.retry_failed)
+                latencies.clear()
+                outcomes.update(updated=0, review=0, failed=0)
+                before = (dict(tg.stats), wc_stats(shops), dict(cdn.stats))
+                with contextlib.redirect_stdout(out):
+                    t0 = time.perf_counter()
+                    main.run_profiled(worker._main, cfg)
+                    elapsed = time.perf_counter() - t0
+                if not latencies:
+                    # с --sessions товары обрабатываются в дочерних процессах: их замеры — в отчёте прогона
+                    latencies.extend(report_latencies(worker))
+                    outcomes.update(main.METRICS.to_json()["outcomes"])
+                passes.append({
+                    "elapsed_s": round(elapsed, 3),
+                    "products_per_min": round(len(latencies) / elapsed * 60, 2) if elapsed > 0 else 0.0,
+                    "telegram": stats_delta(tg.stats, before[0]),
+                    "woocommerce": stats_delta(wc_stats(shops), before[1]),
+                    "cloudinary": stats_delta(cdn.stats, before[2]),
+                })
+    finally:
+        for k, v in saved.items():
+            setattr(main, k, v)
+        cloudinary.config(upload_prefix=None)
+        for shop in shops:
+            shop.stop()
+        cdn.stop()
+
+    # верхнеуровневые цифры — по последнему проходу (с --passes 2 это повторный прогон)
+    n = len(latencies)
+    last = passes[-1]
+    return {
+        "products": n,
+        "elapsed_s": round(elapsed, 3),
+        "products_per_min": round(n / elapsed * 60, 2) if elapsed > 0 else 0.0,
+        "latency_p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "latency_p95_ms": round(percentile(latencies, 95) * 1000, 1),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "outcomes": outcomes,
+        "telegram": last["telegram"],
+        "woocommerce": last["woocommerce"],
+        "cloudinary": last["cloudinary"],
+        "passes": passes,
+        "stages": {k: {"count": v["count"], "sum": v["sum"], "p50": v["p50"], "p95": v["p95"]}
+                   for k, v in main.METRICS.to_json()["stages"].items()},
+        "params": {k: v for k, v in vars(args).items() if k not in ("json", "baseline", "verbose")},
+        "log": log_path,
+    }
+
+
+def compare_with_baseline(report, baseline, tolerance):
+    """Возвращает список регрессий относительно baseline (пусто — всё в порядке)."""
+    problems = []
+    checks = [
+        ("products_per_min", -1),  # меньше — хуже
+        ("latency_p50_ms", 1),
+        ("latency_p95_ms", 1),
+        ("peak_rss_mb", 1),
+    ]
+    for key, direction in checks:
+        old, new = baseline.get(key), report.get(key)
+        if not old or new is None:
+            continue
+        change = (new - old) / old
+        if change * direction > tolerance:
+            problems.append(f"{key}: {old} -> {new} ({change:+.1%})")
+    return problems
+
+
+def print_report(report):
+    print("=== БЕНЧМАРК WC — TG Sync ===")
+    print(f"Товаров: {report['products']} за {report['elapsed_s']} с")
+    print(f"Скорость: {report['products_per_min']} товаров/мин")
+    print(f"Время на товар: p50={report['latency_p50_ms']} мс, p95={report['latency_p95_ms']} мс")
+    print(f"Пиковый RSS: {report['peak_rss_mb']} МБ")
+    print(f"Итоги: {report['outcomes']}")
+    print(f"Telegram: {report['telegram']}")
+    print(f"WooCommerce: {report['woocommerce']}")
+    print(f"Cloudinary: {report['cloudinary']}")
+    if len(report["passes"]) > 1:
+        print("Проходы: " + ", ".join(f"#{i + 1}: {p['products_per_min']} товаров/мин"
+                                      for i, p in enumerate(report["passes"])))
+    print("Этапы (всего, с):")
+    for stage, st in sorted(report["stages"].items(), key=lambda kv: kv[1]["sum"], reverse=True):
+        print(f"  {stage}: {st['sum']:.3f} ({st['count']} выз., p95={st['p95']:.3f})")
+    print(f"Лог прогона: {report['log']}")
+
+
+def build_parser():
+    p = argparse.ArgumentParser(description="Офлайн-бенчмарк синхронизации WC — TG на локальных заглушках.")
+    p.add_argument("--products", type=int, default=100, help="Количество товаров в каталоге")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--album", type=int, default=4, help="Фото в альбоме основного поста")
+    p.add_argument("--replies", type=int, default=5, help="Фото-ответов на основной пост")
+    p.add_argument("--trailing", type=int, default=2, help="Фото без текста сразу после поста")
+    p.add_argument("--missing-rate", type=float, default=0.05, help="Доля товаров, которых нет в чате")
+    p.add_argument("--dup-rate", type=float, default=0.1, help="Доля товаров с повтором фото в ответах")
+    p.add_argument("--tg-latency", type=float, default=0.0, help="Задержка Telegram на запрос, с")
+    p.add_argument("--download-latency", type=float, default=0.0, help="Задержка скачивания фото, с")
+    p.add_argument("--wc-latency", type=float, default=0.0, help="Задержка WooCommerce на запрос, с")
+    p.add_argument("--cdn-latency", type=float, default=0.0, help="Задержка Cloudinary на загрузку, с")
+    p.add_argument("--strategy", default="all", choices=["only_new", "only_updated", "all"])
+    p.add_argument("--what", default="both", choices=["both", "photos", "description"])
+    p.add_argument("--passes", type=int, default=1,
+                   help="Сколько раз подряд прогнать каталог на тех же заглушках (отчёт — по последнему проходу)")
+    p.add_argument("--shops", type=int, default=1,
+                   help="Сколько магазинов WooCommerce с тем же каталогом (WC_SHOPS)")
+    p.add_argument("--retry-failed", action="store_true",
+                   help="Повторные проходы (--passes) — режим «Повторить неудачные»")
+    p.add_argument("--cdn-down", action="store_true",
+                   help="Cloudinary весь прогон отвечает 503: с проверкой перед запуском прогон не начнётся, "
+                        "с --no-preflight — проверка предохранителей")
+    p.add_argument("--no-preflight", action="store_true", help="Без проверки доступов перед прогоном (PREFLIGHT_ENABLED)")
+    p.add_argument("--fresh-state", action="store_true",
+                   help="Перед каждым повторным проходом удалять локальные файлы состояния (медиакарту, историю обновлений)")
+    p.add_argument("--format-mode", default="local", choices=["local", "server"],
+                   help="Где перекодировать фото: local (Pillow) или server (f_auto,q_auto в Cloudinary)")
+    p.add_argument("--priority", default="", help="PRODUCT_PRIORITY, например no_images,best_selling")
+    p.add_argument("--sessions", type=int, default=1,
+                   help="Сколько сессий Telegram (процессов) делят каталог; >1 включает параллельный прогон")
+    p.add_argument("--history", action="store_true",
+                   help="Выгрузить историю чата в локальную базу (HISTORY_MODE=takeout) и искать офлайн")
+    p.add_argument("--profile", default="off", choices=["off", "cprofile", "sample"],
+                   help="Профиль прогона (PROFILE_MODE): файлы .prof/.folded в папке отчётов")
+    p.add_argument("--slow-callback-ms", type=int, default=0,
+                   help="Писать в лог стек, если цикл событий заблокирован дольше N мс (SLOW_CALLBACK_MS)")
+    p.add_argument("--record", help="Записать прогон в кассету в этой папке (RECORD_CASSETTE) для benchmarks.replay")
+    p.add_argument("--json", help="Сохранить отчёт в JSON")
+    p.add_argument("--baseline", help="JSON-отчёт прошлого прогона для сравнения")
+    p.add_argument("--tolerance", type=float, default=0.2, help="Допустимое ухудшение (доля), по умолчанию 0.2")
+    p.add_argument("--verbose", action="store_true", help="Выводить лог синхронизации в консоль")
+    return p
+
+
+def main_cli(argv=None):
+    args = build_parser().parse_args(argv)
+    report = run_benchmark(args)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        problems = compare_with_baseline(report, baseline, args.tolerance)
+        if problems:
+            print("РЕГРЕССИЯ производительности:")
+            for line in problems:
+                print(f"  - {line}")
+            return 1
+        print("Регрессий относительно baseline нет.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
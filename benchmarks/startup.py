@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Бюджет времени запуска: сколько стоит `import main` по данным python -X importtime.
+
+Импорт выполняется в отдельном процессе несколько раз (после прогревочного импорта,
+который обновляет байткод в __pycache__), в отчёт идёт медиана суммарного времени
+модуля main и самые тяжёлые прямые импорты. Завершается с кодом 1,
+если медиана больше бюджета или при импорте загрузилась тяжёлая зависимость,
+которая должна грузиться только при синхронизации (Pillow, Cloudinary, requests, Telethon, aiohttp).
+
+tests/test_startup.py всегда проверяет ленивые импорты, а бюджет — только с переменной
+окружения STARTUP_BUDGET_MS (мс): время импорта зависит от машины и её загрузки.
+
+Пример:
+    python -m benchmarks.startup
+    python -m benchmarks.startup --budget-ms 80 --runs 7
+"""
+
+import os
+import sys
+import re
+import argparse
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BUDGET_MS = 120.0
+
+# модули, которые не должны загружаться при `import main`
+LAZY_MODULES = ("PIL.Image", "cloudinary", "requests", "telethon", "aiohttp", "woocommerce")
+
+LINE = re.compile(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|( *)(\S+)")
+
+
+def measure_once():
+    """(мкс на import main, {модуль: мкс} прямых импортов, множество всех загруженных модулей)."""
+    # без записи байткода устаревший main.pyc компилировался бы заново при каждом замере
+    env = {k: v for k, v in os.environ.items() if k != "PYTHONDONTWRITEBYTECODE"}
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"],
+                          cwd=ROOT, capture_output=True, text=True, env=env)
+    if proc.returncode != 0:
+        raise RuntimeError(f"import main завершился с ошибкой:\n{proc.stderr[-2000:]}")
+    entries = []
+    for line in proc.stderr.splitlines():
+        m = LINE.match(line)
+        if m:
+            entries.append((int(m.group(2)), len(m.group(3)), m.group(4)))
+    # importtime печатает дочерние модули раньше родителя: прямые импорты main — строки уровня 3
+    # между предыдущим модулем верхнего уровня и самим main
+    end = max(i for i, (_, level, name) in enumerate(entries) if name == "main" and level == 1)
+    start = max([i for i, (_, level, _) in enumerate(entries[:end]) if level == 1] or [-1]) + 1
+    children = {name: cum for cum, level, name in entries[start:end] if level == 3}
+    loaded = {name for _, _, name in entries[start:end]}
+    return entries[end][0], children, loaded
+
+
+def run(args):
+    totals, children, loaded = [], {}, set()
+    measure_once()  # прогрев: байткод и файловый кэш, как у обычного запуска приложения
+    for _ in range(max(1, args.runs)):
+        total, direct, names = measure_once()
+        totals.append(total)
+        loaded |= names
+        for name, us in direct.items():
+            children.setdefault(name, []).append(us)
+    return {
+        "median_ms": round(statistics.median(totals) / 1000, 1),
+        "min_ms": round(min(totals) / 1000, 1),
+        "top": sorted(((n, round(statistics.median(v) / 1000, 1)) for n, v in children.items()),
+                      key=lambda kv: kv[1], reverse=True)[:args.top],
+        "eager_heavy": sorted(m for m in loaded if m in LAZY_MODULES),
+    }
+
+
+def build_parser():
+    p = argparse.ArgumentParser(description="Бюджет времени импорта main.py (python -X importtime).")
+    p.add_argument("--budget-ms", type=float, default=BUDGET_MS, help="Допустимая медиана import main, мс")
+    p.add_argument("--runs", type=int, default=5, help="Сколько раз импортировать")
+    p.add_argument("--top", type=int, default=8, help="Сколько тяжёлых прямых импортов показать")
+    return p
+
+
+def main():
+    args = build_parser().parse_args()
+    report = run(args)
+    print("=== ЗАПУСК WC — TG Sync ===")
+    print(f"import main: медиана {report['median_ms']} мс, минимум {report['min_ms']} мс (бюджет {args.budget_ms} мс)")
+    print("Тяжёлые прямые импорты:")
+    for name, ms in report["top"]:
+        print(f"  {name}: {ms} мс")
+    problems = []
+    if report["median_ms"] > args.budget_ms:
+        problems.append(f"медиана {report['median_ms']} мс больше бюджета {args.budget_ms} мс")
+    if report["eager_heavy"]:
+        problems.append("при импорте загружены: " + ", ".join(report["eager_heavy"]))
+    if problems:
+        print("ПРЕВЫШЕНИЕ: " + "; ".join(problems))
+        sys.exit(1)
+    print("Бюджет соблюдён.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,544 @@
+# -*- coding: utf-8 -*-
+"""
+Локальные заменители внешних сервисов для офлайн-бенчмарков:
+- FakeTelegramClient — имитация Telethon поверх синтетического чата (альбомы, ответы, хвостовые фото);
+- WooCommerceStub — HTTP-заглушка REST API wc/v3 (products);
+- CloudinaryStub — HTTP-заглушка Upload API (подключается через cloudinary.config(upload_prefix=...)).
+У всех заменителей настраиваемая задержка, чтобы моделировать сеть.
+"""
+
+import io
+import re
+import json
+import time
+import uuid
+import random
+import bisect
+import asyncio
+import threading
+import contextlib
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from PIL import Image, ImageDraw
+
+# -------------------------
+# Синтетический Telegram
+# -------------------------
+PAGE_SIZE = 100  # Telethon запрашивает историю страницами по 100 сообщений
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+class FakePhoto:
+    def __init__(self, photo_id, image_key):
+        self.id = photo_id
+        self.image_key = image_key
+
+
+class FakeMessage:
+    def __init__(self, msg_id, text="", photo=None, grouped_id=None, reply_to_msg_id=None):
+        self.id = msg_id
+        self.text = text
+        self.photo = photo
+        self.media = photo
+        self.grouped_id = grouped_id
+        self.reply_to_msg_id = reply_to_msg_id
+        self.edit_date = None
+
+    @property
+    def message(self):
+        return self.text
+
+    def __repr__(self):
+        return f"<FakeMessage id={self.id} photo={bool(self.photo)} text={len(self.text or '')}>"
+
+
+class FakeEntity:
+    def __init__(self, entity_id, title):
+        self.id = entity_id
+        self.title = title
+
+
+class SyntheticChat:
+    """Чат в памяти: сообщения по возрастанию id и простой индекс для поиска по словам."""
+
+    def __init__(self, entity_id, title="bench"):
+        self.entity = FakeEntity(entity_id, title)
+        self.ids = []
+        self.by_id = {}
+        self.index = {}
+
+    def add(self, msg):
+        self.ids.append(msg.id)
+        self.by_id[msg.id] = msg
+        for tok in set(_TOKEN_RE.findall((msg.text or "").lower())):
+            self.index.setdefault(tok, []).append(msg.id)
+
+    def search_ids(self, query):
+        tokens = _TOKEN_RE.findall((query or "").lower())
+        if not tokens:
+            return []
+        found = None
+        for tok in tokens:
+            posting = set(self.index.get(tok, ()))
+            found = posting if found is None else (found & posting)
+        return sorted(found or (), reverse=True)
+
+    def range_ids(self, min_id, max_id):
+        lo = bisect.bisect_right(self.ids, min_id) if min_id else 0
+        hi = bisect.bisect_left(self.ids, max_id) if max_id else len(self.ids)
+        return self.ids[lo:hi]
+
+    def __len__(self):
+        return len(self.ids)
+
+
+def build_synthetic_chat(n_products, entity_id=-1001000000001, seed=1, album=4, replies=5, trailing=2,
+                         missing_rate=0.05, dup_rate=0.1, noise=2, start_id=1000):
+    """
+    Строит чат и каталог WooCommerce под него. Для каждого товара:
+      - альбом из `album` фото, текст с артикулом на первом сообщении альбома;
+      - `trailing` фото без текста сразу после альбома;
+      - `replies` фото-ответов на основной пост и один текстовый ответ;
+      - `noise` посторонних текстовых сообщений.
+    Часть товаров (missing_rate) в чате отсутствует, у части (dup_rate) один ответ — повтор фото из альбома.
+    Возвращает (chat, products).
+    """
+    rnd = random.Random(seed)
+    chat = SyntheticChat(entity_id)
+    products = []
+    next_id = start_id
+    next_photo = 5_000_000_000
+    next_group = 13_000_000_000_000_000
+
+    def new_photo(key):
+        nonlocal next_photo
+        next_photo += 1
+        return FakePhoto(next_photo, key)
+
+    for i in range(1, n_products + 1):
+        sku = f"BN{i:04d}-{i % 10}-{rnd.randint(10, 99)}"
+        products.append({
+            "id": 100000 + i,
+            "name": f"Товар {i}",
+            "sku": sku,
+            "description": "",
+            "images": [{"id": 900000 + i, "src": f"https://shop.test/img/{i}.jpg"}] if i % 3 == 0 else [],
+            "date_modified_gmt": f"2026-{(i % 12) + 1:02d}-{(i % 28) + 1:02d}T10:00:00",
+            "total_sales": rnd.randint(0, 500),
+        })
+        if rnd.random() < missing_rate:
+            continue
+
+        article = "-".join(sku.split("-")[:2])
+        keys = rnd.sample(range(IMAGE_POOL_SIZE), album + replies + trailing)
+        next_group += 1
+        main_id = next_id
+        text = (f"Кроссовки модель {i}\nАртикул: {article}\nРазмеры 36-41\n"
+                f"Материал: натуральная кожа\nЦена {rnd.randint(900, 3000)} грн\nОплата на карту")
+        for j in range(album):
+            chat.add(FakeMessage(next_id, text if j == 0 else "", new_photo(keys[j]), grouped_id=next_group))
+            next_id += 1
+        for j in range(trailing):
+            chat.add(FakeMessage(next_id, "", new_photo(keys[album + j])))
+            next_id += 1
+        for _ in range(noise):
+            chat.add(FakeMessage(next_id, f"Вопрос по наличию #{rnd.randint(1, 10**6)}"))
+            next_id += 1
+        chat.add(FakeMessage(next_id, f"Подробнее: {article} идёт в размер", reply_to_msg_id=main_id))
+        next_id += 1
+        reply_keys = keys[album + trailing:]
+        if album and rnd.random() < dup_rate:
+            reply_keys = [keys[0]] + reply_keys[1:]
+        for key in reply_keys:
+            chat.add(FakeMessage(next_id, "", new_photo(key), reply_to_msg_id=main_id))
+            next_id += 1
+    return chat, products
+
+
+IMAGE_POOL_SIZE = 48
+_IMAGE_CACHE = {}
+_IMAGE_LOCK = threading.Lock()
+
+
+def synthetic_jpeg(key, size=800):
+    """Детерминированная JPEG-картинка для ключа пула (кэшируется в памяти)."""
+    with _IMAGE_LOCK:
+        data = _IMAGE_CACHE.get(key)
+        if data is not None:
+            return data
+        rnd = random.Random(key)
+        img = Image.new("RGB", (size, size), tuple(rnd.randint(0, 255) for _ in range(3)))
+        draw = ImageDraw.Draw(img)
+        for _ in range(12):
+            x0, y0 = rnd.randint(0, size - 1), rnd.randint(0, size - 1)
+            x1, y1 = rnd.randint(x0, size), rnd.randint(y0, size)
+            draw.rectangle((x0, y0, x1, y1), fill=tuple(rnd.randint(0, 255) for _ in range(3)))
+        buf = io.BytesIO()
+        img.save(buf, format="JPEG", quality=90)
+        data = buf.getvalue()
+        _IMAGE_CACHE[key] = data
+        return data
+
+
+class FakeTelegramClient:
+    """
+    Минимальная совместимая с Telethon поверхность: start/connect/disconnect, get_entity,
+    iter_messages (search/min_id/max_id/limit/reverse, новые сначала), get_messages, download_media, takeout.
+    """
+
+    def __init__(self, chats, latency=0.0, download_latency=0.0):
+        if isinstance(chats, SyntheticChat):
+            chats = [chats]
+        self.chats = {c.entity.id: c for c in chats}
+        self.latency = latency
+        self.download_latency = download_latency
+        self.stats = {"requests": 0, "downloads": 0, "connects": 0}
+
+    async def _rpc(self, latency=None):
+        self.stats["requests"] += 1
+        delay = self.latency if latency is None else latency
+        if delay:
+            await asyncio.sleep(delay)
+
+    async def start(self, phone=None, *args, **kwargs):
+        self.stats["connects"] += 1
+        await self._rpc()
+        return self
+
+    async def connect(self):
+        self.stats["connects"] += 1
+        await self._rpc()
+
+    async def disconnect(self):
+        return None
+
+    async def is_user_authorized(self):
+        return True
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc):
+        await self.disconnect()
+
+    @contextlib.asynccontextmanager
+    async def takeout(self, finalize=True, **kwargs):
+        # takeout-сессия Telethon — тот же клиент с ослабленными лимитами; здесь просто считаем запуск
+        self.stats["takeouts"] = self.stats.get("takeouts", 0) + 1
+        await self._rpc()
+        yield self
+
+    def _chat(self, entity):
+        key = getattr(entity, "id", entity)
+        chat = self.chats.get(key)
+        if chat is None:
+            raise ValueError(f"Cannot find any entity corresponding to {entity!r}")
+        return chat
+
+    async def get_entity(self, entity):
+        await self._rpc()
+        return self._chat(entity).entity
+
+    async def iter_messages(self, entity, limit=None, *, search=None, min_id=0, max_id=0, reverse=False,
+                            ids=None, **kwargs):
+        chat = self._chat(entity)
+        if ids is not None:
+            for msg in await self.get_messages(entity, ids=ids):
+                yield msg
+            return
+        if search:
+            found = [i for i in chat.search_ids(search)
+                     if (not min_id or i > min_id) and (not max_id or i < max_id)]
+        else:
+            found = chat.range_ids(min_id, max_id)[::-1]
+        if reverse:
+            found = found[::-1]
+        if limit is not None:
+            found = found[:limit]
+        for n, msg_id in enumerate(found):
+            if n % PAGE_SIZE == 0:
+                await self._rpc()
+            yield chat.by_id[msg_id]
+        if not found:
+            await self._rpc()
+
+    async def get_messages(self, entity, *args, ids=None, **kwargs):
+        chat = self._chat(entity)
+        if ids is None:
+            return [m async for m in self.iter_messages(entity, *args, **kwargs)]
+        await self._rpc()
+        if isinstance(ids, int):
+            return chat.by_id.get(ids)
+        return [chat.by_id.get(i) for i in ids]
+
+    async def download_media(self, media, file=None, **kwargs):
+        photo = getattr(media, "photo", None) or media
+        key = getattr(photo, "image_key", None)
+        if key is None:
+            return None
+        self.stats["requests"] += 1
+        self.stats["downloads"] += 1
+        if self.download_latency:
+            await asyncio.sleep(self.download_latency)
+        data = synthetic_jpeg(key)
+        if file is None:
+            return data
+        with open(file, "wb") as f:
+            f.write(data)
+        return file
+
+
+# -------------------------
+# HTTP-заглушки
+# -------------------------
+class _StubServer:
+    """Общая часть: ThreadingHTTPServer в фоновом потоке на случайном порту."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.down = False  # True — сервис «лежит»: на любой запрос 503
+        self.stats = {}
+        self.lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def setup(self):
+                super().setup()
+                stub.count("connections")
+
+            def _dispatch(self):
+                if stub.latency:
+                    time.sleep(stub.latency)
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                parsed = urlparse(self.path)
+                if stub.down:
+                    stub.count("rejected")
+                    status, payload, headers = 503, {"error": {"message": "Service Unavailable"}}, None
+                else:
+                    status, payload, headers = stub.handle(self.command, parsed.path, parse_qs(parsed.query),
+                                                           self.headers, body)
+                data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json; charset=utf-8")
+                self.send_header("Content-Length", str(len(data)))
+                for k, v in (headers or {}).items():
+                    self.send_header(k, v)
+                self.end_headers()
+                if self.command != "HEAD":
+                    self.wfile.write(data)
+
+            do_GET = do_POST = do_PUT = do_DELETE = do_HEAD = _dispatch
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count(self, key, n=1):
+        with self.lock:
+            self.stats[key] = self.stats.get(key, 0) + n
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def handle(self, method, path, query, headers, body):
+        raise NotImplementedError
+
+
+class WooCommerceStub(_StubServer):
+    """
+    Заглушка WooCommerce REST API (wc/v3): список/чтение/обновление товаров.
+    Картинки, переданные как {"src": ...}, считаются скачанными сервером (sideloads) и получают новый media id;
+    {"id": ...} прикрепляет уже существующее вложение, неизвестный id — ошибка 400, как в WooCommerce.
+    """
+
+    PREFIX = "/wp-json/wc/v3/"
+
+    def __init__(self, products, latency=0.0):
+        super().__init__(latency)
+        self.products = {int(p["id"]): json.loads(json.dumps(p)) for p in products}
+        self.order = [int(p["id"]) for p in products]
+        self.next_media_id = 700000
+        self.media = {img["id"] for p in products for img in p.get("images", [])}
+
+    def _images(self, images):
+        out = []
+        for img in images or []:
+            if img.get("id"):
+                if int(img["id"]) not in self.media:
+                    raise ValueError(f"#{img['id']} is an invalid image ID.")
+                out.append({"id": int(img["id"]), "src": f"https://shop.test/media/{img['id']}.jpg"})
+                continue
+            with self.lock:
+                self.next_media_id += 1
+                media_id = self.next_media_id
+                self.media.add(media_id)
+            self.count("sideloads")
+            out.append({"id": media_id, "src": f"https://shop.test/media/{media_id}.jpg"})
+        return out
+
+    def _update(self, pid, data):
+        prod = self.products.get(pid)
+        if prod is None:
+            return None
+        if "images" in data:
+            prod["images"] = self._images(data["images"])  # ValueError — неизвестный media id
+        for key in ("description", "tags"):
+            if key in data:
+                prod[key] = data[key]
+        return prod
+
+    def handle(self, method, path, query, headers, body):
+        self.count(f"{method} requests")
+        if not path.startswith(self.PREFIX):
+            return 404, {"code": "rest_no_route"}, None
+        route = path[len(self.PREFIX):].strip("/")
+        data = json.loads(body.decode("utf-8")) if body else {}
+        if route == "products" and method == "GET":
+            ids = self.order
+            if query.get("include"):
+                wanted = {int(x) for x in query["include"][0].split(",") if x.strip()}
+                ids = [i for i in ids if i in wanted]
+            per_page = int(query.get("per_page", ["10"])[0])
+            page = int(query.get("page", ["1"])[0])
+            chunk = ids[(page - 1) * per_page: page * per_page]
+            total_pages = (len(ids) + per_page - 1) // per_page
+            return 200, [self.products[i] for i in chunk], {"X-WP-Total": str(len(ids)),
+                                                            "X-WP-TotalPages": str(total_pages)}
+        if route == "products/batch" and method in ("POST", "PUT"):
+            updated = []
+            for item in data.get("update", []):
+                try:
+                    prod = self._update(int(item.get("id", 0)), item)
+                except ValueError as e:
+                    prod = {"id": item.get("id"), "error": {"code": "woocommerce_product_invalid_image_id",
+                                                            "message": str(e)}}
+                updated.append(prod or {"id": item.get("id"), "error": {"code": "woocommerce_rest_product_invalid_id"}})
+            return 200, {"update": updated}, None
+        m = re.fullmatch(r"products/(\d+)", route)
+        if m:
+            pid = int(m.group(1))
+            if method == "GET":
+                prod = self.products.get(pid)
+            elif method in ("PUT", "POST"):
+                try:
+                    prod = self._update(pid, data)
+                except ValueError as e:
+                    return 400, {"code": "woocommerce_product_invalid_image_id", "message": str(e),
+                                 "data": {"status": 400}}, None
+            else:
+                prod = None
+            if prod is None:
+                return 404, {"code": "woocommerce_rest_product_invalid_id"}, None
+            return 200, prod, None
+        return 404, {"code": "rest_no_route"}, None
+
+
+def parse_multipart(headers, body):
+    """Разбирает multipart/form-data: возвращает (поля, байты файла)."""
+    ctype = headers.get("Content-Type", "")
+    if "multipart/form-data" not in ctype:
+        return {k: v[0] for k, v in parse_qs(body.decode("utf-8", "replace")).items()}, b""
+    msg = BytesParser().parsebytes(f"Content-Type: {ctype}\r\n\r\n".encode("latin-1") + body)
+    fields, file_bytes = {}, b""
+    for part in msg.get_payload():
+        name = part.get_param("name", header="content-disposition")
+        payload = part.get_payload(decode=True) or b""
+        if part.get_filename() is not None or name == "file":
+            file_bytes = payload
+        elif name:
+            fields[name] = payload.decode("utf-8", "replace")
+    return fields, file_bytes
+
+
+class CloudinaryStub(_StubServer):
+    """
+    Заглушка Cloudinary Upload API (и ping Admin API). Подключение: cloudinary.config(upload_prefix=stub.url).
+    Хранит загруженные ресурсы по public_id; URL доставки — на несуществующем домене, его никто не скачивает.
+    """
+
+    def __init__(self, latency=0.0, cloud_name="bench"):
+        super().__init__(latency)
+        self.cloud_name = cloud_name
+        self.resources = {}
+        self.partial = {}
+
+    def resource(self, public_id, size):
+        return {
+            "public_id": public_id,
+            "version": 1,
+            "format": "jpg",
+            "resource_type": "image",
+            "type": "upload",
+            "bytes": size,
+            "secure_url": f"https://res.cloudinary.test/{self.cloud_name}/image/upload/v1/{public_id}.jpg",
+        }
+
+    def handle(self, method, path, query, headers, body):
+        self.count(f"{method} requests")
+        if method == "GET" and re.fullmatch(r"/v1_1/[^/]+/ping", path):
+            return 200, {"status": "ok"}, None
+        m = re.fullmatch(r"/v1_1/[^/]+/image/(\w+)", path)
+        if not m or method != "POST":
+            return 404, {"error": {"message": "not found"}}, None
+        action = m.group(1)
+        fields, file_bytes = parse_multipart(headers, body)
+        if action == "upload":
+            self.count("upload_bytes", len(file_bytes))
+            size = len(file_bytes)
+            content_range = headers.get("Content-Range")
+            if content_range:
+                # upload_large_part: части одного файла связаны X-Unique-Upload-Id, ресурс появляется после последней
+                self.count("chunks")
+                start, end, total = map(int, re.fullmatch(r"bytes (\d+)-(\d+)/(\d+)", content_range).groups())
+                upload_id = headers.get("X-Unique-Upload-Id", "")
+                with self.lock:
+                    received = self.partial.get(upload_id, 0)
+                    if start > received:
+                        return 400, {"error": {"message": f"Missing bytes {received}-{start - 1}"}}, None
+                    self.partial[upload_id] = max(received, end + 1)
+                    if end + 1 < total:
+                        return 200, {"done": False, "bytes": end + 1}, None
+                    self.partial.pop(upload_id, None)
+                size = total
+            self.count("uploads")
+            public_id = fields.get("public_id") or uuid.uuid4().hex[:20]
+            if fields.get("folder"):
+                public_id = f"{fields['folder']}/{public_id}"
+            with self.lock:
+                existing = self.resources.get(public_id)
+                if existing and str(fields.get("overwrite", "true")).lower() in ("false", "0"):
+                    return 200, dict(existing, existing=True), None
+                res = self.resource(public_id, size)
+                self.resources[public_id] = res
+            return 200, res, None
+        if action == "explicit":
+            with self.lock:
+                res = self.resources.get(fields.get("public_id", ""))
+            if res is None:
+                return 404, {"error": {"message": f"Resource not found - {fields.get('public_id')}"}}, None
+            return 200, res, None
+        return 404, {"error": {"message": f"unsupported action {action}"}}, None
@@ -28,27 +28,55 @@ import builtins
 import getpass
 import traceback
 import re
+import hashlib
+import contextvars
+import importlib
+import contextlib
+from contextlib import contextmanager
 from datetime import datetime
-
-from PIL import Image
-import requests
-import cloudinary
-import cloudinary.uploader
+from collections import deque
 
 import tkinter as tk
 from tkinter import ttk, messagebox, simpledialog, filedialog
 
-# Try import WooCommerce client; if absent, code will still run but won't update site
-try:
-    from woocommerce import API as WC_API_Class
-except Exception:
-    WC_API_Class = None
+class LazyModule:
+    """
+    Модуль, который импортируется при первом обращении к атрибуту.
+    Pillow, Cloudinary (с requests/urllib3/certifi) и Telethon нужны только во время синхронизации,
+    поэтому окно программы и процессы-сессии не ждут их загрузки. Бюджет: python -m benchmarks.startup.
+    """
+    def __init__(self, name, *submodules):
+        self._name = name
+        self._submodules = submodules
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            module = importlib.import_module(self._name)
+            for sub in self._submodules:
+                importlib.import_module(f"{self._name}.{sub}")
+            self._module = module
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+Image = LazyModule("PIL.Image")
+cloudinary = LazyModule("cloudinary", "uploader", "utils", "exceptions", "api")
+telethon = LazyModule("telethon", "utils", "errors")
+
+def wc_api_class():
+    """woocommerce.API или None, если библиотека не установлена (она тянет requests — импорт только при создании клиента)."""
+    try:
+        from woocommerce import API
+        return API
+    except Exception:
+        return None
 
 # --- Paths ---
 APP_DIR = os.path.abspath(os.path.dirname(__file__))
 SETTINGS_PATH = os.path.join(APP_DIR, "settings.json")
 DOWNLOAD_DIR = os.path.join(APP_DIR, "downloads")
-os.makedirs(DOWNLOAD_DIR, exist_ok=True)
 
 # --- Logger ---
 def timestamp():
@@ -108,7 +136,65 @@ DEFAULT_CONFIG = {
 
     "OPERATION_MODE": "comments",
 
-    "ADDITIONAL_POSTS_POSITION": "after"
+    "ADDITIONAL_POSTS_POSITION": "after",
+
+    "METRICS_ENABLED": True,
+    "METRICS_DIR": "reports",
+
+    "CHECKPOINT_ENABLED": True,
+    "CHECKPOINT_FILE": "checkpoint.json",
+
+    "MEDIA_MAP_FILE": "wc_media_map.json",
+
+    "SKU_CACHE_ENABLED": True,
+    "SKU_CACHE_FILE": "sku_message_cache.json",
+
+    "HISTORY_MODE": "off",
+    "HISTORY_STORE_FILE": "tg_history.sqlite3",
+
+    "PHOTO_DEDUP_ENABLED": True,
+    "PHOTO_DEDUP_METHOD": "phash",
+    "PHOTO_DEDUP_DISTANCE": 8,
+
+    "SKIP_UNCHANGED_SOURCE": True,
+
+    "WC_ASYNC": True,
+    "WC_MAX_CONNECTIONS": 8,
+
+    "CLOUDINARY_CHUNKED_MB": 5,
+    "CLOUDINARY_CHUNK_MB": 6,
+
+    "CLOUDINARY_FORMAT_MODE": "local",
+    "CLOUDINARY_DELIVERY_TRANSFORM": "f_auto,q_auto",
+
+    "TG_SESSIONS": [],
+    "SHARD_START_METHOD": "spawn",
+
+    "PRODUCT_PRIORITY": "",
+
+    "REPORT_DIR": "reports",
+
+    "DESC_FAST_PATH": True,
+    "DESC_FAST_PAUSE": 3,
+    "WC_BATCH_SIZE": 50,
+
+    "SKU_BULK_MATCH": True,
+
+    "CLOUDINARY_STABLE_IDS": True,
+
+    "BREAKER_THRESHOLD": 5,
+    "BREAKER_COOLDOWN": 120,
+
+    "RETRY_FAILED_ONLY": False,
+    "RETRY_REASONS": "",
+
+    "WC_SHOPS": [],
+    "RECORD_CASSETTE": "",
+    "PROFILE_MODE": "off",
+    "PROFILE_SAMPLE_MS": 5,
+    "SLOW_CALLBACK_MS": 0,
+    "PREFLIGHT_ENABLED": True,
+    "PREFLIGHT_TIMEOUT": 20
 }
 
 # --- Settings load/save ---
@@ -145,6 +231,740 @@ def save_settings(cfg):
     with open(SETTINGS_PATH, "w", encoding="utf-8") as f:
         json.dump(cfg, f, ensure_ascii=False, indent=2)
 
+# -------------------------
+# Run metrics (stage spans)
+# -------------------------
+# Границы корзин гистограмм, секунды
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_current_product = contextvars.ContextVar("current_product", default=None)
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+class Histogram:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(METRIC_BUCKETS) + 1)
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        for i, bound in enumerate(METRIC_BUCKETS):
+            if value <= bound:
+                self.buckets[i] += 1
+                return
+        self.buckets[-1] += 1
+
+    def quantile(self, q):
+        """Оценка квантиля по корзинам (линейная интерполяция внутри корзины)."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        lower = 0.0
+        for i, n in enumerate(self.buckets):
+            upper = METRIC_BUCKETS[i] if i < len(METRIC_BUCKETS) else self.max
+            if n and seen + n >= rank:
+                return min(self.max, lower + (upper - lower) * (rank - seen) / n)
+            seen += n
+            lower = upper
+        return self.max
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": round(self.total, 6),
+            "max": round(self.max, 6),
+            "p50": round(self.quantile(0.5), 6),
+            "p95": round(self.quantile(0.95), 6),
+            "buckets": {("+Inf" if i == len(METRIC_BUCKETS) else str(METRIC_BUCKETS[i])): n
+                        for i, n in enumerate(self.buckets)},
+        }
+
+class RunMetrics:
+    """
+    Лёгкие замеры этапов синхронизации. span() считает "чистое" время этапа:
+    время вложенных span'ов (например download_media внутри сканирования ответов) вычитается.
+    Текущий товар берётся из contextvars, поэтому замеры внутри asyncio.to_thread тоже привязываются к товару.
+    Замеры по товару держатся только пока товар обрабатывается: product() отдаёт их вызывающему для строки
+    отчёта, а здесь остаются гистограммы.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = datetime.now()
+            self.stages = {}
+            self.product_stages = {}
+            self.products = {}  # товары в обработке -> время этапов
+            self.outcomes = {}
+            self.total = 0
+            self.active = {}  # товар (None — этап вне товара) -> стек открытых span'ов
+            self.calls = {}  # сервис -> время последних запросов (для скорости в панели хода)
+
+    def observe(self, stage, seconds, product_id=None):
+        with self.lock:
+            self.stages.setdefault(stage, Histogram()).observe(seconds)
+            if product_id is not None:
+                per = self.products.setdefault(product_id, {})
+                per[stage] = per.get(stage, 0.0) + seconds
+
+    @contextmanager
+    def span(self, stage):
+        frame = [0.0]  # время вложенных span'ов
+        token = _current_span.set(frame)
+        product_id = _current_product.get()
+        with self.lock:
+            self.active.setdefault(product_id, []).append(stage)
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - t0
+            _current_span.reset(token)
+            parent = _current_span.get()
+            if parent is not None:
+                parent[0] += elapsed
+            self._leave(product_id, stage)
+            self.observe(stage, max(0.0, elapsed - frame[0]), product_id)
+
+    def _leave(self, product_id, stage):
+        with self.lock:
+            stack = self.active.get(product_id)
+            if stack and stage in stack:
+                # параллельные span'ы одного товара закрываются не по порядку — убираем последнее вхождение
+                del stack[len(stack) - 1 - stack[::-1].index(stage)]
+            if product_id is None and not stack:
+                self.active.pop(None, None)
+
+    @contextmanager
+    def product(self, product_id):
+        """Замеры товара; отдаёт словарь, который после выхода заполняется временем этапов (секунды)."""
+        token = _current_product.set(str(product_id))
+        with self.lock:
+            self.active.setdefault(str(product_id), [])
+        timings = {}
+        t0 = time.perf_counter()
+        try:
+            yield timings
+        finally:
+            _current_product.reset(token)
+            timings.update(self.finish_product(str(product_id), time.perf_counter() - t0))
+
+    def finish_product(self, product_id, seconds):
+        with self.lock:
+            self.active.pop(product_id, None)
+            self.stages.setdefault("product_total", Histogram()).observe(seconds)
+            per = self.products.pop(product_id, {})
+            per["product_total"] = per.get("product_total", 0.0) + seconds
+            for stage, value in per.items():
+                self.product_stages.setdefault(stage, Histogram()).observe(value)
+        return {k: round(v, 6) for k, v in per.items()}
+
+    def count_outcome(self, outcome):
+        with self.lock:
+            self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+
+    def set_total(self, total):
+        with self.lock:
+            self.total = int(total)
+
+    def call(self, service):
+        """Отметка запроса к сервису (telegram, woocommerce, cloudinary) для скорости в панели хода."""
+        with self.lock:
+            self.calls.setdefault(service, deque(maxlen=10000)).append(time.monotonic())
+
+    def progress(self, window=60.0):
+        """Снимок для панели хода: счётчики, скорость, оценка остатка, текущие этапы и запросы за window секунд."""
+        with self.lock:
+            now = time.monotonic()
+            processed = sum(self.outcomes.values())
+            elapsed = (datetime.now() - self.started).total_seconds()
+            per_min = processed / elapsed * 60 if elapsed > 0 else 0.0
+            remaining = max(0, self.total - processed)
+            active = {pid: (stack[-1] if stack else None) for pid, stack in self.active.items() if pid is not None}
+            depth = {}
+            for stack in self.active.values():
+                if stack:
+                    depth[stack[-1]] = depth.get(stack[-1], 0) + 1
+            services = {name: {"per_min": sum(1 for t in times if now - t <= window) * 60.0 / window}
+                        for name, times in self.calls.items()}
+            return {
+                "total": self.total,
+                "processed": processed,
+                "outcomes": dict(self.outcomes),
+                "elapsed_s": elapsed,
+                "per_min": per_min,
+                "eta_s": remaining / per_min * 60 if per_min > 0 and remaining else None,
+                "active": active,
+                "stages": depth,
+                "services": services,
+            }
+
+    def export_raw(self):
+        """Сырые гистограммы (простые типы — передаются между процессами)."""
+        with self.lock:
+            pack = lambda hs: {k: (h.count, h.total, h.max, list(h.buckets)) for k, h in hs.items()}
+            return {"stages": pack(self.stages), "product_stages": pack(self.product_stages)}
+
+    def merge_raw(self, raw):
+        """Добавляет замеры другого процесса (см. export_raw)."""
+        with self.lock:
+            for name in ("stages", "product_stages"):
+                target = getattr(self, name)
+                for stage, (count, total, mx, buckets) in raw.get(name, {}).items():
+                    h = target.setdefault(stage, Histogram())
+                    h.count += count
+                    h.total += total
+                    h.max = max(h.max, mx)
+                    h.buckets = [a + b for a, b in zip(h.buckets, buckets)]
+
+    def to_json(self):
+        with self.lock:
+            return {
+                "started": self.started.strftime("%Y-%m-%d %H:%M:%S"),
+                "finished": timestamp(),
+                "outcomes": dict(self.outcomes),
+                "stages": {k: h.to_dict() for k, h in self.stages.items()},
+                "per_product_stages": {k: h.to_dict() for k, h in self.product_stages.items()},
+            }
+
+    def to_prometheus(self, prefix="wc_tg_sync"):
+        lines = []
+        with self.lock:
+            for name, source, help_text in (
+                ("stage_seconds", self.stages, "Длительность одного вызова этапа (чистое время)"),
+                ("product_stage_seconds", self.product_stages, "Суммарное время этапа на один товар"),
+            ):
+                metric = f"{prefix}_{name}"
+                lines.append(f"# HELP {metric} {help_text}")
+                lines.append(f"# TYPE {metric} histogram")
+                for stage, h in sorted(source.items()):
+                    cumulative = 0
+                    for i, n in enumerate(h.buckets):
+                        cumulative += n
+                        le = "+Inf" if i == len(METRIC_BUCKETS) else repr(float(METRIC_BUCKETS[i]))
+                        lines.append(f'{metric}_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+                    lines.append(f'{metric}_sum{{stage="{stage}"}} {h.total:.6f}')
+                    lines.append(f'{metric}_count{{stage="{stage}"}} {h.count}')
+            metric = f"{prefix}_products_total"
+            lines.append(f"# HELP {metric} Обработанные товары по итогу")
+            lines.append(f"# TYPE {metric} counter")
+            for outcome, n in sorted(self.outcomes.items()):
+                lines.append(f'{metric}{{outcome="{outcome}"}} {n}')
+        return "\n".join(lines) + "\n"
+
+    def summary_lines(self):
+        with self.lock:
+            items = sorted(((k, h) for k, h in self.stages.items() if k != "product_total"),
+                           key=lambda kv: kv[1].total, reverse=True)
+            total = self.stages.get("product_total")
+        out = []
+        if total and total.count:
+            out.append(f"Время на товар: p50={total.quantile(0.5):.2f}s, p95={total.quantile(0.95):.2f}s, max={total.max:.2f}s")
+        for stage, h in items:
+            out.append(f"  {stage}: {h.count} выз., всего {h.total:.1f}s, p50={h.quantile(0.5):.2f}s, p95={h.quantile(0.95):.2f}s")
+        return out
+
+    def write_reports(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        stamp = self.started.strftime("%Y%m%d_%H%M%S")
+        json_path = os.path.join(directory, f"run_{stamp}.json")
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(self.to_json(), f, ensure_ascii=False, indent=2)
+        prom_path = os.path.join(directory, "metrics.prom")
+        with open(prom_path, "w", encoding="utf-8") as f:
+            f.write(self.to_prometheus())
+        return json_path, prom_path
+
+METRICS = RunMetrics()
+
+# -------------------------
+# Circuit breakers
+# -------------------------
+class CircuitOpenError(Exception):
+    """Сервис недоступен: предохранитель разомкнут, запрос не отправлялся."""
+    def __init__(self, service):
+        super().__init__(f"{service} недоступен (предохранитель разомкнут)")
+        self.service = service
+
+class CircuitBreaker:
+    """
+    Предохранитель сервиса: после threshold ошибок подряд размыкается и cooldown секунд не пропускает запросы.
+    Потом пропускает пробный запрос (half-open): успех замыкает, ошибка снова размыкает на cooldown.
+    """
+    def __init__(self, name, threshold=5, cooldown=120):
+        self.name = name
+        self.threshold = max(1, int(threshold))
+        self.cooldown = float(cooldown)
+        self.lock = threading.Lock()
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_at = 0.0
+
+    def allow(self):
+        with self.lock:
+            if self.state == "closed":
+                return True
+            now = time.monotonic()
+            if self.state == "open" and now - self.opened_at >= self.cooldown:
+                self.state = "half_open"
+                self.probe_at = now
+                lg(f"{self.name}: пробный запрос после паузы {int(self.cooldown)}s.")
+                return True
+            # пробный запрос, который так и не отчитался, не держит предохранитель вечно
+            if self.state == "half_open" and now - self.probe_at >= self.cooldown:
+                self.probe_at = now
+                return True
+            return False
+
+    def check(self):
+        if not self.allow():
+            raise CircuitOpenError(self.name)
+
+    def blocked(self):
+        """Запрос сейчас не пройдёт (без захвата пробного запроса — для проверки до начала работы с товаром)."""
+        with self.lock:
+            now = time.monotonic()
+            if self.state == "open":
+                return now - self.opened_at < self.cooldown
+            return self.state == "half_open" and now - self.probe_at < self.cooldown
+
+    def status(self):
+        """(состояние, секунд до пробного запроса) — для панели хода синхронизации."""
+        with self.lock:
+            if self.state == "open":
+                return "open", max(0.0, self.cooldown - (time.monotonic() - self.opened_at))
+            return self.state, 0.0
+
+    def success(self):
+        with self.lock:
+            if self.state != "closed":
+                lg(f"{self.name}: сервис снова отвечает — работа продолжается.")
+            self.state = "closed"
+            self.failures = 0
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == "half_open" or (self.state == "closed" and self.failures >= self.threshold):
+                self.state = "open"
+                self.opened_at = time.monotonic()
+                lg(f"{self.name}: {self.failures} ошибок подряд — запросы приостановлены на {int(self.cooldown)}s, "
+                   f"товары уходят в ручную проверку.")
+
+BREAKERS = {name: CircuitBreaker(name) for name in ("telegram", "cloudinary", "woocommerce")}
+
+def configure_breakers(cfg):
+    """Новые предохранители на прогон с порогом и паузой из настроек."""
+    threshold = int(cfg.get("BREAKER_THRESHOLD", 5))
+    cooldown = float(cfg.get("BREAKER_COOLDOWN", 120))
+    for name in list(BREAKERS):
+        BREAKERS[name] = CircuitBreaker(name, threshold, cooldown)
+
+def progress_snapshot():
+    """METRICS.progress() плюс состояние предохранителей сервисов."""
+    snap = METRICS.progress()
+    for name, breaker in BREAKERS.items():
+        state, retry_in = breaker.status()
+        snap["services"].setdefault(name, {"per_min": 0.0}).update(state=state, retry_in=retry_in)
+    return snap
+
+# -------------------------
+# Run report (streamed per product)
+# -------------------------
+REPORT_FIELDS = ("ts", "product_id", "name", "article", "outcome", "reason", "error", "photos_count", "desc_updated", "shop", "seconds")
+
+class RunReport:
+    """
+    Итоги по товарам пишутся в products_<время>.jsonl и .csv сразу после обработки товара;
+    в памяти остаются только счётчики, поэтому размер каталога на память и окно лога не влияет.
+    """
+    def __init__(self, directory):
+        import csv
+        os.makedirs(directory, exist_ok=True)
+        stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        self.jsonl_path = os.path.join(directory, f"products_{stamp}.jsonl")
+        self.csv_path = os.path.join(directory, f"products_{stamp}.csv")
+        self.lock = threading.Lock()
+        self.counts = {"updated": 0, "failed": 0, "review": 0}
+        self.reasons = {}
+        self._jsonl = open(self.jsonl_path, "w", encoding="utf-8")
+        self._csv_file = open(self.csv_path, "w", encoding="utf-8-sig", newline="")  # BOM — чтобы Excel понял кириллицу
+        self._csv = csv.DictWriter(self._csv_file, fieldnames=REPORT_FIELDS, extrasaction="ignore")
+        self._csv.writeheader()
+
+    def add(self, result, outcome):
+        row = {
+            "ts": timestamp(),
+            "product_id": result.get("product_id"),
+            "name": result.get("name", ""),
+            "article": result.get("article", ""),
+            "outcome": outcome,
+            "reason": result.get("review_reason") or "",
+            "error": result.get("error") or "",
+            "photos_count": result.get("photos_count", 0),
+            "desc_updated": bool(result.get("desc_updated")),
+            "shop": result.get("shop", ""),
+            "seconds": (result.get("stages") or {}).get("product_total", ""),
+        }
+        with self.lock:
+            self.counts[outcome] = self.counts.get(outcome, 0) + 1
+            if outcome != "updated":
+                reason = row["reason"] or ("error" if row["error"] else "update_failed")
+                self.reasons[reason] = self.reasons.get(reason, 0) + 1
+            self._jsonl.write(json.dumps(dict(result, outcome=outcome, ts=row["ts"]), ensure_ascii=False, default=str) + "\n")
+            self._jsonl.flush()
+            self._csv.writerow(row)
+            self._csv_file.flush()
+
+    def close(self):
+        with self.lock:
+            for f in (self._jsonl, self._csv_file):
+                try: f.close()
+                except Exception: pass
+
+    def summary_lines(self):
+        with self.lock:
+            lines = [f"Успешно обновлено: {self.counts.get('updated', 0)}",
+                     f"Не удалось обновить: {self.counts.get('failed', 0)}",
+                     f"Требуют ручной проверки: {self.counts.get('review', 0)}"]
+            if self.reasons:
+                lines.append("Причины: " + ", ".join(f"{k} — {v}" for k, v in sorted(self.reasons.items(), key=lambda kv: -kv[1])))
+        return lines
+
+# -------------------------
+# Run recording (cassette)
+# -------------------------
+CASSETTE_SECRET_KEYS = ("TG_API_HASH", "TG_PHONE", "WC_KEY", "WC_SECRET", "CLOUDINARY_API_KEY", "CLOUDINARY_API_SECRET")
+CASSETTE_STATE_KEYS = ("UPDATED_FILE", "MEDIA_MAP_FILE", "CHECKPOINT_FILE", "SKU_CACHE_FILE", "HISTORY_STORE_FILE")
+REDACTED = "<redacted>"
+
+def cassette_key(*parts):
+    """Ключ вызова в кассете: одни и те же аргументы при записи и воспроизведении дают одну строку."""
+    return json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+
+def message_record(msg):
+    """Сообщение Telegram для кассеты: поля StoredMessage без chat_id (None — сообщения нет)."""
+    if msg is None:
+        return None
+    photo = getattr(msg, "photo", None)
+    return [msg.id, msg.text or "", getattr(msg, "grouped_id", None), getattr(msg, "reply_to_msg_id", None),
+            getattr(photo, "id", None) if photo else None,
+            HistoryStore._iso(getattr(msg, "date", None)), HistoryStore._iso(getattr(msg, "edit_date", None))]
+
+def media_photo_id(media):
+    """id фото, которое скачивает download_media: MessageMediaPhoto, Photo или StoredPhoto."""
+    photo = getattr(media, "photo", None)
+    return getattr(photo if photo is not None else media, "id", None)
+
+def cassette_secrets(cfg):
+    """Значения ключей и паролей из настроек, включая WC_SHOPS и TG_SESSIONS (длинные — первыми)."""
+    values = set()
+    for source in [cfg, *(cfg.get("WC_SHOPS") or []), *(cfg.get("TG_SESSIONS") or [])]:
+        if isinstance(source, dict):
+            values.update(str(source[k]) for k in CASSETTE_SECRET_KEYS if source.get(k))
+    return sorted((v for v in values if len(v) >= 4), key=len, reverse=True)
+
+class CassetteRecorder:
+    """
+    Запись прогона для воспроизведения без сети (python -m benchmarks.replay): ответы Telegram, WooCommerce
+    и Cloudinary по порядку вызовов в calls.jsonl, скачанные фото — в blobs/<sha1>, файлы состояния
+    на момент старта — в state/, настройки — в config.json. Ключи и пароли из настроек заменяются
+    на <redacted> до записи на диск.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.directory = None
+        self._calls = None
+        self.secrets = []
+        self.count = 0
+        self.started = 0.0
+
+    @property
+    def active(self):
+        return self._calls is not None
+
+    def redact(self, text):
+        for secret in self.secrets:
+            text = text.replace(secret, REDACTED)
+        return text
+
+    def start(self, root, cfg):
+        import shutil
+        self.stop()
+        directory = os.path.join(root, "cassette_" + datetime.now().strftime("%Y%m%d_%H%M%S"))
+        base, n = directory, 1
+        while os.path.exists(directory):
+            n += 1
+            directory = f"{base}_{n}"
+        os.makedirs(os.path.join(directory, "blobs"), exist_ok=True)
+        os.makedirs(os.path.join(directory, "state"), exist_ok=True)
+        self.secrets = cassette_secrets(cfg)
+        paths = [cfg.get(key) for key in CASSETTE_STATE_KEYS]
+        paths += [shop[key] for shop in shop_configs(cfg)[1:] for key, _ in SHOP_STATE_KEYS]
+        state = []
+        for path in paths:
+            # база истории в режиме WAL: незакреплённые записи лежат в файле -wal рядом
+            for suffix in ("", "-wal"):
+                if path and os.path.exists(path + suffix):
+                    name = os.path.basename(path) + suffix
+                    shutil.copyfile(path + suffix, os.path.join(directory, "state", name))
+                    state.append(name)
+        with open(os.path.join(directory, "config.json"), "w", encoding="utf-8") as f:
+            f.write(self.redact(json.dumps({"config": cfg, "state": state}, ensure_ascii=False, indent=2, default=str)))
+        with self.lock:
+            self.directory = directory
+            self.count = 0
+            self.started = time.perf_counter()
+            self._calls = open(os.path.join(directory, "calls.jsonl"), "w", encoding="utf-8")
+        return directory
+
+    def add_blob(self, path):
+        """Копирует скачанный файл в blobs/ (один раз на содержимое) и возвращает его SHA-1."""
+        import shutil
+        sha1 = file_sha1(path)
+        dest = os.path.join(self.directory, "blobs", sha1)
+        if not os.path.exists(dest):
+            shutil.copyfile(path, dest)
+        return sha1
+
+    def record(self, service, key, ms, result=None, error=None):
+        with self.lock:
+            if self._calls is None:
+                return
+            entry = {"n": self.count, "t": round(time.perf_counter() - self.started, 4),
+                     "service": service, "key": key, "ms": round(ms, 2), "result": result}
+            if error is not None:
+                entry["error"] = [type(error).__name__, str(error)]
+            self._calls.write(self.redact(json.dumps(entry, ensure_ascii=False, default=str)) + "\n")
+            self.count += 1
+
+    def stop(self, outcomes=None):
+        """Закрывает запись; outcomes (итоги прогона) сохраняются для сверки при воспроизведении."""
+        with self.lock:
+            if self._calls is None:
+                return
+            self._calls.close()
+            self._calls = None
+            with open(os.path.join(self.directory, "summary.json"), "w", encoding="utf-8") as f:
+                json.dump({"calls": self.count, "outcomes": outcomes or {},
+                           "elapsed_s": round(time.perf_counter() - self.started, 3)}, f, ensure_ascii=False, indent=2)
+
+RECORDER = CassetteRecorder()
+
+class RecordingTelegramClient:
+    """Обёртка над клиентом Telethon при RECORD_CASSETTE: результаты чтений и скачиваний пишутся в кассету."""
+    def __init__(self, client, recorder):
+        self.client = client
+        self.recorder = recorder
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    async def _call(self, key, coro, convert):
+        t0 = time.perf_counter()
+        try:
+            value = await coro
+        except Exception as e:
+            self.recorder.record("telegram", key, (time.perf_counter() - t0) * 1000, error=e)
+            raise
+        self.recorder.record("telegram", key, (time.perf_counter() - t0) * 1000, convert(value))
+        return value
+
+    async def get_entity(self, entity):
+        return await self._call(cassette_key("get_entity", entity), self.client.get_entity(entity),
+                                lambda ent: {"id": entity_key(ent)})
+
+    async def get_messages(self, entity, *args, ids=None, **kwargs):
+        def convert(value):
+            if isinstance(value, list):
+                return {"list": [message_record(m) for m in value]}
+            return {"one": message_record(value)}
+        key = cassette_key("get_messages", entity_key(entity), args, ids, kwargs)
+        return await self._call(key, self.client.get_messages(entity, *args, ids=ids, **kwargs), convert)
+
+    async def iter_messages(self, entity, limit=None, **kwargs):
+        # в кассету попадает то, что успел прочитать потребитель; время — только ожидание Telegram
+        key = cassette_key("iter_messages", entity_key(entity), limit, kwargs)
+        seen = []
+        waited = 0.0
+        error = None
+        source = self.client.iter_messages(entity, limit, **kwargs).__aiter__()
+        try:
+            while True:
+                t0 = time.perf_counter()
+                try:
+                    m = await source.__anext__()
+                except StopAsyncIteration:
+                    break
+                finally:
+                    waited += time.perf_counter() - t0
+                seen.append(message_record(m))
+                yield m
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self.recorder.record("telegram", key, waited * 1000, seen, error)
+
+    async def download_media(self, media, *args, **kwargs):
+        def convert(path):
+            if isinstance(path, str) and os.path.exists(path):
+                return {"blob": self.recorder.add_blob(path)}
+            return {"blob": None}
+        key = cassette_key("download_media", media_photo_id(media))
+        return await self._call(key, self.client.download_media(media, *args, **kwargs), convert)
+
+    @contextlib.asynccontextmanager
+    async def takeout(self, *args, **kwargs):
+        async with self.client.takeout(*args, **kwargs) as takeout:
+            yield RecordingTelegramClient(takeout, self.recorder)
+
+# -------------------------
+# Profiling (PROFILE_MODE, SLOW_CALLBACK_MS)
+# -------------------------
+PROFILE_MODES = ("off", "cprofile", "sample")
+
+class StackSampler:
+    """
+    Сэмплирующий профайлер без зависимостей: фоновый поток раз в interval снимает стек потока
+    цикла событий (sys._current_frames) и копит одинаковые стеки. Результат — формат collapsed
+    («файл:функция;...;файл:функция число» на строку) для flamegraph.pl и speedscope. Время простоя
+    цикла видно как стек select — это ожидание сети.
+    """
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = max(0.001, interval)
+        self.stacks = {}
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            names = []
+            while frame is not None:
+                names.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+                frame = frame.f_back
+            if names:
+                stack = ";".join(reversed(names))
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+                self.samples += 1
+
+    def write(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, n in sorted(self.stacks.items()):
+                f.write(f"{stack} {n}\n")
+
+class LoopWatchdog:
+    """
+    Поиск блокировок цикла событий: в цикле тикает сердцебиение, фоновый поток следит за ним.
+    Если цикл не отвечает дольше threshold, в лог идёт стек потока цикла — видно, какой синхронный
+    вызов (time.sleep, requests, Pillow) его держит. Об одной остановке сообщается один раз.
+    """
+    def __init__(self, thread_id, threshold):
+        self.thread_id = thread_id
+        self.threshold = threshold
+        self.interval = threshold / 4
+        self.beat = time.monotonic()
+        self.stalls = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="loop-watchdog", daemon=True)
+
+    async def heartbeat(self):
+        while True:
+            self.beat = time.monotonic()
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        reported = None
+        while not self._stop.wait(self.interval):
+            beat = self.beat
+            stalled = time.monotonic() - beat - self.interval
+            if stalled < self.threshold or beat == reported:
+                continue
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            reported = beat
+            self.stalls += 1
+            stack = "".join(traceback.format_stack(frame))
+            lg(f"Цикл событий заблокирован уже {stalled:.2f} с (порог {self.threshold:.2f} с), стек:\n{stack}")
+
+async def _run_watched(coro_fn, slow_ms):
+    """coro_fn() под LoopWatchdog и предупреждениями asyncio о медленных колбэках."""
+    if slow_ms <= 0:
+        return await coro_fn()
+    loop = asyncio.get_running_loop()
+    loop.slow_callback_duration = slow_ms / 1000
+    watchdog = LoopWatchdog(threading.get_ident(), slow_ms / 1000).start()
+    beat = asyncio.ensure_future(watchdog.heartbeat())
+    try:
+        return await coro_fn()
+    finally:
+        beat.cancel()
+        watchdog.stop()
+        ulog(f"Блокировок цикла событий дольше {slow_ms:g} мс: {watchdog.stalls}")
+
+def run_profiled(coro_fn, cfg):
+    """
+    asyncio.run(coro_fn()) с профилированием по PROFILE_MODE и поиском блокировок цикла по SLOW_CALLBACK_MS.
+    cprofile — profile_<время>.prof (pstats, snakeviz, flameprof); sample — profile_<время>.folded
+    (flamegraph.pl, speedscope). Файлы пишутся в METRICS_DIR.
+    """
+    mode = cfg.get("PROFILE_MODE", "off") or "off"
+    slow_ms = float(cfg.get("SLOW_CALLBACK_MS", 0) or 0)
+    directory = cfg.get("METRICS_DIR", "reports")
+    stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    profiler = sampler = None
+    if mode == "cprofile":
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    elif mode == "sample":
+        sampler = StackSampler(threading.get_ident(), float(cfg.get("PROFILE_SAMPLE_MS", 5) or 5) / 1000).start()
+    try:
+        return asyncio.run(_run_watched(coro_fn, slow_ms), debug=slow_ms > 0)
+    finally:
+        try:
+            if profiler is not None:
+                profiler.disable()
+                os.makedirs(directory, exist_ok=True)
+                path = os.path.join(directory, f"profile_{stamp}.prof")
+                profiler.dump_stats(path)
+                ulog(f"Профиль (cProfile) сохранён: {path}")
+            if sampler is not None:
+                sampler.stop()
+                os.makedirs(directory, exist_ok=True)
+                path = os.path.join(directory, f"profile_{stamp}.folded")
+                sampler.write(path)
+                ulog(f"Профиль (сэмплы, {sampler.samples} шт.) сохранён: {path}")
+        except Exception as e:
+            lg(f"Не удалось сохранить профиль: {e}")
+
 # -------------------------
 # Text helpers and filtering
 # -------------------------
@@ -271,27 +1091,232 @@ def image_file_ok(path, cfg):
         return False
     return True
 
-def upload_image_cloudinary(image_path, cfg, retries=3, delay=4):
-    prepared = prepare_image_for_upload(image_path, cfg)
-    if not prepared:
-        lg(f"Подготовка файла не удалась: {image_path}")
+def file_sha1(path, chunk_size=1024*1024):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+_DCT_32 = None
+
+def perceptual_hash(path, method="dhash"):
+    """
+    64-битный перцептивный хэш картинки: dhash (разность соседних пикселей 9x8) или phash (DCT 32x32).
+    JPEG декодируется сразу в уменьшенном виде (draft), полный кадр не разворачивается.
+    """
+    global _DCT_32
+    with Image.open(path) as img:
+        img.draft("L", (64, 64))
+        gray = img.convert("L")
+    if method == "phash":
+        px = list(gray.resize((32, 32), Image.BILINEAR).getdata())
+        if _DCT_32 is None:
+            import math
+            _DCT_32 = [[math.cos((2 * x + 1) * u * math.pi / 64) for x in range(32)] for u in range(8)]
+        rows = [[sum(px[y * 32 + x] * _DCT_32[u][x] for x in range(32)) for u in range(8)] for y in range(32)]
+        coeffs = [sum(rows[y][u] * _DCT_32[v][y] for y in range(32)) for v in range(8) for u in range(8)]
+        median = sorted(coeffs[1:])[len(coeffs[1:]) // 2]
+        bits = [c > median for c in coeffs]
+    else:
+        px = list(gray.resize((9, 8), Image.BILINEAR).getdata())
+        bits = [px[y * 9 + x] > px[y * 9 + x + 1] for y in range(8) for x in range(8)]
+    value = 0
+    for b in bits:
+        value = (value << 1) | int(b)
+    return value
+
+class PhotoDeduper:
+    """Отсеивает почти одинаковые фото в наборе одного товара (расстояние Хэмминга перцептивных хэшей)."""
+    def __init__(self, method="dhash", max_distance=6):
+        self.method = method
+        self.max_distance = max_distance
+        self.hashes = []
+        self.dropped = 0
+
+    def is_duplicate(self, path):
+        try:
+            with METRICS.span("photo_dedup"):
+                h = perceptual_hash(path, self.method)
+        except Exception as e:
+            lg(f"Не удалось посчитать хэш {os.path.basename(path)}: {e}", verbose_only=True)
+            return False
+        if any(bin(h ^ other).count("1") <= self.max_distance for other in self.hashes):
+            self.dropped += 1
+            return True
+        self.hashes.append(h)
+        return False
+
+def keep_photo(path, dedup):
+    """True — фото идёт в набор; повтор уже взятого фото удаляется с диска, его место займёт следующее."""
+    if dedup is None or not dedup.is_duplicate(path):
+        return True
+    try:
+        os.remove(path)
+    except Exception:
+        pass
+    return False
+
+def cloudinary_call_key(name, args, kwargs):
+    """Ключ вызова Cloudinary в кассете: public_id, имя файла (или ресурса) и диапазон части."""
+    subject = None
+    if args:
+        subject = args[0][0] if isinstance(args[0], tuple) else os.path.basename(str(args[0]))
+    return cassette_key("cloudinary", name, kwargs.get("public_id"), subject,
+                        (kwargs.get("http_headers") or {}).get("Content-Range"))
+
+def cloudinary_call(name, *args, **kwargs):
+    """cloudinary.uploader.<name>(...) или cloudinary.api.<name>(...); при записи прогона ответ или ошибка идут в кассету."""
+    call = getattr(cloudinary.uploader, name, None) or getattr(cloudinary.api, name)
+    METRICS.call("cloudinary")
+    if not RECORDER.active:
+        return call(*args, **kwargs)
+    key = cloudinary_call_key(name, args, kwargs)
+    t0 = time.perf_counter()
+    try:
+        result = call(*args, **kwargs)
+    except Exception as e:
+        RECORDER.record("cloudinary", key, (time.perf_counter() - t0) * 1000, error=e)
+        raise
+    RECORDER.record("cloudinary", key, (time.perf_counter() - t0) * 1000, dict(result) if result else result)
+    return result
+
+def upload_large_resumable(path, state, checkpoint=None, part_retries=3, delay=2):
+    """
+    Загрузка большого файла в Cloudinary частями (upload_large_part с общим X-Unique-Upload-Id).
+    Части читаются срезами memory-mapped файла, поэтому в памяти одновременно только одна часть.
+    Сбойная часть переотправляется с тем же upload_id и смещением до part_retries раз; если не вышло,
+    state остаётся на первой неподтверждённой части — следующий вызов (и перезапуск с контрольной точкой)
+    продолжает с неё, а не с начала файла.
+    """
+    import mmap
+    name = os.path.basename(path)
+    size = state["size"]
+    result = None
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        while state["offset"] < size:
+            start = state["offset"]
+            end = min(start + state["chunk_size"], size)
+            headers = {"Content-Range": f"bytes {start}-{end - 1}/{size}", "X-Unique-Upload-Id": state["upload_id"]}
+            options = {"public_id": state["public_id"], "overwrite": False} if state.get("public_id") else {}
+            for attempt in range(1, part_retries + 1):
+                try:
+                    result = cloudinary_call("upload_large_part", (name, mm[start:end]), http_headers=headers,
+                                             folder="tg_import", resource_type="image", **options)
+                    break
+                except Exception as e:
+                    if attempt == part_retries:
+                        raise
+                    lg(f"Часть {start}-{end - 1} файла {name} не загружена ({e}), повтор {attempt}/{part_retries - 1}")
+                    time.sleep(delay * attempt)
+            state["offset"] = end
+            if checkpoint and end < size:
+                checkpoint.set_chunked(name, state)
+    if checkpoint:
+        checkpoint.set_chunked(name, None)
+    return result
+
+def chunked_upload_state(path, cfg, checkpoint=None, public_id=None):
+    """Состояние частичной загрузки: из контрольной точки, если файл тот же, иначе новое."""
+    size = os.path.getsize(path)
+    saved = (checkpoint.get().get("chunked") or {}).get(os.path.basename(path)) if checkpoint else None
+    if saved and saved.get("size") == size and saved.get("public_id") == public_id:
+        return dict(saved)
+    chunk_mb = max(5, int(cfg.get("CLOUDINARY_CHUNK_MB", 6)))  # Cloudinary не принимает части меньше 5 МБ
+    return {"upload_id": cloudinary.utils.random_public_id(), "offset": 0, "size": size,
+            "chunk_size": chunk_mb * 1024 * 1024, "public_id": public_id}
+
+def cloudinary_public_id(content_hash, cfg):
+    """
+    Постоянный public_id по SHA-1 исходного файла: одни и те же байты из Telegram всегда дают один ресурс.
+    В режиме server загружается исходник, в local — JPEG после подготовки, поэтому id у режимов разные.
+    """
+    suffix = "_src" if cfg.get("CLOUDINARY_FORMAT_MODE", "local") == "server" else ""
+    return f"tg_{content_hash}{suffix}"
+
+def cloudinary_existing(public_id):
+    """Уже загруженный ресурс tg_import/<public_id> (ответ explicit) или None."""
+    BREAKERS["cloudinary"].check()
+    try:
+        with METRICS.span("cloudinary_exists"):
+            return cloudinary_call("explicit", f"tg_import/{public_id}", type="upload", resource_type="image")
+    except cloudinary.exceptions.NotFound:
+        BREAKERS["cloudinary"].success()
         return None
-    if not image_file_ok(prepared, cfg):
-        lg(f"Файл не соответствует ограничениям: {os.path.basename(prepared)}")
+    except Exception as e:
+        BREAKERS["cloudinary"].failure()
+        lg(f"Проверка ресурса {public_id} в Cloudinary не удалась: {e}")
         return None
+
+def cloudinary_delivery_url(res, cfg):
+    """
+    URL, который уходит в WooCommerce. В режиме server — адрес с трансформацией доставки (по умолчанию
+    f_auto,q_auto): Cloudinary сам отдаёт WebP/AVIF/JPEG под браузер, расширение в пути сохраняется.
+    """
+    transform = (cfg.get("CLOUDINARY_DELIVERY_TRANSFORM") or "").strip()
+    if cfg.get("CLOUDINARY_FORMAT_MODE", "local") != "server" or not transform or not res.get("public_id"):
+        return res.get("secure_url")
+    url, _ = cloudinary.utils.cloudinary_url(
+        res["public_id"], resource_type=res.get("resource_type", "image"), type=res.get("type", "upload"),
+        version=res.get("version"), format=res.get("format"), secure=True, raw_transformation=transform,
+    )
+    return url
+
+def configure_cloudinary(cfg):
     cloudinary.config(
         cloud_name=cfg.get("CLOUDINARY_CLOUD_NAME"),
         api_key=cfg.get("CLOUDINARY_API_KEY"),
         api_secret=cfg.get("CLOUDINARY_API_SECRET"),
         secure=True,
     )
+
+def upload_image_cloudinary(image_path, cfg, retries=3, delay=4, checkpoint=None, content_hash=None):
+    configure_cloudinary(cfg)
+    breaker = BREAKERS["cloudinary"]
+    if breaker.blocked():
+        raise CircuitOpenError(breaker.name)
+    public_id = None
+    if cfg.get("CLOUDINARY_STABLE_IDS", True):
+        # id считается до подготовки: для JPEG она перезаписывает исходный файл
+        public_id = cloudinary_public_id(content_hash or file_sha1(image_path), cfg)
+        existing = cloudinary_existing(public_id)
+        if existing:
+            if cfg.get("VERBOSE_LOG", False):
+                lg(f"Уже есть в Cloudinary: {os.path.basename(image_path)} → {public_id}")
+            return cloudinary_delivery_url(existing, cfg)
+    if cfg.get("CLOUDINARY_FORMAT_MODE", "local") == "server":
+        # перекодирование делает Cloudinary при выдаче — загружаем исходные байты как есть
+        prepared = image_path
+    else:
+        with METRICS.span("prepare_image"):
+            prepared = prepare_image_for_upload(image_path, cfg)
+    if not prepared:
+        lg(f"Подготовка файла не удалась: {image_path}")
+        return None
+    if not image_file_ok(prepared, cfg):
+        lg(f"Файл не соответствует ограничениям: {os.path.basename(prepared)}")
+        return None
     last = None
+    chunked = None
+    threshold_mb = float(cfg.get("CLOUDINARY_CHUNKED_MB", 5) or 0)
+    if threshold_mb > 0 and os.path.getsize(prepared) >= threshold_mb * 1024 * 1024:
+        chunked = chunked_upload_state(prepared, cfg, checkpoint, public_id)
     for attempt in range(1, retries+1):
+        # при разомкнутом предохранителе оставшиеся попытки не тратим — товар уходит в ручную проверку
+        breaker.check()
         try:
             if cfg.get("VERBOSE_LOG", False):
                 lg(f"Загружаю {os.path.basename(prepared)} на Cloudinary (попытка {attempt})")
-            res = cloudinary.uploader.upload(prepared, folder="tg_import")
-            url = res.get("secure_url")
+            with METRICS.span("cloudinary_upload"):
+                if chunked:
+                    # повтор после сбоя досылает только недостающие части
+                    res = upload_large_resumable(prepared, chunked, checkpoint)
+                else:
+                    # с постоянным id повтор после таймаута или параллельная загрузка не создают дубль
+                    options = {"public_id": public_id, "overwrite": False} if public_id else {}
+                    res = cloudinary_call("upload", prepared, folder="tg_import", **options)
+            breaker.success()
+            url = cloudinary_delivery_url(res, cfg)
             if cfg.get("VERBOSE_LOG", False):
                 lg(f"Успешно загружено: {url}")
             if prepared.endswith(".converted.jpg") or prepared.endswith(".prepared.jpg"):
@@ -300,6 +1325,7 @@ def upload_image_cloudinary(image_path, cfg, retries=3, delay=4):
             return url
         except Exception as ex:
             last = ex
+            breaker.failure()
             lg(f"Ошибка загрузки {os.path.basename(prepared)}: {ex}")
             time.sleep(delay)
     lg(f"Не удалось загрузить {os.path.basename(image_path)} после {retries} попыток.")
@@ -308,32 +1334,291 @@ def upload_image_cloudinary(image_path, cfg, retries=3, delay=4):
 # -------------------------
 # WooCommerce helpers
 # -------------------------
-def get_all_products(wcapi):
+class WCResponse:
+    """Ответ AsyncWooCommerce в том же виде, что у requests: status_code, text, headers, json()."""
+    def __init__(self, status_code, text, headers):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers
+
+    def json(self):
+        return json.loads(self.text) if self.text else None
+
+class AsyncWooCommerce:
+    """
+    Асинхронный клиент WooCommerce REST API на aiohttp: одна сессия на прогон, пул keep-alive соединений.
+    Пути и авторизация как у woocommerce.API: Basic по https, подпись OAuth 1.0a (woocommerce.oauth) по http.
+    """
+    def __init__(self, url, consumer_key, consumer_secret, version="wc/v3", timeout=60, max_connections=8, verify_ssl=True):
+        import aiohttp
+        self.aiohttp = aiohttp
+        self.url = url.rstrip("/")
+        self.consumer_key = consumer_key
+        self.consumer_secret = consumer_secret
+        self.version = version
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.verify_ssl = verify_ssl
+        self.session = None
+
+    def _session(self):
+        # сессия создаётся лениво: она привязана к циклу событий, а он появляется только в SyncWorker._main
+        if self.session is None or self.session.closed:
+            connector = self.aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=60,
+                                                  ssl=None if self.verify_ssl else False)
+            self.session = self.aiohttp.ClientSession(
+                connector=connector,
+                timeout=self.aiohttp.ClientTimeout(total=self.timeout),
+                headers={"user-agent": "wc-tg-sync", "accept": "application/json"},
+            )
+        return self.session
+
+    async def request(self, method, endpoint, data=None, params=None):
+        url = f"{self.url}/wp-json/{self.version}/{endpoint}"
+        params = dict(params or {})
+        auth = None
+        if url.startswith("https"):
+            auth = self.aiohttp.BasicAuth(self.consumer_key, self.consumer_secret)
+        else:
+            from urllib.parse import urlencode
+            from woocommerce.oauth import OAuth
+            from yarl import URL
+            signed = OAuth(url=f"{url}?{urlencode(params)}", consumer_key=self.consumer_key,
+                           consumer_secret=self.consumer_secret, version=self.version, method=method,
+                           oauth_timestamp=int(time.time())).get_oauth_url()
+            url = URL(signed, encoded=True)  # подпись считалась по этой строке — не перекодируем
+            params = None
+        headers = {}
+        body = None
+        if data is not None:
+            body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+            headers["content-type"] = "application/json;charset=utf-8"
+        async with self._session().request(method, url, params=params, data=body, headers=headers, auth=auth) as resp:
+            text = await resp.text()
+            return WCResponse(resp.status, text, resp.headers)
+
+    async def get(self, endpoint, params=None):
+        return await self.request("GET", endpoint, params=params)
+
+    async def post(self, endpoint, data, params=None):
+        return await self.request("POST", endpoint, data, params)
+
+    async def put(self, endpoint, data, params=None):
+        return await self.request("PUT", endpoint, data, params)
+
+    async def delete(self, endpoint, params=None):
+        return await self.request("DELETE", endpoint, params=params)
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+
+def create_wc_client(cfg):
+    """Асинхронный клиент, если включён WC_ASYNC и установлен aiohttp; иначе синхронный woocommerce.API."""
+    if cfg.get("WC_ASYNC", True):
+        try:
+            return AsyncWooCommerce(
+                url=cfg.get("WC_URL"),
+                consumer_key=cfg.get("WC_KEY"),
+                consumer_secret=cfg.get("WC_SECRET"),
+                version="wc/v3",
+                timeout=60,
+                max_connections=int(cfg.get("WC_MAX_CONNECTIONS", 8)),
+            )
+        except ImportError:
+            lg("aiohttp не установлен — WooCommerce работает через синхронный клиент.")
+    api_class = wc_api_class()
+    if api_class is None:
+        lg("woocommerce библиотека не установлена; обновления на сайт не будут работать.")
+        return None
+    return api_class(
+        url=cfg.get("WC_URL").rstrip("/"),
+        consumer_key=cfg.get("WC_KEY"),
+        consumer_secret=cfg.get("WC_SECRET"),
+        version="wc/v3",
+        timeout=60
+    )
+
+def wc_body_sha1(data, redact=None):
+    """SHA-1 тела запроса WooCommerce; redact — то же сокрытие секретов, что в кассете."""
+    if data is None:
+        return None
+    text = json.dumps(data, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1((redact(text) if redact else text).encode("utf-8")).hexdigest()
+
+def record_wc_call(wcapi, method, endpoint, data, params, ms, res=None, error=None):
+    """
+    Запрос к WooCommerce в кассету. Ключ — магазин, метод, путь и параметры; тело запроса хранится
+    отдельно хешем: при воспроизведении расхождение тела — отличие в поведении, а не промах кассеты.
+    """
+    key = cassette_key("wc", getattr(wcapi, "url", ""), method.upper(), endpoint, params or {})
+    result = None
+    if res is not None:
+        headers = getattr(res, "headers", None) or {}
+        result = {"status": getattr(res, "status_code", None), "text": getattr(res, "text", ""),
+                  "headers": {h: headers[h] for h in ("X-WP-Total", "X-WP-TotalPages") if h in headers},
+                  "body_sha1": wc_body_sha1(data, RECORDER.redact)}
+    RECORDER.record("woocommerce", key, ms, result, error)
+
+async def wc_request(wcapi, method, endpoint, data=None, params=None):
+    """
+    Запрос к WooCommerce из цикла событий: асинхронный клиент напрямую, синхронный — в отдельном потоке.
+    Сетевые ошибки и ответы 5xx считаются предохранителем woocommerce; при разомкнутом — CircuitOpenError.
+    """
+    breaker = BREAKERS["woocommerce"]
+    breaker.check()
+    METRICS.call("woocommerce")
+    t0 = time.perf_counter()
+    try:
+        if isinstance(wcapi, AsyncWooCommerce):
+            res = await wcapi.request(method, endpoint, data, params)
+        else:
+            call = getattr(wcapi, method.lower())
+            if data is None:
+                res = await asyncio.to_thread(call, endpoint, params=params or {})
+            else:
+                res = await asyncio.to_thread(call, endpoint, data, params=params or {})
+    except Exception as e:
+        breaker.failure()
+        if RECORDER.active:
+            record_wc_call(wcapi, method, endpoint, data, params, (time.perf_counter() - t0) * 1000, error=e)
+        raise
+    if RECORDER.active:
+        record_wc_call(wcapi, method, endpoint, data, params, (time.perf_counter() - t0) * 1000, res)
+    if (getattr(res, "status_code", None) or 0) >= 500:
+        breaker.failure()
+    else:
+        breaker.success()
+    return res
+
+async def get_all_products(wcapi):
     out = []
-    page = 1
     per_page = 100
     if wcapi is None:
         lg("WC API не инициализирован — список товаров не получен.")
         return out
-    while True:
-        r = wcapi.get("products", params={"page": page, "per_page": per_page})
+
+    async def fetch_page(page):
+        with METRICS.span("wc_fetch_catalog"):
+            r = await wc_request(wcapi, "GET", "products", params={"page": page, "per_page": per_page})
         try:
             chunk = r.json()
         except Exception as e:
             lg(f"Ошибка парсинга ответа WC: {e}")
-            break
-        if not chunk or not isinstance(chunk, list):
-            break
+            return r, None
+        return r, chunk if isinstance(chunk, list) else None
+
+    r, chunk = await fetch_page(1)
+    if chunk:
         out.extend(chunk)
-        if len(chunk) < per_page:
-            break
-        page += 1
+    try:
+        total_pages = int((getattr(r, "headers", None) or {}).get("X-WP-TotalPages") or 0)
+    except Exception:
+        total_pages = 0
+    if chunk and total_pages > 1:
+        # число страниц известно — остальные запрашиваем параллельно (ограничено пулом соединений клиента)
+        for _, page_chunk in await asyncio.gather(*(fetch_page(p) for p in range(2, total_pages + 1))):
+            out.extend(page_chunk or [])
+    elif chunk and len(chunk) >= per_page:
+        page = 2
+        while True:
+            _, chunk = await fetch_page(page)
+            if not chunk:
+                break
+            out.extend(chunk)
+            if len(chunk) < per_page:
+                break
+            page += 1
     lg(f"Получено товаров: {len(out)}")
     return out
 
+async def get_products_by_ids(wcapi, ids, batch=100):
+    """Только указанные товары: products?include=... пачками по batch id, пачки запрашиваются параллельно."""
+    if wcapi is None:
+        lg("WC API не инициализирован — список товаров не получен.")
+        return []
+    ids = [str(i) for i in ids]
+
+    async def fetch(chunk):
+        with METRICS.span("wc_fetch_catalog"):
+            r = await wc_request(wcapi, "GET", "products",
+                                 params={"include": ",".join(chunk), "per_page": len(chunk), "orderby": "include"})
+        try:
+            data = r.json()
+        except Exception as e:
+            lg(f"Ошибка парсинга ответа WC: {e}")
+            return []
+        return data if isinstance(data, list) else []
+
+    out = []
+    for part in await asyncio.gather(*(fetch(ids[i:i + batch]) for i in range(0, len(ids), batch))):
+        out.extend(part)
+    lg(f"Получено товаров для повтора: {len(out)} из {len(ids)}")
+    return out
+
 def get_product_images_count(product):
     return len(product.get("images", []))
 
+# Причины, после которых товар считается «не получившимся» (для PRODUCT_PRIORITY=previously_failed)
+FAILURE_REASONS = {"not_found", "update_failed", "exception", "missing_comment_group", "circuit_open"}
+
+def remember_outcome(updated_dict, result, path):
+    """Помечает в updated_dict неудачный товар (ключ failed) и снимает пометку после успешного обновления."""
+    pid = str(result.get("product_id"))
+    entry = updated_dict.get(pid)
+    if result.get("updated"):
+        if entry and entry.pop("failed", None) is not None:
+            save_updated_products(updated_dict, path)
+    elif result.get("error") or result.get("review_reason") in FAILURE_REASONS:
+        entry = updated_dict.setdefault(pid, {})
+        entry["failed"] = {"reason": result.get("review_reason") or "error", "ts": timestamp()}
+        save_updated_products(updated_dict, path)
+
+async def load_catalog(wcapi, cfg):
+    """Каталог на прогон: весь или, в режиме повтора, только товары с пометкой failed."""
+    if not cfg.get("RETRY_FAILED_ONLY"):
+        return await get_all_products(wcapi)
+    reasons = {r.strip() for r in str(cfg.get("RETRY_REASONS", "") or "").split(",") if r.strip()}
+    retry_ids = failed_product_ids(load_updated_products(cfg.get("UPDATED_FILE","updated_products.json")), reasons)
+    ulog(f"Повтор неудачных товаров{' (причины: ' + ', '.join(sorted(reasons)) + ')' if reasons else ''}: {len(retry_ids)}.")
+    return await get_products_by_ids(wcapi, retry_ids) if retry_ids else []
+
+def failed_product_ids(updated_dict, reasons=None):
+    """id товаров с пометкой failed (см. remember_outcome); reasons — оставить только эти причины."""
+    return [pid for pid, entry in updated_dict.items()
+            if isinstance(entry, dict) and entry.get("failed")
+            and (not reasons or entry["failed"].get("reason") in reasons)]
+
+def _modified_ts(product):
+    value = product.get("date_modified_gmt") or product.get("date_modified") or ""
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except Exception:
+        return 0.0
+
+# Ключи сортировки очереди товаров: меньшее значение — раньше в очереди
+PRIORITY_KEYS = {
+    "no_images": lambda p, prev: 0 if get_product_images_count(p) == 0 else 1,
+    "recently_modified": lambda p, prev: -_modified_ts(p),
+    "best_selling": lambda p, prev: -int(p.get("total_sales") or 0),
+    "previously_failed": lambda p, prev: 0 if prev.get("failed") else 1,
+}
+
+def order_products(products, cfg, updated_dict):
+    """
+    Упорядочивает товары по ключам PRODUCT_PRIORITY (через запятую, по убыванию важности).
+    Сортировка устойчивая: при равных ключах сохраняется порядок, в котором товары отдал /products.
+    """
+    keys = []
+    for name in [k.strip() for k in str(cfg.get("PRODUCT_PRIORITY", "") or "").split(",") if k.strip()]:
+        if name in PRIORITY_KEYS:
+            keys.append(PRIORITY_KEYS[name])
+        else:
+            lg(f"Неизвестный ключ приоритета '{name}' — пропущен.")
+    if not keys:
+        return list(products)
+    return sorted(products, key=lambda p: tuple(k(p, updated_dict.get(str(p.get("id")), {})) for k in keys))
+
 def load_updated_products(path):
     if os.path.exists(path):
         try:
@@ -350,16 +1635,762 @@ def save_updated_products(dct, path):
     with open(path, "w", encoding="utf-8") as f:
         json.dump(dct, f, ensure_ascii=False, indent=2)
 
+class MediaMap:
+    """
+    Постоянные соответствия для повторного использования фото:
+      - by_hash: хэш скачанного из Telegram файла → Cloudinary URL (повторная загрузка в Cloudinary не нужна);
+      - by_url: Cloudinary URL → id вложения в медиатеке WordPress (заполняется из ответов PUT products/<id>).
+    Фото с известным id отправляются как {"id": ...}: WordPress не скачивает картинку заново и не режет миниатюры.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.by_url = {}
+        self.by_hash = {}
+        if os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                self.by_url = dict(data.get("by_url", {}))
+                self.by_hash = dict(data.get("by_hash", {}))
+            except Exception as e:
+                lg(f"Не удалось прочитать {path}: {e}")
+
+    def url_for_hash(self, file_hash):
+        with self.lock:
+            return self.by_hash.get(file_hash)
+
+    def media_id(self, url):
+        with self.lock:
+            return self.by_url.get(url)
+
+    def remember(self, url, media_id=None, file_hash=None):
+        with self.lock:
+            if media_id:
+                self.by_url[url] = media_id
+            if file_hash:
+                self.by_hash[file_hash] = url
+
+    def forget(self, media_ids):
+        media_ids = set(media_ids)
+        with self.lock:
+            self.by_url = {k: v for k, v in self.by_url.items() if v not in media_ids}
+
+    def images_payload(self, urls):
+        return [{"id": mid} if mid else {"src": u} for u, mid in ((u, self.media_id(u)) for u in urls)]
+
+    def remember_from_response(self, urls, res):
+        """Сопоставляет отправленные URL с картинками в ответе WooCommerce (порядок совпадает)."""
+        try:
+            images = (res.json() or {}).get("images") or []
+        except Exception:
+            return
+        for url, img in zip(urls, images):
+            if isinstance(img, dict) and img.get("id"):
+                self.remember(url, media_id=img["id"])
+
+    def save(self):
+        with self.lock:
+            data = {"by_url": self.by_url, "by_hash": self.by_hash}
+            tmp = self.path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp, self.path)
+
+# -------------------------
+# Checkpoints (resume after crash)
+# -------------------------
+CHECKPOINT_STAGES = ("message_found", "photos_downloaded", "uploaded", "wc_pending")
+
+class CheckpointStore:
+    """
+    Контрольные точки для продолжения после падения:
+      - run: подпись настроек прогона и id уже обработанных товаров (пропускаются при перезапуске);
+      - products: этап каждого незавершённого товара (найден пост, скачаны фото, загруженные URL, ожидает записи в WC).
+    Файл перезаписывается атомарно (tmp + os.replace) после каждого изменения.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.data = self._load()
+
+    def _load(self):
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                if isinstance(data, dict):
+                    data.setdefault("run", None)
+                    data.setdefault("products", {})
+                    return data
+            except Exception as e:
+                lg(f"Контрольная точка повреждена, начинаем заново: {e}")
+        return {"run": None, "products": {}}
+
+    def _save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.data, f, ensure_ascii=False)
+        os.replace(tmp, self.path)
+
+    def start_run(self, signature):
+        """
+        Возвращает множество id, уже обработанных незавершённым прогоном с теми же настройками.
+        С другими настройками точки товаров прошлого прогона не годятся (собраны не те данные) и удаляются.
+        """
+        with self.lock:
+            run = self.data.get("run")
+            if run and not run.get("finished") and run.get("signature") == signature:
+                done = set(run.get("done", []))
+            else:
+                if run and run.get("signature") != signature:
+                    self.data["products"] = {}
+                self.data["run"] = {"signature": signature, "started": timestamp(), "finished": False, "done": []}
+                done = set()
+            self._save()
+            return done
+
+    def mark_done(self, product_id):
+        with self.lock:
+            run = self.data.get("run")
+            if run is not None:
+                run["done"].append(str(product_id))
+                self._save()
+
+    def finish_run(self):
+        with self.lock:
+            run = self.data.get("run")
+            if run is not None:
+                run["finished"] = True
+                run["done"] = []
+                self._save()
+
+    def get(self, product_id):
+        with self.lock:
+            entry = self.data["products"].get(str(product_id))
+            return json.loads(json.dumps(entry)) if entry else {}
+
+    def update(self, product_id, **fields):
+        with self.lock:
+            entry = self.data["products"].setdefault(str(product_id), {})
+            entry.update(fields)
+            entry["ts"] = timestamp()
+            self._save()
+
+    def add_upload(self, product_id, name, url):
+        with self.lock:
+            entry = self.data["products"].setdefault(str(product_id), {})
+            entry.setdefault("uploaded", {})[name] = url
+            entry["ts"] = timestamp()
+            self._save()
+
+    def set_chunked(self, product_id, name, state):
+        with self.lock:
+            entry = self.data["products"].setdefault(str(product_id), {})
+            chunked = entry.setdefault("chunked", {})
+            if state is None:
+                chunked.pop(name, None)
+            else:
+                chunked[name] = dict(state)
+            entry["ts"] = timestamp()
+            self._save()
+
+    def clear(self, product_id):
+        with self.lock:
+            if self.data["products"].pop(str(product_id), None) is not None:
+                self._save()
+
+    def product(self, product_id):
+        return ProductCheckpoint(self, product_id)
+
+class ProductCheckpoint:
+    """Контрольная точка одного товара (тонкая обёртка над CheckpointStore)."""
+    def __init__(self, store, product_id):
+        self.store = store
+        self.product_id = str(product_id)
+
+    def get(self):
+        return self.store.get(self.product_id)
+
+    def update(self, **fields):
+        self.store.update(self.product_id, **fields)
+
+    def add_upload(self, name, url):
+        self.store.add_upload(self.product_id, name, url)
+
+    def set_chunked(self, name, state):
+        self.store.set_chunked(self.product_id, name, state)
+
+    def clear(self):
+        self.store.clear(self.product_id)
+
+def run_signature(cfg):
+    keys = ("UPDATE_STRATEGY", "UPDATE_WHAT", "OPERATION_MODE", "PHOTO_SOURCE_MODE", "PHOTO_SOURCE_FORCED")
+    signature = "|".join(str(cfg.get(k, "")) for k in keys)
+    if cfg.get("WC_SHOPS"):
+        # в режиме нескольких магазинов контрольная точка отмечает артикулы, а не id товаров
+        signature += "|shops:" + ",".join(str(s.get("name") or s.get("WC_URL")) for s in cfg["WC_SHOPS"])
+    # повтор неудачных — отдельный прогон: его контрольная точка не смешивается с полным проходом
+    return signature + "|retry" if cfg.get("RETRY_FAILED_ONLY") else signature
+
+def checkpoint_resumable(cp, want_desc, want_photo):
+    """
+    Можно ли продолжить товар без Telegram: описание сохранено, фото собирались (want_photo точки),
+    а каждое фото либо на диске, либо уже загружено.
+    """
+    if cp.get("stage") not in CHECKPOINT_STAGES[1:]:
+        return False
+    if want_desc and not cp.get("has_desc"):
+        return False
+    if want_photo and not cp.get("want_photo"):
+        # точка прогона «только описание»: photos=[] значит «не искали», а не «фото нет»
+        return False
+    if want_photo:
+        uploaded = cp.get("uploaded", {})
+        for p in cp.get("photos", []):
+            if os.path.basename(p) not in uploaded and not os.path.exists(p):
+                return False
+    return True
+
 # -------------------------
 # Telegram helpers
 # -------------------------
+def create_telegram_client(cfg, session="user_session"):
+    """Создаёт клиент Telethon для сессии (бенчмарки подменяют эту функцию заглушкой)."""
+    return telethon.TelegramClient(session, int(cfg.get("TG_API_ID")), cfg.get("TG_API_HASH"))
+
+async def resolve_entities(client, cfg, errors=None):
+    """
+    Возвращает {"main": сущность TG_CHANNEL_ID или None, "comments": сущность COMMENT_GROUP_ID или None}.
+    Ошибка получения заданного в настройках чата записывается в errors (словарь "main"/"comments" → исключение),
+    если он передан: вызывающий сам решает, важен ли этот чат в текущем режиме.
+    """
+    entities = {"main": None, "comments": None}
+    for name, key in (("main", "TG_CHANNEL_ID"), ("comments", "COMMENT_GROUP_ID")):
+        if cfg.get(key):
+            try:
+                entities[name] = await client.get_entity(cfg.get(key))
+            except Exception as e:
+                if errors is not None:
+                    errors[name] = e
+                entities[name] = None
+    return entities
+
+def note_error(errors, e):
+    """Запоминает проглоченную ошибку Telegram в errors (если список передан) — её учтёт предохранитель."""
+    if errors is not None:
+        errors.append(e)
+
+class SkuMessageCache:
+    """
+    Постоянный кэш: нормализованный артикул → чат, id основного поста (и grouped_id).
+    Перед прогоном записи пакетно сверяются через client.get_messages(entity, ids=[...]) по 100 id за запрос;
+    удалённые и отредактированные с момента записи посты выбрасываются и ищутся заново обычным поиском.
+    """
+    BATCH = 100
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.live = {}  # сверенные в этом прогоне сообщения: артикул → (msg, source)
+        self.dirty = 0
+        if os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    self.entries = dict(json.load(f))
+            except Exception as e:
+                lg(f"Не удалось прочитать {path}: {e}")
+
+    @staticmethod
+    def key(article):
+        return (article or "").strip().upper()
+
+    @staticmethod
+    def _fingerprint(msg):
+        edit = getattr(msg, "edit_date", None)
+        return (hashlib.sha1((msg.text or "").encode("utf-8")).hexdigest(),
+                edit.isoformat() if hasattr(edit, "isoformat") else (str(edit) if edit else None))
+
+    def _still_valid(self, entry, msg):
+        if msg is None:
+            return False
+        text_sha1, edit_date = self._fingerprint(msg)
+        return text_sha1 == entry.get("text_sha1") and edit_date == entry.get("edit_date")
+
+    async def validate(self, client, entities, articles):
+        """Сверяет записи для артикулов каталога. Возвращает (актуальных, выброшено)."""
+        wanted = {self.key(a) for a in articles if a}
+        by_source = {}
+        for k, entry in list(self.entries.items()):
+            if k in wanted:
+                by_source.setdefault(entry.get("source"), []).append(k)
+        valid = dropped = 0
+        for source, keys in by_source.items():
+            entity = entities.get(source)
+            if entity is None:
+                continue
+            for i in range(0, len(keys), self.BATCH):
+                chunk = keys[i:i + self.BATCH]
+                try:
+                    msgs = await client.get_messages(entity, ids=[self.entries[k]["msg_id"] for k in chunk])
+                except Exception as e:
+                    lg(f"Сверка кэша артикулов не удалась: {e}")
+                    return valid, dropped
+                for k, msg in zip(chunk, msgs):
+                    if self._still_valid(self.entries[k], msg):
+                        self.live[k] = (msg, source)
+                        valid += 1
+                    else:
+                        self.drop(k)
+                        dropped += 1
+        return valid, dropped
+
+    async def get(self, client, article, entities, sources):
+        """Сообщение из кэша для артикула (source из sources) или None."""
+        k = self.key(article)
+        if k in self.live and self.live[k][1] in sources:
+            return self.live[k]
+        entry = self.entries.get(k)
+        if not entry or entry.get("source") not in sources or entities.get(entry.get("source")) is None:
+            return None
+        try:
+            msg = await client.get_messages(entities[entry["source"]], ids=entry["msg_id"])
+        except Exception:
+            return None
+        if not self._still_valid(entry, msg):
+            self.drop(k)
+            return None
+        self.live[k] = (msg, entry["source"])
+        return self.live[k]
+
+    def store(self, article, msg, source, entity):
+        text_sha1, edit_date = self._fingerprint(msg)
+        with self.lock:
+            k = self.key(article)
+            self.entries[k] = {
+                "chat": getattr(entity, "id", None),
+                "source": source,
+                "msg_id": msg.id,
+                "grouped_id": getattr(msg, "grouped_id", None),
+                "text_sha1": text_sha1,
+                "edit_date": edit_date,
+            }
+            self.live[k] = (msg, source)
+            self.dirty += 1
+        if self.dirty >= 50:
+            self.save()
+
+    def drop(self, k):
+        with self.lock:
+            if self.entries.pop(k, None) is not None:
+                self.dirty += 1
+            self.live.pop(k, None)
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            tmp = self.path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(self.entries, f, ensure_ascii=False)
+            os.replace(tmp, self.path)
+            self.dirty = 0
+
+class CountingTelegramClient:
+    """Обёртка над клиентом Telethon: отмечает запросы в METRICS (скорость Telegram в панели хода)."""
+    PAGE = 100  # iter_messages забирает сообщения страницами по 100
+
+    def __init__(self, client):
+        self.client = client
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    async def get_entity(self, *args, **kwargs):
+        METRICS.call("telegram")
+        return await self.client.get_entity(*args, **kwargs)
+
+    async def get_messages(self, *args, **kwargs):
+        METRICS.call("telegram")
+        return await self.client.get_messages(*args, **kwargs)
+
+    async def download_media(self, *args, **kwargs):
+        METRICS.call("telegram")
+        return await self.client.download_media(*args, **kwargs)
+
+    async def iter_messages(self, *args, **kwargs):
+        source = self.client.iter_messages(*args, **kwargs)
+        n = 0
+        try:
+            async for m in source:
+                if n % self.PAGE == 0:
+                    METRICS.call("telegram")
+                n += 1
+                yield m
+        finally:
+            if hasattr(source, "aclose"):
+                await source.aclose()
+
+    @contextlib.asynccontextmanager
+    async def takeout(self, *args, **kwargs):
+        async with self.client.takeout(*args, **kwargs) as takeout:
+            yield CountingTelegramClient(takeout)
+
+def entity_key(entity):
+    """Стабильный ключ чата для локальных хранилищ (peer id с префиксом -100 для каналов)."""
+    try:
+        return telethon.utils.get_peer_id(entity)
+    except Exception:
+        return getattr(entity, "id", entity)
+
+class StoredPhoto:
+    __slots__ = ("id", "chat_id", "msg_id")
+    def __init__(self, photo_id, chat_id, msg_id):
+        self.id = photo_id
+        self.chat_id = chat_id
+        self.msg_id = msg_id
+
+class StoredMessage:
+    """Сообщение из локальной истории: те же поля, что читают коллекторы, без обращения к Telegram."""
+    __slots__ = ("chat_id", "id", "text", "grouped_id", "reply_to_msg_id", "photo", "date", "edit_date")
+    def __init__(self, chat_id, msg_id, text, grouped_id, reply_to, photo_id, date, edit_date):
+        self.chat_id = chat_id
+        self.id = msg_id
+        self.text = text or ""
+        self.grouped_id = grouped_id
+        self.reply_to_msg_id = reply_to
+        self.photo = StoredPhoto(photo_id, chat_id, msg_id) if photo_id else None
+        self.date = date
+        self.edit_date = edit_date
+
+    @property
+    def message(self):
+        return self.text
+
+    @property
+    def media(self):
+        return self.photo
+
+class HistoryStore:
+    """Локальная копия истории чатов (sqlite): заполняется выгрузкой через takeout, читается офлайн."""
+    def __init__(self, path):
+        import sqlite3
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS messages (
+                chat_id INTEGER NOT NULL,
+                id INTEGER NOT NULL,
+                text TEXT,
+                grouped_id INTEGER,
+                reply_to INTEGER,
+                photo_id INTEGER,
+                date TEXT,
+                edit_date TEXT,
+                PRIMARY KEY (chat_id, id)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS crawl_state (
+                chat_id INTEGER PRIMARY KEY,
+                last_id INTEGER NOT NULL,
+                crawled_at TEXT
+            );
+            CREATE TABLE IF NOT EXISTS sku_matches (
+                chat_id INTEGER NOT NULL,
+                article TEXT NOT NULL,
+                msg_id INTEGER,
+                PRIMARY KEY (chat_id, article)
+            ) WITHOUT ROWID;
+        """)
+
+    @staticmethod
+    def _iso(value):
+        return value.isoformat() if hasattr(value, "isoformat") else (str(value) if value else None)
+
+    def last_id(self, chat_id):
+        row = self.conn.execute("SELECT last_id FROM crawl_state WHERE chat_id=?", (chat_id,)).fetchone()
+        return row[0] if row else 0
+
+    def add_many(self, chat_id, msgs):
+        rows = []
+        for m in msgs:
+            photo = getattr(m, "photo", None)
+            rows.append((chat_id, m.id, m.text or "", getattr(m, "grouped_id", None),
+                         getattr(m, "reply_to_msg_id", None), getattr(photo, "id", None) if photo else None,
+                         self._iso(getattr(m, "date", None)), self._iso(getattr(m, "edit_date", None))))
+        self.conn.executemany("INSERT OR REPLACE INTO messages VALUES (?,?,?,?,?,?,?,?)", rows)
+
+    def set_last_id(self, chat_id, last_id):
+        self.conn.execute("INSERT OR REPLACE INTO crawl_state VALUES (?,?,?)", (chat_id, last_id, timestamp()))
+        self.conn.commit()
+
+    def count(self, chat_id):
+        return self.conn.execute("SELECT COUNT(*) FROM messages WHERE chat_id=?", (chat_id,)).fetchone()[0]
+
+    def _rows(self, sql, params):
+        for row in self.conn.execute(sql, params):
+            yield StoredMessage(*row)
+
+    def iter_texts(self, chat_id):
+        """(id, text) всех сообщений чата с текстом, от новых к старым."""
+        return self.conn.execute("SELECT id, text FROM messages WHERE chat_id=? AND text<>'' ORDER BY id DESC", (chat_id,))
+
+    def set_sku_matches(self, chat_id, matches):
+        """Заменяет карту артикул → id основного поста для чата (None — в истории поста нет)."""
+        self.conn.execute("DELETE FROM sku_matches WHERE chat_id=?", (chat_id,))
+        self.conn.executemany("INSERT INTO sku_matches VALUES (?,?,?)",
+                              [(chat_id, article, msg_id) for article, msg_id in matches.items()])
+        self.conn.commit()
+
+    def sku_match(self, chat_id, article):
+        """(True, msg_id или None), если артикул есть в карте; (False, None) — карта о нём не знает."""
+        row = self.conn.execute("SELECT msg_id FROM sku_matches WHERE chat_id=? AND article=?", (chat_id, article)).fetchone()
+        return (True, row[0]) if row else (False, None)
+
+    def get(self, chat_id, ids):
+        found = {m.id: m for m in self._rows(
+            f"SELECT * FROM messages WHERE chat_id=? AND id IN ({','.join('?' * len(ids))})", (chat_id, *ids))}
+        return [found.get(i) for i in ids]
+
+    def iter_range(self, chat_id, min_id=0, max_id=0, reverse=False, limit=None, search=None):
+        sql = "SELECT * FROM messages WHERE chat_id=? AND id>?"
+        params = [chat_id, min_id or 0]
+        if max_id:
+            sql += " AND id<?"
+            params.append(max_id)
+        if search:
+            sql += " AND text LIKE ?"
+            params.append(f"%{search}%")
+        sql += " ORDER BY id " + ("ASC" if reverse else "DESC")
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(int(limit))
+        return self._rows(sql, params)
+
+    def close(self):
+        try:
+            self.conn.close()
+        except Exception:
+            pass
+
+async def crawl_history(client, cfg, store, page_log=10000):
+    """
+    Выгружает историю TG_CHANNEL_ID и COMMENT_GROUP_ID в store через takeout-сессию (ослабленные лимиты).
+    Повторная выгрузка докачивает только новые сообщения (после последнего сохранённого id).
+    Если Telegram просит подтвердить экспорт (TakeoutInitDelayError), качаем обычной сессией.
+    """
+    entities = [e for e in (await resolve_entities(client, cfg)).values() if e is not None]
+    if not entities:
+        return 0
+
+    async def crawl(source):
+        total = 0
+        for entity in entities:
+            chat_id = entity_key(entity)
+            last_id = store.last_id(chat_id)
+            batch = []
+            newest = last_id
+            async for m in source.iter_messages(entity, min_id=last_id, reverse=True, wait_time=0):
+                batch.append(m)
+                newest = max(newest, m.id)
+                if len(batch) >= 1000:
+                    store.add_many(chat_id, batch)
+                    store.set_last_id(chat_id, newest)
+                    total += len(batch)
+                    batch = []
+                    if total % page_log == 0:
+                        ulog(f"  История: выгружено {total} сообщений...")
+            if batch:
+                store.add_many(chat_id, batch)
+                total += len(batch)
+            store.set_last_id(chat_id, newest)
+        return total
+
+    try:
+        delay_error = telethon.errors.TakeoutInitDelayError
+    except Exception:
+        delay_error = ()
+    try:
+        async with client.takeout(finalize=True, channels=True, megagroups=True) as takeout:
+            return await crawl(takeout)
+    except delay_error as e:
+        lg(f"Telegram просит подтвердить экспорт данных (повтор через {getattr(e, 'seconds', '?')}s) — выгружаем обычной сессией.")
+        return await crawl(client)
+
+class OfflineHistoryClient:
+    """
+    Обёртка над клиентом Telethon: iter_messages/get_messages читаются из HistoryStore,
+    в Telegram уходят только get_entity и скачивание медиа. Для скачивания настоящие сообщения
+    подгружаются пачкой: запрошенное фото плюс соседние фото из уже выданной выборки (до 100 за запрос).
+    """
+    BATCH = 100
+
+    def __init__(self, client, store):
+        self.client = client
+        self.store = store
+        self._entities = {}
+        self._pending = {}
+        self._real = {}
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    async def get_entity(self, entity):
+        ent = await self.client.get_entity(entity)
+        self._entities[entity_key(ent)] = ent
+        return ent
+
+    async def iter_messages(self, entity, limit=None, *, search=None, min_id=0, max_id=0, reverse=False, ids=None, **kwargs):
+        chat_id = entity_key(entity)
+        self._entities.setdefault(chat_id, entity)
+        if ids is not None:
+            msgs = [m for m in self.store.get(chat_id, [ids] if isinstance(ids, int) else list(ids)) if m]
+        else:
+            msgs = self.store.iter_range(chat_id, min_id, max_id, reverse, limit, search)
+        pending = self._pending.setdefault(chat_id, set())
+        for m in msgs:
+            if m.photo:
+                pending.add(m.id)
+            yield m
+
+    def indexed_main_message(self, entity, article):
+        """Основной пост по карте артикулов (build_sku_index): (True, сообщение или None) либо (False, None)."""
+        chat_id = entity_key(entity)
+        hit, msg_id = self.store.sku_match(chat_id, SkuMessageCache.key(article))
+        if not hit or msg_id is None:
+            return hit, None
+        msg = self.store.get(chat_id, [msg_id])[0]
+        if msg is not None and msg.photo:
+            self._pending.setdefault(chat_id, set()).add(msg.id)
+        return True, msg
+
+    async def get_messages(self, entity, *args, ids=None, **kwargs):
+        chat_id = entity_key(entity)
+        if ids is None:
+            return [m async for m in self.iter_messages(entity, *args, **kwargs)]
+        if isinstance(ids, int):
+            return self.store.get(chat_id, [ids])[0]
+        return self.store.get(chat_id, list(ids))
+
+    async def download_media(self, message, *args, **kwargs):
+        if isinstance(message, StoredMessage):
+            chat_id, msg_id = message.chat_id, message.id
+        elif isinstance(message, StoredPhoto):
+            chat_id, msg_id = message.chat_id, message.msg_id
+        else:
+            return await self.client.download_media(message, *args, **kwargs)
+        real = self._real.get((chat_id, msg_id))
+        if real is None:
+            pending = self._pending.get(chat_id, set())
+            near = sorted(pending - {msg_id}, key=lambda i: abs(i - msg_id))[:self.BATCH - 1]
+            wanted = [msg_id] + near
+            entity = self._entities.get(chat_id) or chat_id
+            fetched = await self.client.get_messages(entity, ids=wanted)
+            if len(self._real) > 5000:
+                self._real.clear()
+            for wanted_id, msg in zip(wanted, fetched):
+                pending.discard(wanted_id)
+                if msg is not None:
+                    self._real[(chat_id, wanted_id)] = msg
+            real = self._real.get((chat_id, msg_id))
+            if real is None:
+                return None
+        return await self.client.download_media(real.media or real.photo, *args, **kwargs)
+
+class SkuMatcher:
+    """
+    Автомат Ахо — Корасик по всем артикулам каталога: один проход по тексту находит все артикулы,
+    стоящие в нём отдельным словом (как \\b...\\b в find_main_message, без учёта регистра).
+    """
+    def __init__(self, articles):
+        self.keys = sorted({SkuMessageCache.key(a) for a in articles if a and a.strip()})
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [()]
+        for k in self.keys:
+            node = 0
+            for ch in k:
+                nxt = self.goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[node][ch] = nxt
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append(())
+                node = nxt
+            self.out[node] = self.out[node] + (k,)
+        # суффиксные ссылки — обходом в ширину; выходы наследуются от узла-ссылки
+        queue = list(self.goto[0].values())
+        for node in queue:
+            for ch, nxt in self.goto[node].items():
+                f = self.fail[node]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                target = self.goto[f].get(ch, 0)
+                self.fail[nxt] = target if target != nxt else 0
+                self.out[nxt] = self.out[nxt] + self.out[self.fail[nxt]]
+                queue.append(nxt)
+
+    @staticmethod
+    def _word(ch):
+        return ch.isalnum() or ch == "_"
+
+    def _boundary(self, text, i):
+        before = i > 0 and self._word(text[i - 1])
+        after = i < len(text) and self._word(text[i])
+        return before != after
+
+    def scan(self, text):
+        """Множество артикулов, найденных в тексте отдельным словом."""
+        text = (text or "").upper()
+        found = set()
+        goto, fail, out = self.goto, self.fail, self.out
+        node = 0
+        for i, ch in enumerate(text):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            for k in out[node]:
+                start = i + 1 - len(k)
+                if k not in found and self._boundary(text, start) and self._boundary(text, i + 1):
+                    found.add(k)
+        return found
+
+def build_sku_index(store, chat_ids, articles):
+    """
+    Карта артикул → основной пост по всей выгруженной истории за один проход по текстам.
+    Из нескольких постов с артикулом берётся самый длинный текст (при равной длине — более новый),
+    как в find_main_message. Результат пишется в store (sku_matches). Возвращает число найденных артикулов.
+    """
+    matcher = SkuMatcher(articles)
+    if not matcher.keys:
+        return 0
+    found = 0
+    for chat_id in chat_ids:
+        best = {}
+        for msg_id, text in store.iter_texts(chat_id):
+            for k in matcher.scan(text):
+                if k not in best or len(text) > best[k][1]:
+                    best[k] = (msg_id, len(text))
+        store.set_sku_matches(chat_id, {k: (best[k][0] if k in best else None) for k in matcher.keys})
+        found += len(best)
+    return found
+
 async def find_main_message(client, group_entity, site_article, limit=1000):
     if not site_article:
         return None
+    indexed = getattr(client, "indexed_main_message", None)
+    if indexed is not None:
+        hit, msg = indexed(group_entity, site_article)
+        if hit:
+            return msg
     candidates = []
-    async for msg in client.iter_messages(group_entity, search=site_article, limit=limit):
-        if re.search(rf'\b{re.escape(site_article)}\b', msg.text or "", re.IGNORECASE):
-            candidates.append(msg)
+    with METRICS.span("find_main_message"):
+        async for msg in client.iter_messages(group_entity, search=site_article, limit=limit):
+            if re.search(rf'\b{re.escape(site_article)}\b', msg.text or "", re.IGNORECASE):
+                candidates.append(msg)
     if candidates:
         chosen = max(candidates, key=lambda m: len(m.text or ""))
         return chosen
@@ -373,155 +2404,372 @@ async def collect_photos_from_media_group(client, group_entity, grouped_id, max_
         break
     return photos
 
-async def collect_photos_combined(client, group_entity, main_msg, max_photos=9, position="after"):
+async def iter_photos_combined(client, group_entity, main_msg, errors=None):
     """
-    Собирает фотографии в порядке приоритета:
+    Кандидаты в фото товара (имя файла, сообщение) в порядке приоритета:
       1) Ответы (reply_to_msg_id == main_msg.id) с фото
       2) Фото из основного сообщения (media group или одиночное)
       3) Доп. фото, идущие сразу после основного поста (без текста), пока не встретится текст
-    Возвращает список локальных путей до скачанных файлов (до max_photos).
+    Сообщения читаются лениво: перебор останавливается, когда потребитель набрал нужное количество.
     """
-    photos = []
     seen_msg_ids = set()
 
     # 1) Собираем ответы (replies) к main_msg
     try:
-        async for m in client.iter_messages(group_entity, min_id=main_msg.id+1, max_id=main_msg.id+800):
-            if getattr(m, "reply_to_msg_id", None) == main_msg.id and getattr(m, "photo", None):
-                fname = os.path.join(DOWNLOAD_DIR, f"reply_{main_msg.id}_{m.id}.jpg")
-                try:
-                    await client.download_media(m.media or m.photo, file=fname)
-                    photos.append(fname)
+        with METRICS.span("scan_replies"):
+            async for m in client.iter_messages(group_entity, min_id=main_msg.id+1, max_id=main_msg.id+800):
+                if getattr(m, "reply_to_msg_id", None) == main_msg.id and getattr(m, "photo", None):
                     seen_msg_ids.add(m.id)
-                except Exception:
-                    pass
-                if len(photos) >= max_photos:
-                    return photos
-    except Exception:
+                    yield os.path.join(DOWNLOAD_DIR, f"reply_{main_msg.id}_{m.id}.jpg"), m
+    except Exception as e:
         # перебор мог упасть по таймауту — продолжаем дальше
-        pass
+        note_error(errors, e)
 
     # 2) Фото из основного сообщения (media group или одиночное)
     try:
         if getattr(main_msg, "grouped_id", None):
             gid = main_msg.grouped_id
             msgs = []
-            async for m in client.iter_messages(group_entity, min_id=main_msg.id-50, max_id=main_msg.id+50):
-                if getattr(m, "grouped_id", None) == gid and getattr(m, "photo", None):
-                    msgs.append(m)
+            with METRICS.span("scan_main_group"):
+                async for m in client.iter_messages(group_entity, min_id=main_msg.id-50, max_id=main_msg.id+50):
+                    if getattr(m, "grouped_id", None) == gid and getattr(m, "photo", None):
+                        msgs.append(m)
             msgs = sorted(msgs, key=lambda x: x.id)
             for m in msgs:
                 if m.id in seen_msg_ids:
                     continue
-                fname = os.path.join(DOWNLOAD_DIR, f"maingroup_{gid}_{m.id}.jpg")
-                try:
-                    await client.download_media(m.media or m.photo, file=fname)
-                    photos.append(fname)
-                    seen_msg_ids.add(m.id)
-                except Exception:
-                    pass
-                if len(photos) >= max_photos:
-                    return photos
+                seen_msg_ids.add(m.id)
+                yield os.path.join(DOWNLOAD_DIR, f"maingroup_{gid}_{m.id}.jpg"), m
         else:
-            if getattr(main_msg, "photo", None):
-                if main_msg.id not in seen_msg_ids:
-                    fname = os.path.join(DOWNLOAD_DIR, f"main_{main_msg.id}.jpg")
-                    try:
-                        await client.download_media(main_msg.media or main_msg.photo, file=fname)
-                        photos.append(fname)
-                        seen_msg_ids.add(main_msg.id)
-                    except Exception:
-                        pass
-                    if len(photos) >= max_photos:
-                        return photos
-    except Exception:
-        pass
+            if getattr(main_msg, "photo", None) and main_msg.id not in seen_msg_ids:
+                seen_msg_ids.add(main_msg.id)
+                yield os.path.join(DOWNLOAD_DIR, f"main_{main_msg.id}.jpg"), main_msg
+    except Exception as e:
+        note_error(errors, e)
 
     # 3) Фото, идущие сразу после основного поста (без текста) — собираем подряд до первого текстового сообщения
     try:
-        async for m in client.iter_messages(group_entity, min_id=main_msg.id+1, max_id=main_msg.id+400):
-            if m.text and m.text.strip():
-                # встречен текст — считаем, что серия доп. фото закончилась
-                break
-            if getattr(m, "photo", None) and m.id not in seen_msg_ids:
-                fname = os.path.join(DOWNLOAD_DIR, f"after_{main_msg.id}_{m.id}.jpg")
-                try:
-                    await client.download_media(m.media or m.photo, file=fname)
-                    photos.append(fname)
+        with METRICS.span("scan_after"):
+            async for m in client.iter_messages(group_entity, min_id=main_msg.id+1, max_id=main_msg.id+400):
+                if m.text and m.text.strip():
+                    # встречен текст — считаем, что серия доп. фото закончилась
+                    break
+                if getattr(m, "photo", None) and m.id not in seen_msg_ids:
                     seen_msg_ids.add(m.id)
-                except Exception:
-                    pass
-                if len(photos) >= max_photos:
-                    return photos
-    except Exception:
-        pass
-
-    return photos
+                    yield os.path.join(DOWNLOAD_DIR, f"after_{main_msg.id}_{m.id}.jpg"), m
+    except Exception as e:
+        note_error(errors, e)
 
-async def collect_photos_from_main_only_with_next(client, group_entity, main_msg, max_photos=9, position="after"):
+async def iter_photos_from_main_with_next(client, group_entity, main_msg, errors=None):
     """
-    Если пользователь явно выбрал 'main' — собираем фото из main (media group / photo),
-    и при недостатке дополняем ближайшими после main фото (без текста), чтобы получить до max_photos.
+    Кандидаты из main (media group / photo), затем ближайшие после main фото (без текста).
     """
-    photos = []
     seen_msg_ids = set()
     try:
         # main media
         if getattr(main_msg, "grouped_id", None):
             gid = main_msg.grouped_id
             msgs = []
-            async for m in client.iter_messages(group_entity, min_id=main_msg.id-50, max_id=main_msg.id+50):
-                if getattr(m, "grouped_id", None) == gid and getattr(m, "photo", None):
-                    msgs.append(m)
+            with METRICS.span("scan_main_group"):
+                async for m in client.iter_messages(group_entity, min_id=main_msg.id-50, max_id=main_msg.id+50):
+                    if getattr(m, "grouped_id", None) == gid and getattr(m, "photo", None):
+                        msgs.append(m)
             msgs = sorted(msgs, key=lambda x: x.id)
             for m in msgs:
-                fname = os.path.join(DOWNLOAD_DIR, f"maingroup_{gid}_{m.id}.jpg")
-                try:
-                    await client.download_media(m.media or m.photo, file=fname)
-                    photos.append(fname)
-                    seen_msg_ids.add(m.id)
-                except Exception:
-                    pass
-                if len(photos) >= max_photos:
-                    return photos
+                seen_msg_ids.add(m.id)
+                yield os.path.join(DOWNLOAD_DIR, f"maingroup_{gid}_{m.id}.jpg"), m
         else:
             if getattr(main_msg, "photo", None):
-                fname = os.path.join(DOWNLOAD_DIR, f"main_{main_msg.id}.jpg")
-                try:
-                    await client.download_media(main_msg.media or main_msg.photo, file=fname)
-                    photos.append(fname)
-                    seen_msg_ids.add(main_msg.id)
-                except Exception:
-                    pass
-                if len(photos) >= max_photos:
-                    return photos
-    except Exception:
-        pass
+                seen_msg_ids.add(main_msg.id)
+                yield os.path.join(DOWNLOAD_DIR, f"main_{main_msg.id}.jpg"), main_msg
+    except Exception as e:
+        note_error(errors, e)
 
     # дополнительно берем фото после main (без текста), если нужно
     try:
-        async for m in client.iter_messages(group_entity, min_id=main_msg.id+1, max_id=main_msg.id+400):
-            if m.text and m.text.strip():
-                break
-            if getattr(m, "photo", None) and m.id not in seen_msg_ids:
-                fname = os.path.join(DOWNLOAD_DIR, f"main_after_{main_msg.id}_{m.id}.jpg")
-                try:
-                    await client.download_media(m.media or m.photo, file=fname)
-                    photos.append(fname)
+        with METRICS.span("scan_after"):
+            async for m in client.iter_messages(group_entity, min_id=main_msg.id+1, max_id=main_msg.id+400):
+                if m.text and m.text.strip():
+                    break
+                if getattr(m, "photo", None) and m.id not in seen_msg_ids:
                     seen_msg_ids.add(m.id)
+                    yield os.path.join(DOWNLOAD_DIR, f"main_after_{main_msg.id}_{m.id}.jpg"), m
+    except Exception as e:
+        note_error(errors, e)
+
+async def take_photo_candidates(candidates, n):
+    """Первые n кандидатов; генератор остаётся открытым, перебор можно продолжить."""
+    taken = []
+    if n <= 0:
+        return taken
+    async for c in candidates:
+        taken.append(c)
+        if len(taken) >= n:
+            break
+    return taken
+
+async def chain_photo_candidates(taken, candidates):
+    try:
+        for c in taken:
+            yield c
+        async for c in candidates:
+            yield c
+    finally:
+        await candidates.aclose()
+
+async def download_photos(client, candidates, max_photos, dedup=None, errors=None, selected=None):
+    """
+    Скачивает кандидатов по порядку, пока не наберётся max_photos (повторы по dedup не считаются).
+    В selected (если передан) добавляются взятые кандидаты (имя файла, сообщение).
+    """
+    os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+    photos = []
+    try:
+        async for fname, m in candidates:
+            try:
+                with METRICS.span("download_media"):
+                    await client.download_media(m.media or m.photo, file=fname)
+            except Exception as e:
+                note_error(errors, e)
+                continue
+            if keep_photo(fname, dedup):
+                photos.append(fname)
+                if selected is not None:
+                    selected.append((fname, m))
+                if len(photos) >= max_photos:
+                    break
+    finally:
+        # закрываем перебор явно: иначе открытые span'ы сканирования повиснут до сборки мусора
+        await candidates.aclose()
+    return photos
+
+async def collect_photos_combined(client, group_entity, main_msg, max_photos=9, position="after", dedup=None):
+    """
+    Собирает фотографии в порядке приоритета (см. iter_photos_combined).
+    Возвращает список локальных путей до скачанных файлов (до max_photos).
+    """
+    return await download_photos(client, iter_photos_combined(client, group_entity, main_msg), max_photos, dedup)
+
+async def collect_photos_from_main_only_with_next(client, group_entity, main_msg, max_photos=9, position="after", dedup=None):
+    """
+    Если пользователь явно выбрал 'main' — собираем фото из main (media group / photo),
+    и при недостатке дополняем ближайшими после main фото (без текста), чтобы получить до max_photos.
+    """
+    return await download_photos(client, iter_photos_from_main_with_next(client, group_entity, main_msg), max_photos, dedup)
+
+def description_fingerprint(text, cfg):
+    """Хэш описания в том виде, в каком оно уйдёт на сайт (после стоп-слов и чистки)."""
+    filtered, _ = exclude_lines_by_keywords(text or "", cfg.get("STOP_WORDS", []))
+    return hashlib.sha1(clean_description(filtered).encode("utf-8")).hexdigest()
+
+def photo_fingerprint(candidates):
+    """Упорядоченный список id фото Telegram: тот же набор постов даёт тот же список."""
+    return [getattr(getattr(m, "photo", None), "id", None) or m.id for _, m in candidates]
+
+async def fetch_telegram_source(client, cfg, site_article, want_desc, want_photo, result, ck=None, sku_cache=None, prev=None, errors=None):
+    """
+    Находит основной пост товара и собирает описание и фото.
+    Возвращает (description_text, photo_paths) или None, если товар уходит в ручную проверку
+    (причина/ошибка записываются в result). Если id поста известен из контрольной точки или кэша артикулов,
+    поиск не повторяется.
+    Отпечатки источника пишутся в result["fingerprint"]. Если prev (запись updated_dict) содержит те же
+    отпечатки, часть попадает в result["unchanged"], а фото при неизменном наборе не скачиваются.
+    Ошибки Telegram, после которых сбор продолжается (нужный режиму чат, перебор фото, скачивание), добавляются в errors.
+    """
+    entity_errors = {}
+    entities = await resolve_entities(client, cfg, entity_errors)
+    main_entity = entities["main"]
+    comments_entity = entities["comments"]
+
+    op_mode = cfg.get("OPERATION_MODE", "comments")
+    result["modes"]["op_mode"] = op_mode
+    result["modes"]["photo_mode"] = cfg.get("PHOTO_SOURCE_MODE", "auto")
+    # предохранитель учитывает только чат, с которого режим начинает поиск; второй — лишь запасной источник
+    needed = "comments" if op_mode == "comments" or cfg.get("PHOTO_SOURCE_FORCED", "main") != "main" else "main"
+    if needed in entity_errors:
+        note_error(errors, entity_errors[needed])
+        ulog(f"  → Не удалось получить чат {'COMMENT_GROUP_ID' if needed == 'comments' else 'TG_CHANNEL_ID'}: {entity_errors[needed]}")
+
+    # Find main message
+    main_msg = None
+    main_source = None
+    # default behaviour: in comments mode we search in COMMENT_GROUP_ID (ваш второй чат)
+    if op_mode == "comments" and not comments_entity:
+        result["review_reason"] = "missing_comment_group"
+        ulog("  → Режим 'Работа по группе' требует COMMENT_GROUP_ID — добавлено в ручную проверку.")
+        return None
+
+    cp = ck.get() if ck else {}
+    if cp.get("msg_id"):
+        entity = comments_entity if cp.get("source") == "comments" else main_entity
+        if entity:
+            try:
+                with METRICS.span("find_main_message"):
+                    main_msg = await client.get_messages(entity, ids=cp["msg_id"])
+            except Exception as e:
+                note_error(errors, e)
+                main_msg = None
+        if main_msg is not None and re.search(rf'\b{re.escape(site_article)}\b', main_msg.text or "", re.IGNORECASE):
+            main_source = cp.get("source")
+        else:
+            main_msg = None
+
+    if main_msg is None and sku_cache:
+        sources = ("comments",) if op_mode == "comments" else ("main", "comments")
+        with METRICS.span("find_main_message"):
+            cached = await sku_cache.get(client, site_article, entities, sources)
+        if cached:
+            main_msg, main_source = cached
+
+    if main_msg is None:
+        if op_mode == "comments":
+            main_msg = await find_main_message(client, comments_entity, site_article)
+            main_source = "comments"
+        else:
+            # manual mode: try forced sources but still prefer comments_entity if configured
+            forced = cfg.get("PHOTO_SOURCE_FORCED", "main")
+            if forced == "main" and main_entity:
+                main_msg = await find_main_message(client, main_entity, site_article)
+                main_source = "main"
+            if not main_msg and comments_entity:
+                main_msg = await find_main_message(client, comments_entity, site_article)
+                main_source = "comments"
+            if not main_msg and main_entity and forced != "main":
+                main_msg = await find_main_message(client, main_entity, site_article)
+                main_source = "main"
+
+    if not main_msg:
+        result["review_reason"] = "not_found"
+        ulog("  → Сообщение в Telegram не найдено — добавлено в ручную проверку.")
+        return None
+    if sku_cache:
+        sku_cache.store(site_article, main_msg, main_source, entities.get(main_source))
+    if ck:
+        ck.update(stage="message_found", article=site_article, msg_id=main_msg.id, source=main_source,
+                  grouped_id=getattr(main_msg, "grouped_id", None))
+
+    # Description selection according to priority
+    desc_priority = [s.strip() for s in cfg.get("DESCRIPTION_SOURCE_PRIORITY", "comments,main").split(",") if s.strip()]
+    description_text = ""
+    if want_desc:
+        for source in desc_priority:
+            if source == "main":
+                if getattr(main_msg, "text", None):
+                    description_text = clean_telegram_description(main_msg.text)
+                    break
+            elif source == "comments":
+                entity_to_search = comments_entity or main_entity
+                if entity_to_search:
+                    with METRICS.span("scan_description"):
+                        async for m in client.iter_messages(entity_to_search, min_id=main_msg.id+1, max_id=main_msg.id+200):
+                            if getattr(m, "reply_to_msg_id", None) == main_msg.id and getattr(m, "text", None):
+                                description_text = clean_telegram_description(m.text)
+                                break
+                if description_text:
+                    break
+        if not description_text:
+            description_text = clean_telegram_description(main_msg.text or "")
+
+    prev = prev or {}
+    fingerprint = result["fingerprint"] = {}
+    unchanged = result["unchanged"] = []
+    if want_desc:
+        fingerprint["desc_sha1"] = description_fingerprint(description_text, cfg)
+        if prev.get("desc_sha1") == fingerprint["desc_sha1"]:
+            unchanged.append("desc")
+
+    photo_paths = []
+    if not want_photo:
+        # только описание: фото не ищем и не скачиваем
+        if ck:
+            ck.update(stage="photos_downloaded", description=description_text, has_desc=bool(want_desc),
+                      want_photo=False, photos=[], fingerprint=fingerprint, unchanged=unchanged)
+        return description_text, photo_paths
+
+    # Photo collection using enhanced rules:
+    max_photos = int(cfg.get("MAX_PHOTOS", 9))
+    # Decide which entity to use for fetching photos:
+    # Prefer comments_entity (the group) as primary source per your request
+    fetch_entity = comments_entity or main_entity
+    dedup = None
+    if cfg.get("PHOTO_DEDUP_ENABLED", True):
+        dedup = PhotoDeduper(cfg.get("PHOTO_DEDUP_METHOD", "phash"), int(cfg.get("PHOTO_DEDUP_DISTANCE", 8)))
+
+    # If operation mode is manual and photo source forced to 'main' and main_entity corresponds:
+    # but still allow supplement from next messages (rule: main or next)
+    if cfg.get("PHOTO_SOURCE_MODE", "auto") == "manual" and cfg.get("PHOTO_SOURCE_FORCED", "main") == "main":
+        # collect from main_entity (where the main message was found), prefer main, supplement with next messages
+        fetch_entity = main_entity or comments_entity
+        candidates = iter_photos_from_main_with_next(client, fetch_entity, main_msg, errors)
+    else:
+        # default (auto/comments priority) — use combined collector that follows your three rules:
+        # replies -> main -> immediate after
+        fetch_entity = comments_entity or main_entity
+        candidates = iter_photos_combined(client, fetch_entity, main_msg, errors)
+    taken = await take_photo_candidates(candidates, max_photos)
+
+    # If still nothing and media exists in main entity (fallback)
+    if not taken:
+        # try main-only fallback
+        await candidates.aclose()
+        fetch_entity_fallback = main_entity or comments_entity
+        candidates = iter_photos_from_main_with_next(client, fetch_entity_fallback, main_msg, errors)
+        taken = await take_photo_candidates(candidates, max_photos)
+
+    # отпечаток — итоговый набор фото (после отсева похожих и замен). Если первые кандидаты совпали с прошлым
+    # набором, отсев оставит их все (они уже были вместе в наборе) — тот же пост с теми же фото не качаем
+    if prev.get("photo_ids") == photo_fingerprint(taken):
+        fingerprint["photo_ids"] = prev["photo_ids"]
+        unchanged.append("photo")
+        await candidates.aclose()
+    else:
+        selected = []
+        photo_paths = await download_photos(client, chain_photo_candidates(taken, candidates), max_photos, dedup, errors, selected)
+        fingerprint["photo_ids"] = photo_fingerprint(selected)
+        if prev.get("photo_ids") == fingerprint["photo_ids"]:
+            # прошлый набор был собран с заменами отброшенных повторов — после отсева он тот же
+            unchanged.append("photo")
+            for p in photo_paths:
+                try:
+                    os.remove(p)
                 except Exception:
                     pass
-                if len(photos) >= max_photos:
-                    return photos
-    except Exception:
-        pass
+            photo_paths = []
 
-    return photos
+    if dedup and dedup.dropped:
+        ulog(f"  Отброшено похожих фото: {dedup.dropped}")
+
+    if ck:
+        ck.update(stage="photos_downloaded", description=description_text, has_desc=bool(want_desc),
+                  want_photo=True, photos=photo_paths, fingerprint=fingerprint, unchanged=unchanged)
+    return description_text, photo_paths
+
+async def fetch_telegram_source_guarded(client, cfg, site_article, want_desc, want_photo, result, ck=None, sku_cache=None, prev=None):
+    """
+    fetch_telegram_source с учётом предохранителя telegram. Сбой сервиса — исключение, недоступный чат,
+    с которого режим начинает поиск, и ошибки перебора или скачивания фото, после которых сбор продолжился.
+    """
+    breaker = BREAKERS["telegram"]
+    breaker.check()
+    errors = []
+    try:
+        source = await fetch_telegram_source(client, cfg, site_article, want_desc, want_photo, result, ck, sku_cache, prev, errors)
+    except Exception:
+        breaker.failure()
+        raise
+    if errors:
+        lg(f"Telegram: ошибок при сборе — {len(errors)}, первая: {errors[0]}")
+    if result.get("error") or errors:
+        breaker.failure()
+    else:
+        breaker.success()
+    return source
 
 # -------------------------
 # Update product
 # -------------------------
-def update_product(product_id, new_description, photo_paths, wcapi, cfg, update_desc, update_photo, updated_file, tags=None):
+def prepare_product_update(new_description, photo_paths, cfg, update_desc, update_photo, tags=None, checkpoint=None, media_map=None):
+    """Готовит тело PUT products/<id>: чистит описание и загружает фото в Cloudinary (блокирующие вызовы)."""
     data = {}
     removed_lines = []
     if update_desc:
@@ -532,41 +2780,101 @@ def update_product(product_id, new_description, photo_paths, wcapi, cfg, update_
             data["description"] = cleaned
     uploaded_urls = []
     if update_photo:
+        # фото, загруженные до прерывания прошлого прогона, повторно не загружаем
+        uploaded_before = checkpoint.get().get("uploaded", {}) if checkpoint else {}
         for p in photo_paths:
+            name = os.path.basename(p)
+            if name in uploaded_before:
+                uploaded_urls.append(uploaded_before[name])
+                if len(uploaded_urls) >= cfg.get("MAX_PHOTOS", 9):
+                    break
+                continue
             if not image_file_ok(p, cfg):
                 continue
-            url = upload_image_cloudinary(p, cfg, retries=3, delay=cfg.get("PAUSE_BETWEEN_PHOTOS", 2))
+            file_hash = file_sha1(p) if media_map or cfg.get("CLOUDINARY_STABLE_IDS", True) else None
+            known_url = media_map.url_for_hash(file_hash) if media_map else None
+            if known_url:
+                uploaded_urls.append(known_url)
+                if len(uploaded_urls) >= cfg.get("MAX_PHOTOS", 9):
+                    break
+                continue
+            url = upload_image_cloudinary(p, cfg, retries=3, delay=cfg.get("PAUSE_BETWEEN_PHOTOS", 2), checkpoint=checkpoint,
+                                          content_hash=file_hash)
             if url:
                 uploaded_urls.append(url)
+                if checkpoint:
+                    checkpoint.add_upload(name, url)
+                if media_map:
+                    media_map.remember(url, file_hash=file_hash)
             if len(uploaded_urls) >= cfg.get("MAX_PHOTOS", 9):
                 break
             time.sleep(cfg.get("PAUSE_BETWEEN_PHOTOS", 2))
         if uploaded_urls:
-            data["images"] = [{"src": u} for u in uploaded_urls]
+            data["images"] = media_map.images_payload(uploaded_urls) if media_map else [{"src": u} for u in uploaded_urls]
+        if checkpoint:
+            checkpoint.update(stage="uploaded")
     if tags:
         data["tags"] = [{"name": t} for t in tags]
+    return data, uploaded_urls, removed_lines
+
+async def update_product(product_id, new_description, photo_paths, wcapi, cfg, update_desc, update_photo, updated_file, tags=None, checkpoint=None, media_map=None):
+    data, uploaded_urls, removed_lines = await asyncio.to_thread(
+        prepare_product_update, new_description, photo_paths, cfg, update_desc, update_photo,
+        tags=tags, checkpoint=checkpoint, media_map=media_map
+    )
     if not data:
         return False, uploaded_urls, removed_lines
+    success = await write_product_update(product_id, data, uploaded_urls, wcapi, update_photo, checkpoint, media_map)
+    return success, uploaded_urls, removed_lines
+
+async def write_product_update(product_id, data, uploaded_urls, wcapi, update_photo, checkpoint=None, media_map=None):
+    """PUT products/<id> с готовым телом (см. prepare_product_update). True — WooCommerce принял обновление."""
+    if checkpoint:
+        checkpoint.update(stage="wc_pending")
     try:
-        if update_photo and wcapi is not None:
+        # старые фото снимаем только когда есть чем их заменить, иначе товар останется без галереи
+        if update_photo and wcapi is not None and data.get("images"):
             try:
-                wcapi.put(f"products/{product_id}", {"images": []})
-                time.sleep(1)
+                with METRICS.span("wc_clear_images"):
+                    await wc_request(wcapi, "PUT", f"products/{product_id}", {"images": []})
+                # пауза после очистки — не работа сервиса, в отчёт по этапам идёт отдельно
+                with METRICS.span("wc_clear_pause"):
+                    await asyncio.sleep(1)
+            except CircuitOpenError:
+                raise
             except Exception:
                 pass
-        res = wcapi.put(f"products/{product_id}", data)
+        with METRICS.span("wc_put"):
+            res = await wc_request(wcapi, "PUT", f"products/{product_id}", data)
+        reused_ids = [img["id"] for img in data.get("images", []) if "id" in img]
+        if getattr(res, "status_code", None) == 400 and reused_ids and "image" in (getattr(res, "text", "") or ""):
+            # вложение удалили из медиатеки — забываем id и отправляем картинки по URL
+            lg(f"WooCommerce отклонил id медиафайлов {reused_ids} — загружаем по URL.")
+            media_map.forget(reused_ids)
+            data["images"] = [{"src": u} for u in uploaded_urls]
+            with METRICS.span("wc_put"):
+                res = await wc_request(wcapi, "PUT", f"products/{product_id}", data)
         if getattr(res, "status_code", None) in (200, 201):
-            return True, uploaded_urls, removed_lines
-        else:
-            return False, uploaded_urls, removed_lines
+            if media_map and "images" in data:
+                media_map.remember_from_response(uploaded_urls, res)
+            return True
+        return False
+    except CircuitOpenError:
+        raise
     except Exception:
-        return False, uploaded_urls, removed_lines
+        return False
+    finally:
+        if media_map:
+            try:
+                media_map.save()
+            except Exception as e:
+                lg(f"Не удалось сохранить {media_map.path}: {e}")
 
 # -------------------------
 # Process one product
 # -------------------------
-async def process_one_product(product, wcapi, cfg, updated_dict):
-    result = {
+def new_product_result(product):
+    return {
         "product_id": str(product.get("id")),
         "name": product.get("name", "") or "",
         "article": "",
@@ -575,19 +2883,18 @@ async def process_one_product(product, wcapi, cfg, updated_dict):
         "photos_uploaded": [],
         "photos_count": 0,
         "removed_lines": [],
-        "error": None,
-        "review_reason": None,
-        "modes": {},
-        "description_preview": ""
-    }
-    prod_id = result["product_id"]
-    site_title = result["name"]
-    site_article = extract_site_article(product, cfg)
-    result["article"] = site_article
-
-    ulog(f"Обработка: \"{site_title}\" (id={prod_id}, артикул='{site_article}')")
+        "error": None,
+        "review_reason": None,
+        "modes": {},
+        "description_preview": ""
+    }
 
-    prev = updated_dict.get(prod_id, {})
+def plan_product_update(product, cfg, updated_dict, result):
+    """
+    Решает по настройкам и истории, что обновлять у товара: (want_desc, want_photo).
+    None — обновлять нечего (причина записана в result["review_reason"]).
+    """
+    prev = updated_dict.get(result["product_id"], {})
     desc_done = bool(prev.get("desc", False))
     photo_done = bool(prev.get("photo", False))
 
@@ -605,11 +2912,11 @@ async def process_one_product(product, wcapi, cfg, updated_dict):
     if update_strategy == "only_new" and is_updated_any:
         ulog(f"  → Пропущен (только новые, уже обновлялся ранее).")
         result["review_reason"] = "only_new_already_updated"
-        return result
+        return None
     if update_strategy == "only_updated" and not is_updated_any:
         ulog(f"  → Пропущен (только обновлённые, ранее не обновлялся).")
         result["review_reason"] = "only_updated_not_prev"
-        return result
+        return None
 
     if cfg.get("UPDATE_PHOTOS", True) and update_strategy in cfg.get("PHOTO_SKIP_STRATEGIES", ["only_new"]):
         cnt = get_product_images_count(product)
@@ -624,115 +2931,98 @@ async def process_one_product(product, wcapi, cfg, updated_dict):
     if not want_desc and not want_photo:
         ulog("  → Нечего обновлять (по настройкам и истории).")
         result["review_reason"] = "nothing_to_update"
-        return result
+        return None
+    return want_desc, want_photo
 
-    # Telethon client
-    from telethon import TelegramClient
-    client = TelegramClient('user_session', int(cfg.get("TG_API_ID")), cfg.get("TG_API_HASH"))
-    try:
-        await client.start(phone=cfg.get("TG_PHONE"))
-    except Exception as e:
-        result["error"] = f"Telethon start error: {e}"
-        ulog(f"  Ошибка подключения к Telegram: {e}")
-        try: await client.disconnect()
-        except: pass
-        return result
+async def process_one_product(product, wcapi, cfg, updated_dict, checkpoints=None, media_map=None, client=None, sku_cache=None):
+    result = new_product_result(product)
+    prod_id = result["product_id"]
+    site_title = result["name"]
+    site_article = extract_site_article(product, cfg)
+    result["article"] = site_article
 
-    main_entity = None
-    comments_entity = None
-    try:
-        if cfg.get("TG_CHANNEL_ID"):
-            try:
-                main_entity = await client.get_entity(cfg.get("TG_CHANNEL_ID"))
-            except Exception:
-                main_entity = None
-        if cfg.get("COMMENT_GROUP_ID"):
-            try:
-                comments_entity = await client.get_entity(cfg.get("COMMENT_GROUP_ID"))
-            except Exception:
-                comments_entity = None
-    except Exception as e:
-        result["error"] = f"Error getting entities: {e}"
-        await client.disconnect()
+    ulog(f"Обработка: \"{site_title}\" (id={prod_id}, артикул='{site_article}')")
+
+    plan = plan_product_update(product, cfg, updated_dict, result)
+    if plan is None:
         return result
+    want_desc, want_photo = plan
+    prev = updated_dict.get(prod_id, {})
 
-    op_mode = cfg.get("OPERATION_MODE", "comments")
-    result["modes"]["op_mode"] = op_mode
-    result["modes"]["photo_mode"] = cfg.get("PHOTO_SOURCE_MODE", "auto")
+    # отпечатки прошлого обновления: при неизменном посте в Telegram ничего не качаем и не пишем
+    prev_fp = prev if cfg.get("SKIP_UNCHANGED_SOURCE", True) else None
+
+    ck = checkpoints.product(prod_id) if checkpoints else None
+    cp = ck.get() if ck else {}
+    if cp and cp.get("article") != site_article:
+        ck.clear()
+        cp = {}
+
+    resumable = bool(cp) and checkpoint_resumable(cp, want_desc, want_photo)
+    needed = ["woocommerce"] + ([] if resumable else ["telegram"]) + (["cloudinary"] if want_photo else [])
+    blocked = [name for name in needed if BREAKERS[name].blocked()]
+    if blocked:
+        # сервис лежит: товар не ждёт таймаутов, а сразу уходит в ручную проверку
+        ulog(f"  → Недоступно: {', '.join(blocked)} — добавлено в ручную проверку без обращения к сети.")
+        result["review_reason"] = "circuit_open"
+        result["error"] = f"{', '.join(blocked)} недоступен"
+        return result
 
-    # Find main message
-    main_msg = None
-    # default behaviour: in comments mode we search in COMMENT_GROUP_ID (ваш второй чат)
-    if op_mode == "comments":
-        if not comments_entity:
-            result["review_reason"] = "missing_comment_group"
-            ulog("  → Режим 'Работа по группе' требует COMMENT_GROUP_ID — добавлено в ручную проверку.")
-            await client.disconnect()
+    if resumable:
+        ulog(f"  → Продолжаем с контрольной точки (этап: {cp.get('stage')}, уже загружено фото: {len(cp.get('uploaded', {}))}).")
+        description_text = cp.get("description", "")
+        photo_paths = list(cp.get("photos", []))
+        result["fingerprint"] = dict(cp.get("fingerprint") or {})
+        result["unchanged"] = list(cp.get("unchanged") or [])
+    elif client is not None:
+        # общий клиент прогона (подключается один раз в SyncWorker._main)
+        source = await fetch_telegram_source_guarded(client, cfg, site_article, want_desc, want_photo, result, ck, sku_cache, prev_fp)
+        if source is None:
             return result
-        main_msg = await find_main_message(client, comments_entity, site_article)
+        description_text, photo_paths = source
     else:
-        # manual mode: try forced sources but still prefer comments_entity if configured
-        forced = cfg.get("PHOTO_SOURCE_FORCED", "main")
-        if forced == "main" and main_entity:
-            main_msg = await find_main_message(client, main_entity, site_article)
-        if not main_msg and comments_entity:
-            main_msg = await find_main_message(client, comments_entity, site_article)
-        if not main_msg and main_entity and forced != "main":
-            main_msg = await find_main_message(client, main_entity, site_article)
-
-    if not main_msg:
-        result["review_reason"] = "not_found"
-        ulog("  → Сообщение в Telegram не найдено — добавлено в ручную проверку.")
-        await client.disconnect()
-        return result
-
-    # Description selection according to priority
-    desc_priority = [s.strip() for s in cfg.get("DESCRIPTION_SOURCE_PRIORITY", "comments,main").split(",") if s.strip()]
-    description_text = ""
-    if want_desc:
-        for source in desc_priority:
-            if source == "main":
-                if getattr(main_msg, "text", None):
-                    description_text = clean_telegram_description(main_msg.text)
-                    break
-            elif source == "comments":
-                entity_to_search = comments_entity or main_entity
-                if entity_to_search:
-                    async for m in client.iter_messages(entity_to_search, min_id=main_msg.id+1, max_id=main_msg.id+200):
-                        if getattr(m, "reply_to_msg_id", None) == main_msg.id and getattr(m, "text", None):
-                            description_text = clean_telegram_description(m.text)
-                            break
-                if description_text:
-                    break
-        if not description_text:
-            description_text = clean_telegram_description(main_msg.text or "")
+        # Telethon client
+        client = create_telegram_client(cfg)
+        if RECORDER.active:
+            client = RecordingTelegramClient(client, RECORDER)
+        client = CountingTelegramClient(client)
+        try:
+            with METRICS.span("telegram_connect"):
+                await client.start(phone=cfg.get("TG_PHONE"))
+        except Exception as e:
+            BREAKERS["telegram"].failure()
+            result["error"] = f"Telethon start error: {e}"
+            ulog(f"  Ошибка подключения к Telegram: {e}")
+            try: await client.disconnect()
+            except: pass
+            return result
+        try:
+            source = await fetch_telegram_source_guarded(client, cfg, site_article, want_desc, want_photo, result, ck, sku_cache, prev_fp)
+        finally:
+            try: await client.disconnect()
+            except: pass
+        if source is None:
+            return result
+        description_text, photo_paths = source
 
     result["description_preview"] = (description_text or "")[:400].replace("\n", " ")
 
-    # Photo collection using enhanced rules:
-    photo_paths = []
-    max_photos = int(cfg.get("MAX_PHOTOS", 9))
-    # Decide which entity to use for fetching photos:
-    # Prefer comments_entity (the group) as primary source per your request
-    fetch_entity = comments_entity or main_entity
-
-    # If operation mode is manual and photo source forced to 'main' and main_entity corresponds:
-    # but still allow supplement from next messages (rule: main or next)
-    if cfg.get("PHOTO_SOURCE_MODE", "auto") == "manual" and cfg.get("PHOTO_SOURCE_FORCED", "main") == "main":
-        # collect from main_entity (where the main message was found), prefer main, supplement with next messages
-        fetch_entity = main_entity or comments_entity
-        photo_paths = await collect_photos_from_main_only_with_next(client, fetch_entity, main_msg, max_photos, position=cfg.get("ADDITIONAL_POSTS_POSITION","after"))
-    else:
-        # default (auto/comments priority) — use combined collector that follows your three rules:
-        # replies -> main -> immediate after
-        fetch_entity = comments_entity or main_entity
-        photo_paths = await collect_photos_combined(client, fetch_entity, main_msg, max_photos, position=cfg.get("ADDITIONAL_POSTS_POSITION","after"))
-
-    # If still nothing and media exists in main entity (fallback)
-    if want_photo and not photo_paths:
-        # try main-only fallback
-        fetch_entity_fallback = main_entity or comments_entity
-        photo_paths = await collect_photos_from_main_only_with_next(client, fetch_entity_fallback, main_msg, max_photos, position=cfg.get("ADDITIONAL_POSTS_POSITION","after"))
+    unchanged = result.get("unchanged") or []
+    if "desc" in unchanged:
+        want_desc = False
+    if "photo" in unchanged:
+        want_photo = False
+    if unchanged and not want_desc and not want_photo:
+        for p in photo_paths:
+            try:
+                os.remove(p)
+            except Exception:
+                pass
+        if ck:
+            ck.clear()
+        ulog("  → Пост в Telegram не изменился с прошлого обновления — пропущен.")
+        result["review_reason"] = "source_unchanged"
+        return result
 
     # Show concise info about photos found
     if want_photo:
@@ -744,9 +3034,16 @@ async def process_one_product(product, wcapi, cfg, updated_dict):
 
     # Perform update
     try:
-        success, uploaded_urls, removed_lines = await asyncio.to_thread(
-            update_product, product["id"], description_text, photo_paths, wcapi, cfg, want_desc, want_photo, cfg.get("UPDATED_FILE","updated_products.json")
+        success, uploaded_urls, removed_lines = await update_product(
+            product["id"], description_text, photo_paths, wcapi, cfg, want_desc, want_photo, cfg.get("UPDATED_FILE","updated_products.json"),
+            checkpoint=ck, media_map=media_map
         )
+    except CircuitOpenError as e:
+        success = False
+        uploaded_urls = []
+        removed_lines = []
+        result["error"] = str(e)
+        result["circuit_open"] = True
     except Exception as e:
         success = False
         uploaded_urls = []
@@ -754,6 +3051,7 @@ async def process_one_product(product, wcapi, cfg, updated_dict):
         result["error"] = f"update_product exception: {e}"
 
     # Clean temporary downloaded photos
+    # (при падении процесса файлы остаются на диске и переиспользуются по контрольной точке)
     for p in photo_paths:
         try:
             if os.path.exists(p):
@@ -762,6 +3060,8 @@ async def process_one_product(product, wcapi, cfg, updated_dict):
             pass
 
     if success:
+        if ck:
+            ck.clear()
         result["updated"] = True
         result["desc_updated"] = bool(want_desc)
         result["photos_uploaded"] = uploaded_urls
@@ -771,6 +3071,11 @@ async def process_one_product(product, wcapi, cfg, updated_dict):
             updated_dict[prod_id] = {}
         if want_desc: updated_dict[prod_id]["desc"] = True
         if want_photo: updated_dict[prod_id]["photo"] = True
+        fingerprint = result.get("fingerprint") or {}
+        if want_desc and "desc_sha1" in fingerprint:
+            updated_dict[prod_id]["desc_sha1"] = fingerprint["desc_sha1"]
+        if want_photo and "photo_ids" in fingerprint:
+            updated_dict[prod_id]["photo_ids"] = fingerprint["photo_ids"]
         save_updated_products(updated_dict, cfg.get("UPDATED_FILE","updated_products.json"))
 
         ulog(f"  Успешно обновлён. Фото: {len(uploaded_urls)}. Описание: {'обновлено' if want_desc else 'нет'}")
@@ -785,14 +3090,509 @@ async def process_one_product(product, wcapi, cfg, updated_dict):
             ulog(f"  Ошибка: {result['error']}")
         else:
             ulog("  Обновление не удалось (см. подробный лог).")
-        result["review_reason"] = "update_failed"
+        result["review_reason"] = "circuit_open" if result.pop("circuit_open", False) else "update_failed"
 
-    await client.disconnect()
     return result
 
+# -------------------------
+# Description-only fast path
+# -------------------------
+def description_only(cfg):
+    """Прогон обновляет только описания — фото не нужны ни одному товару."""
+    if cfg.get("UPDATE_WHAT", "both") == "description":
+        return True
+    return cfg.get("UPDATE_WHAT", "both") == "both" and not cfg.get("UPDATE_PHOTOS", True) and cfg.get("UPDATE_DESCRIPTION", True)
+
+class DescriptionBatch:
+    """
+    Копит готовые описания и отправляет их пачками через products/batch
+    (WooCommerce принимает до 100 товаров за запрос).
+    """
+    def __init__(self, wcapi, size=50):
+        self.wcapi = wcapi
+        self.size = max(1, min(int(size), 100))
+        self.items = []  # (result, data)
+
+    def add(self, result, data):
+        self.items.append((result, data))
+        return len(self.items) >= self.size
+
+    async def flush(self):
+        """Отправляет накопленное; возвращает список result с проставленным updated."""
+        items, self.items = self.items, []
+        if not items:
+            return []
+        payload = {"update": [dict(data, id=int(result["product_id"])) for result, data in items]}
+        statuses = {}
+        error = "нет в ответе products/batch"
+        reason = "update_failed"
+        try:
+            with METRICS.span("wc_batch"):
+                res = await wc_request(self.wcapi, "POST", "products/batch", payload)
+            if getattr(res, "status_code", None) in (200, 201):
+                for prod in (res.json() or {}).get("update", []):
+                    statuses[str(prod.get("id"))] = prod.get("error")
+            else:
+                error = f"products/batch: HTTP {getattr(res, 'status_code', None)}"
+        except Exception as e:
+            error = f"products/batch: {e}"
+            reason = "circuit_open" if isinstance(e, CircuitOpenError) else reason
+        for result, _ in items:
+            pid = result["product_id"]
+            if pid in statuses and not statuses[pid]:
+                result["updated"] = True
+                result["desc_updated"] = True
+            else:
+                err = statuses.get(pid)
+                result["error"] = (err.get("message") or err.get("code")) if isinstance(err, dict) else error
+                result["review_reason"] = reason
+        return [result for result, _ in items]
+
+async def prepare_description_only(product, cfg, updated_dict, client, sku_cache=None):
+    """
+    Описание товара без работы с медиа: поиск поста и чистка текста.
+    Возвращает (result, data) — data это тело для products/batch или None, если товар отправлять не нужно.
+    """
+    result = new_product_result(product)
+    site_article = extract_site_article(product, cfg)
+    result["article"] = site_article
+    ulog(f"Обработка: \"{result['name']}\" (id={result['product_id']}, артикул='{site_article}')")
+
+    plan = plan_product_update(product, cfg, updated_dict, result)
+    if plan is None:
+        return result, None
+    prev = updated_dict.get(result["product_id"], {}) if cfg.get("SKIP_UNCHANGED_SOURCE", True) else None
+    if BREAKERS["telegram"].blocked() or BREAKERS["woocommerce"].blocked():
+        ulog("  → Telegram или сайт недоступны — добавлено в ручную проверку без обращения к сети.")
+        result["review_reason"] = "circuit_open"
+        return result, None
+    source = await fetch_telegram_source_guarded(client, cfg, site_article, True, False, result, None, sku_cache, prev)
+    if source is None:
+        return result, None
+    description_text = source[0]
+    result["description_preview"] = (description_text or "")[:400].replace("\n", " ")
+    if "desc" in (result.get("unchanged") or []):
+        ulog("  → Пост в Telegram не изменился с прошлого обновления — пропущен.")
+        result["review_reason"] = "source_unchanged"
+        return result, None
+    data, _, removed_lines = prepare_product_update(description_text, [], cfg, True, False)
+    result["removed_lines"] = removed_lines
+    if not data:
+        ulog("  → Описание пустое после очистки — добавлено в ручную проверку.")
+        result["review_reason"] = "update_failed"
+        return result, None
+    return result, data
+
+def apply_description_results(results, updated_dict, cfg):
+    """Отмечает обновлённые описания в updated_dict и сохраняет файл один раз на пачку."""
+    for result in results:
+        if not result.get("updated"):
+            ulog(f"  id={result['product_id']}: описание не обновлено — {result.get('error')}")
+            continue
+        entry = updated_dict.setdefault(result["product_id"], {})
+        entry["desc"] = True
+        desc_sha1 = (result.get("fingerprint") or {}).get("desc_sha1")
+        if desc_sha1:
+            entry["desc_sha1"] = desc_sha1
+    save_updated_products(updated_dict, cfg.get("UPDATED_FILE", "updated_products.json"))
+    ok = sum(1 for r in results if r.get("updated"))
+    ulog(f"Пачка описаний отправлена: обновлено {ok} из {len(results)}.")
+
+# -------------------------
+# Several shops (fan-out)
+# -------------------------
+SHOP_STATE_KEYS = (("UPDATED_FILE", "updated_products.json"), ("MEDIA_MAP_FILE", "wc_media_map.json"))
+
+def shop_file(path, name):
+    root, ext = os.path.splitext(path)
+    return f"{root}.{re.sub(r'[^A-Za-z0-9_-]+', '_', name)}{ext}"
+
+def shop_configs(cfg):
+    """
+    Конфиги магазинов: основной (WC_URL, WC_KEY, WC_SECRET) и магазины из WC_SHOPS.
+    Элемент WC_SHOPS: {"name": "shop2", "WC_URL": "...", "WC_KEY": "...", "WC_SECRET": "..."} — можно
+    переопределить и другие настройки сайта (кроме TG_*). У каждого магазина свои updated_products и медиакарта.
+    """
+    shops = [dict(cfg, WC_SHOP_NAME="main")]
+    for i, extra in enumerate(cfg.get("WC_SHOPS") or [], start=1):
+        name = str(extra.get("name") or f"shop{i + 1}")
+        shop = dict(cfg, WC_SHOP_NAME=name)
+        for key, default in SHOP_STATE_KEYS:
+            shop[key] = shop_file(cfg.get(key, default), name)
+        shop.update({k: v for k, v in extra.items() if k in DEFAULT_CONFIG and not k.startswith("TG_")})
+        shops.append(shop)
+    return shops
+
+class ShopTarget:
+    """Магазин в режиме нескольких магазинов: клиент WC, каталог по артикулам и своё состояние прогресса."""
+    def __init__(self, cfg, wcapi=None, products=None, updated_dict=None, media_map=None):
+        self.cfg = cfg
+        self.name = cfg.get("WC_SHOP_NAME", "main")
+        self.wcapi = wcapi
+        self.products = products or []
+        self.updated_dict = updated_dict if updated_dict is not None else load_updated_products(cfg.get("UPDATED_FILE","updated_products.json"))
+        self.media_map = media_map or MediaMap(cfg.get("MEDIA_MAP_FILE", "wc_media_map.json"))
+
+def group_by_article(targets, cfg):
+    """
+    Очередь для режима нескольких магазинов: [(артикул, {индекс магазина: товар})] в порядке основного каталога,
+    затем товары, которые есть только в других магазинах. Товары без артикула идут каждый отдельно.
+    """
+    groups = {}
+    order = []
+    for index, target in enumerate(targets):
+        quiet = dict(target.cfg, VERBOSE_LOG=False)
+        for product in target.products:
+            article = extract_site_article(product, quiet)
+            key = SkuMessageCache.key(article) or f"id:{target.name}:{product.get('id')}"
+            if key not in groups:
+                groups[key] = (article, {})
+                order.append(key)
+            groups[key][1].setdefault(index, product)
+    return [(key,) + groups[key] for key in order]
+
+def shared_prev(entries):
+    """Общие отпечатки прошлых обновлений: поле попадает в prev, только если у всех магазинов оно одинаковое."""
+    prev = {}
+    for field in ("desc_sha1", "photo_ids"):
+        values = {json.dumps(entry.get(field)) for entry in entries}
+        if len(values) == 1 and entries and entries[0].get(field) is not None:
+            prev[field] = entries[0][field]
+    return prev
+
+async def fan_out_article(article, products, targets, cfg, client, sku_cache=None):
+    """
+    Один пост Telegram — во все магазины, где есть артикул: поиск, скачивание, подготовка и загрузка
+    в Cloudinary выполняются один раз, запись в WooCommerce — в каждый магазин своим PUT.
+    Возвращает [(магазин, result)].
+    """
+    entries = []
+    for index, product in sorted(products.items()):
+        target = targets[index]
+        result = new_product_result(product)
+        result["article"] = article
+        result["shop"] = target.name
+        ulog(f"[{target.name}] \"{result['name']}\" (id={result['product_id']}, артикул='{article}')")
+        plan = plan_product_update(product, target.cfg, target.updated_dict, result)
+        entries.append([target, result, plan])
+    active = [e for e in entries if e[2] is not None]
+    if not active:
+        return [(t, r) for t, r, _ in entries]
+
+    want_desc = any(plan[0] for _, _, plan in active)
+    want_photo = any(plan[1] for _, _, plan in active)
+    needed = ["woocommerce", "telegram"] + (["cloudinary"] if want_photo else [])
+    blocked = [name for name in needed if BREAKERS[name].blocked()]
+    if blocked:
+        ulog(f"  → Недоступно: {', '.join(blocked)} — добавлено в ручную проверку без обращения к сети.")
+        for _, result, _ in active:
+            result["review_reason"] = "circuit_open"
+            result["error"] = f"{', '.join(blocked)} недоступен"
+        return [(t, r) for t, r, _ in entries]
+
+    skip_unchanged = cfg.get("SKIP_UNCHANGED_SOURCE", True)
+    prev = shared_prev([t.updated_dict.get(r["product_id"], {}) for t, r, _ in active]) if skip_unchanged else None
+    shared = new_product_result({})
+    source = await fetch_telegram_source_guarded(client, cfg, article, want_desc, want_photo, shared, None, sku_cache, prev)
+    if source is None:
+        for _, result, _ in active:
+            result["review_reason"] = shared.get("review_reason")
+            result["error"] = shared.get("error")
+        return [(t, r) for t, r, _ in entries]
+    description_text, photo_paths = source
+    fingerprint = shared.get("fingerprint") or {}
+
+    # у каждого магазина своя история: неизменившееся с его прошлого обновления не пишем
+    for entry in active:
+        target, result, (td, tp) = entry
+        last = target.updated_dict.get(result["product_id"], {}) if skip_unchanged else {}
+        if td and last.get("desc_sha1") and last.get("desc_sha1") == fingerprint.get("desc_sha1"):
+            td = False
+        if tp and last.get("photo_ids") and last.get("photo_ids") == fingerprint.get("photo_ids"):
+            tp = False
+        entry[2] = (td, tp)
+        result["fingerprint"] = fingerprint
+        result["description_preview"] = (description_text or "")[:400].replace("\n", " ")
+        if not td and not tp:
+            result["review_reason"] = "source_unchanged"
+    writers = [e for e in active if not e[1]["review_reason"]]
+    any_desc = any(plan[0] for _, _, plan in writers)
+    any_photo = any(plan[1] for _, _, plan in writers)
+
+    try:
+        if writers:
+            if any_photo and photo_paths:
+                ulog(f"  Фото найдено: {len(photo_paths)} шт. — загружаются один раз для {len(writers)} магазин(ов).")
+            try:
+                data, uploaded_urls, removed_lines = await asyncio.to_thread(
+                    prepare_product_update, description_text, photo_paths if any_photo else [], cfg, any_desc, any_photo,
+                    media_map=targets[0].media_map)
+            except CircuitOpenError as e:
+                for _, result, _ in writers:
+                    result["error"] = str(e)
+                    result["review_reason"] = "circuit_open"
+                writers = []
+        async def write(target, result, td, tp):
+            payload = {}
+            if td and "description" in data:
+                payload["description"] = data["description"]
+            if tp and uploaded_urls:
+                payload["images"] = target.media_map.images_payload(uploaded_urls)
+            if not payload:
+                result["review_reason"] = "update_failed"
+                return
+            try:
+                success = await write_product_update(result["product_id"], payload, uploaded_urls, target.wcapi, tp,
+                                                     media_map=target.media_map)
+            except CircuitOpenError as e:
+                result["error"] = str(e)
+                result["review_reason"] = "circuit_open"
+                return
+            if not success:
+                ulog(f"  [{target.name}] Обновление не удалось (см. подробный лог).")
+                result["review_reason"] = "update_failed"
+                return
+            result["updated"] = True
+            result["desc_updated"] = bool(td)
+            result["photos_uploaded"] = uploaded_urls if tp else []
+            result["photos_count"] = len(result["photos_uploaded"])
+            result["removed_lines"] = removed_lines
+            entry = target.updated_dict.setdefault(result["product_id"], {})
+            if td:
+                entry["desc"] = True
+                if "desc_sha1" in fingerprint:
+                    entry["desc_sha1"] = fingerprint["desc_sha1"]
+            if tp:
+                entry["photo"] = True
+                if "photo_ids" in fingerprint:
+                    entry["photo_ids"] = fingerprint["photo_ids"]
+            save_updated_products(target.updated_dict, target.cfg.get("UPDATED_FILE","updated_products.json"))
+            ulog(f"  [{target.name}] Успешно обновлён. Фото: {result['photos_count']}. Описание: {'обновлено' if td else 'нет'}")
+
+        # магазины независимы: пишем во все одновременно
+        await asyncio.gather(*(write(target, result, td, tp) for target, result, (td, tp) in writers))
+    finally:
+        for p in photo_paths:
+            try:
+                if os.path.exists(p):
+                    os.remove(p)
+            except Exception:
+                pass
+    return [(t, r) for t, r, _ in entries]
+
+# -------------------------
+# Pre-flight checks
+# -------------------------
+async def preflight_timed(coro, timeout):
+    """(ok, сообщение) проверки; если сервис не ответил за timeout секунд — (False, ...)."""
+    try:
+        return await asyncio.wait_for(coro, timeout)
+    except asyncio.TimeoutError:
+        return False, f"нет ответа за {timeout:g} с"
+    except Exception as e:
+        return False, f"ошибка проверки: {e}"
+
+async def preflight_telegram(client, cfg):
+    """Вход выполнен и нужные чаты (TG_CHANNEL_ID, COMMENT_GROUP_ID) доступны этому аккаунту."""
+    if client is None:
+        return False, "вход не выполнен (причина — выше в логе)"
+    entities = await resolve_entities(client, cfg)
+    problems = []
+    if cfg.get("COMMENT_GROUP_ID") and entities["comments"] is None:
+        problems.append(f"группа комментариев COMMENT_GROUP_ID={cfg.get('COMMENT_GROUP_ID')} не найдена или недоступна")
+    if cfg.get("TG_CHANNEL_ID") and entities["main"] is None:
+        problems.append(f"канал TG_CHANNEL_ID={cfg.get('TG_CHANNEL_ID')} не найден или недоступен")
+    if problems:
+        return False, "; ".join(problems)
+    if cfg.get("OPERATION_MODE", "comments") == "comments" and entities["comments"] is None:
+        return True, "вход выполнен; COMMENT_GROUP_ID не задан — товары уйдут в ручную проверку (missing_comment_group)"
+    return True, "вход выполнен, чаты доступны"
+
+async def preflight_woocommerce(wcapi, name="WooCommerce"):
+    """Сайт отвечает и принимает ключ/секрет (GET products?per_page=1)."""
+    if wcapi is None:
+        return False, "клиент не создан (нет библиотеки или неверный WC_URL)"
+    try:
+        res = await wc_request(wcapi, "GET", "products", params={"per_page": 1})
+    except Exception as e:
+        return False, f"сайт недоступен: {e}"
+    status = getattr(res, "status_code", 0) or 0
+    if status in (401, 403):
+        return False, f"ключ или секрет не приняты (HTTP {status})"
+    if status >= 400:
+        return False, f"HTTP {status}: {(getattr(res, 'text', '') or '')[:200]}"
+    total = (getattr(res, "headers", None) or {}).get("X-WP-Total")
+    return True, f"доступ есть, товаров на сайте: {total}" if total else "доступ есть"
+
+async def preflight_cloudinary(cfg):
+    """Ключи Cloudinary приняты (Admin API ping); не нужен, если фото не обновляются."""
+    if description_only(cfg):
+        return True, "не используется (обновляются только описания)"
+    missing = [k for k in ("CLOUDINARY_CLOUD_NAME", "CLOUDINARY_API_KEY", "CLOUDINARY_API_SECRET") if not cfg.get(k)]
+    if missing:
+        return False, "не заполнены " + ", ".join(missing)
+    configure_cloudinary(cfg)
+    try:
+        await asyncio.to_thread(cloudinary_call, "ping")
+    except Exception as e:
+        return False, f"ключи не приняты или сервис недоступен: {e}"
+    return True, "ключи приняты"
+
+# -------------------------
+# Sharded run (several Telegram sessions)
+# -------------------------
+def shard_configs(cfg):
+    """
+    Конфиги сессий для параллельного прогона: основной аккаунт (user_session) и аккаунты из TG_SESSIONS.
+    Элемент TG_SESSIONS: {"session": "user_session_2", "TG_API_ID": ..., "TG_API_HASH": "...", "TG_PHONE": "..."}.
+    """
+    shards = [dict(cfg, TG_SESSION="user_session")]
+    for i, extra in enumerate(cfg.get("TG_SESSIONS") or [], start=1):
+        shard = dict(cfg)
+        shard.update({k: v for k, v in extra.items() if k.startswith("TG_")})
+        shard["TG_SESSION"] = extra.get("session") or f"user_session_{i + 1}"
+        shards.append(shard)
+    return shards
+
+def shard_file(path, index):
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard{index}{ext}"
+
+class ShardLogWriter(io.TextIOBase):
+    """stdout процесса-сессии: строки лога уходят в очередь событий координатора с меткой сессии."""
+    def __init__(self, index, events):
+        self.index = index
+        self.events = events
+        self.buf = ""
+
+    def write(self, s):
+        self.buf += s
+        while "\n" in self.buf:
+            line, self.buf = self.buf.split("\n", 1)
+            self.events.put(("log", self.index, f"[S{self.index + 1}] {line}\n" if line else "\n"))
+        return len(s)
+
+    def flush(self):
+        pass
+
+def shard_process_main(index, cfg, history_path, work_queue, events, stop_event, pause_event):
+    """Точка входа процесса-сессии: свой цикл событий, свой файл сессии Telethon."""
+    sys.stdout = sys.stderr = ShardLogWriter(index, events)
+    try:
+        asyncio.run(_shard_main(index, cfg, history_path, work_queue, events, stop_event, pause_event))
+    except Exception as e:
+        lg(f"Сессия {cfg.get('TG_SESSION')}: ошибка {e}\n{traceback.format_exc()}")
+    finally:
+        events.put(("exit", index, None))
+
+async def _shard_main(index, cfg, history_path, work_queue, events, stop_event, pause_event):
+    import queue
+    METRICS.reset()
+    configure_breakers(cfg)
+    wcapi = create_wc_client(cfg)
+    client = create_telegram_client(cfg, session=cfg["TG_SESSION"])
+    history = None
+    media_map = MediaMap(cfg["MEDIA_MAP_FILE"])
+    sku_cache = SkuMessageCache(cfg["SKU_CACHE_FILE"]) if cfg.get("SKU_CACHE_ENABLED", True) else None
+    try:
+        with METRICS.span("telegram_connect"):
+            await client.connect()
+        if not await client.is_user_authorized():
+            lg(f"Сессия {cfg['TG_SESSION']} не авторизована — процесс завершён.")
+            return
+        if history_path:
+            history = HistoryStore(history_path)
+            client = OfflineHistoryClient(client, history)
+        updated_dict = load_updated_products(cfg["UPDATED_FILE"])
+        while not stop_event.is_set():
+            try:
+                product = await asyncio.to_thread(work_queue.get, True, 0.5)
+            except queue.Empty:
+                continue
+            if product is None:
+                break
+            while not pause_event.is_set() and not stop_event.is_set():
+                await asyncio.sleep(0.5)
+            pid = str(product.get("id"))
+            with METRICS.product(pid) as timings:
+                try:
+                    result = await process_one_product(product, wcapi, cfg, updated_dict, None, media_map, client, sku_cache)
+                except Exception as e:
+                    result = {"product_id": pid, "name": product.get("name",""), "error": str(e), "review_reason": "exception"}
+            remember_outcome(updated_dict, result, cfg["UPDATED_FILE"])
+            result["stages"] = timings
+            events.put(("result", index, result, updated_dict.get(pid)))
+            # пауза между товарами у каждой сессии своя: лимиты Telegram считаются на аккаунт
+            for _ in range(int(cfg.get("PAUSE_BETWEEN_PRODUCTS", 15))):
+                if stop_event.is_set(): break
+                await asyncio.sleep(1)
+    finally:
+        if sku_cache:
+            try: sku_cache.save()
+            except Exception: pass
+        try: media_map.save()
+        except Exception: pass
+        try: await client.disconnect()
+        except Exception: pass
+        if history is not None:
+            history.close()
+        if isinstance(wcapi, AsyncWooCommerce):
+            await wcapi.close()
+        events.put(("metrics", index, METRICS.export_raw()))
+
 # -------------------------
 # GUI and Worker
 # -------------------------
+def open_path(path):
+    """Открывает файл программой по умолчанию."""
+    try:
+        if sys.platform.startswith("win"):
+            os.startfile(path)
+        else:
+            import subprocess
+            subprocess.Popen(["open" if sys.platform == "darwin" else "xdg-open", path])
+    except Exception as e:
+        lg(f"Не удалось открыть {path}: {e}")
+
+PROGRESS_REFRESH_MS = 1000  # как часто окно перечитывает ход прогона
+SERVICE_TITLES = {"telegram": "Telegram", "woocommerce": "WooCommerce", "cloudinary": "Cloudinary"}
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600} ч {seconds % 3600 // 60} мин"
+    if seconds >= 60:
+        return f"{seconds // 60} мин {seconds % 60} с"
+    return f"{seconds} с"
+
+def progress_lines(snap, max_active=4):
+    """Строки панели хода синхронизации по progress_snapshot()."""
+    total, done = snap["total"], snap["processed"]
+    head = f"Обработано {done} из {total} ({done * 100 // total}%)" if total else f"Обработано {done}"
+    head += f" · {snap['per_min']:.1f} товаров/мин"
+    if snap["eta_s"] is not None:
+        head += f" · осталось ~{format_duration(snap['eta_s'])}"
+    head += f" · идёт {format_duration(snap['elapsed_s'])}"
+    outcomes = snap["outcomes"]
+    result = (f"Итоги: обновлено {outcomes.get('updated', 0)} · на проверку {outcomes.get('review', 0)} · "
+              f"не удалось {outcomes.get('failed', 0)}")
+    active = sorted(snap["active"].items())
+    now = ", ".join(f"{pid} — {stage or 'между этапами'}" for pid, stage in active[:max_active])
+    if len(active) > max_active:
+        now += f" и ещё {len(active) - max_active}"
+    stages = ", ".join(f"{stage} {n}" for stage, n in sorted(snap["stages"].items(), key=lambda kv: -kv[1]))
+    current = "Сейчас: " + (now or "—") + (f" · по этапам: {stages}" if stages else "")
+    services = []
+    for name, title in SERVICE_TITLES.items():
+        st = snap["services"].get(name, {})
+        text = f"{title} {st.get('per_min', 0.0):.0f} запр./мин"
+        if st.get("state") == "open":
+            text += f" (пауза после ошибок, ещё {format_duration(st.get('retry_in', 0))})"
+        elif st.get("state") == "half_open":
+            text += " (пробный запрос)"
+        services.append(text)
+    return [head, result, current, "Сервисы: " + " · ".join(services)]
+
 class StdoutProxy(io.TextIOBase):
     def __init__(self, write_cb):
         self.write_cb = write_cb
@@ -848,7 +3648,45 @@ HELP_TEXTS = {
     "SKU_TAKE_FIRST_N": "Если >0 — берутся первые N символов после обработки артикула.",
     "VERBOSE_LOG": "Подробный лог (для отладки).",
     "OPERATION_MODE": "Режим работы: комментарии (рекомендуется) или ручной.",
-    "ADDITIONAL_POSTS_POSITION": "Позиция дополнительных постов относительно основного."
+    "ADDITIONAL_POSTS_POSITION": "Позиция дополнительных постов относительно основного.",
+    "METRICS_ENABLED": "Сохранять замеры этапов по итогам прогона (JSON-отчёт и metrics.prom в формате Prometheus).",
+    "METRICS_DIR": "Папка для отчётов с метриками (относительно папки приложения).",
+    "CHECKPOINT_ENABLED": "Контрольные точки: после падения или остановки прогон продолжается с места прерывания, уже загруженные в Cloudinary фото не загружаются повторно.",
+    "CHECKPOINT_FILE": "Файл контрольных точек.",
+    "SKU_CACHE_ENABLED": "Кэш артикул → сообщение Telegram: повторные прогоны не ищут основной пост заново. Перед прогоном кэш пакетно сверяется с Telegram — удалённые и отредактированные посты ищутся заново.",
+    "SKU_CACHE_FILE": "Файл кэша артикул → сообщение Telegram.",
+    "HISTORY_MODE": "off — как раньше, поиск и перебор сообщений по каждому товару в Telegram. takeout — перед прогоном история TG_CHANNEL_ID/COMMENT_GROUP_ID выгружается (докачивается) в локальную базу через takeout-сессию; поиск постов, ответов и альбомов идёт офлайн, в Telegram уходит только скачивание фото.",
+    "HISTORY_STORE_FILE": "Файл локальной истории Telegram (sqlite).",
+    "PHOTO_DEDUP_ENABLED": "Отбрасывать почти одинаковые фото в наборе товара (один снимок в альбоме и в ответах). Освободившиеся места занимают следующие фото.",
+    "PHOTO_DEDUP_METHOD": "Перцептивный хэш для сравнения фото: phash (устойчивее, по умолчанию) или dhash (быстрее, но чаще путает разные простые картинки).",
+    "PHOTO_DEDUP_DISTANCE": "Сколько бит из 64 могут различаться у хэшей, чтобы фото считались одинаковыми (0 — только точные совпадения).",
+    "SKIP_UNCHANGED_SOURCE": "Сравнивать хэш описания и список фото поста с прошлым обновлением товара и не трогать то, что не изменилось (важно для стратегии «Все»). Выключите, чтобы принудительно перезаписать всё.",
+    "WC_ASYNC": "Работать с WooCommerce асинхронно (aiohttp, keep-alive): запросы к сайту не занимают поток и идут параллельно с Telegram. Без aiohttp используется обычный клиент woocommerce.",
+    "WC_MAX_CONNECTIONS": "Сколько соединений с сайтом держать открытыми одновременно.",
+    "CLOUDINARY_CHUNKED_MB": "Файлы от этого размера (МБ) загружаются в Cloudinary частями: при обрыве повторяется только недокачанная часть. 0 — всегда целиком.",
+    "CLOUDINARY_CHUNK_MB": "Размер одной части при загрузке по частям, МБ (не меньше 5).",
+    "CLOUDINARY_FORMAT_MODE": "local — фото перекодируются в JPEG на этом компьютере перед загрузкой. server — загружается исходный файл, формат и качество подбирает Cloudinary при выдаче (см. CLOUDINARY_DELIVERY_TRANSFORM), процессор не тратится.",
+    "CLOUDINARY_DELIVERY_TRANSFORM": "Трансформация доставки для режима server, добавляется в URL фото на сайте (по умолчанию f_auto,q_auto).",
+    "TG_SESSIONS": "Дополнительные аккаунты Telegram для параллельного прогона: список объектов {\"session\": \"user_session_2\", \"TG_API_ID\": ..., \"TG_API_HASH\": \"...\", \"TG_PHONE\": \"...\"}. Если список не пуст, товары делятся между основным и этими аккаунтами, каждый работает в своём процессе. Вход в аккаунты выполняется в начале прогона.",
+    "SHARD_START_METHOD": "Как запускать процессы сессий TG_SESSIONS: spawn (по умолчанию, работает везде), fork или forkserver (только Linux/macOS; fork стартует быстрее).",
+    "PRODUCT_PRIORITY": "Порядок обработки товаров — ключи через запятую, первый важнее: no_images (сначала товары без фото), recently_modified (недавно изменённые), best_selling (больше продаж), previously_failed (не получившиеся в прошлый раз). Пусто — в порядке, в котором отдаёт сайт. Полезно, когда прогон прерывают или ограничивают по времени.",
+    "REPORT_DIR": "Папка для построчного отчёта по товарам (CSV и JSONL пишутся по ходу прогона).",
+    "DESC_FAST_PATH": "Когда обновляется только описание: не трогать фото вовсе, ждать между товарами короткую паузу DESC_FAST_PAUSE вместо обычной и отправлять описания на сайт пачками.",
+    "DESC_FAST_PAUSE": "Пауза между товарами (сек) в быстром режиме «только описание»: поиск поста всё равно идёт в Telegram, пауза бережёт лимиты аккаунта. 0 — без паузы.",
+    "WC_BATCH_SIZE": "Сколько товаров отправлять одним запросом products/batch (не больше 100).",
+    "SKU_BULK_MATCH": "При выгруженной истории: сопоставить все артикулы каталога с постами за один проход по текстам вместо поиска для каждого товара.",
+    "CLOUDINARY_STABLE_IDS": "Имя файла в Cloudinary по хэшу содержимого: уже загруженное фото (в том числе с другого компьютера) не загружается повторно, повторы не создают дублей.",
+    "BREAKER_THRESHOLD": "Сколько ошибок подряд у Telegram, Cloudinary или сайта считать отказом сервиса: дальше товары сразу уходят в ручную проверку без запросов.",
+    "BREAKER_COOLDOWN": "Через сколько секунд после отказа пробовать сервис снова (один пробный запрос; при успехе работа продолжается).",
+    "WC_SHOPS": "Дополнительные магазины WooCommerce с тем же источником в Telegram: список объектов {\"name\": \"shop2\", \"WC_URL\": \"...\", \"WC_KEY\": \"...\", \"WC_SECRET\": \"...\"}. Пост ищется, фото скачиваются и загружаются в Cloudinary один раз, описание и фото пишутся во все магазины, где есть артикул. У каждого магазина свой файл обновлённых товаров.",
+    "RECORD_CASSETTE": "Папка для записи прогона (кассеты): ответы Telegram, WooCommerce и Cloudinary, скачанные фото и исходные файлы состояния. Ключи и пароли из настроек в запись не попадают. Кассету можно воспроизвести без сети: python -m benchmarks.replay <папка кассеты>. Пусто — не записывать. Во время записи прогон идёт одной сессией Telegram.",
+    "PROFILE_MODE": "Профилирование прогона: off — выключено; cprofile — полный профиль cProfile (файл .prof для snakeviz/flameprof); sample — сэмплы стека потока синхронизации раз в PROFILE_SAMPLE_MS мс (файл .folded для flamegraph.pl/speedscope), почти без замедления. Файлы — в папке метрик. Можно включить и из командной строки: main.py --profile sample.",
+    "PROFILE_SAMPLE_MS": "Интервал сэмплирования для PROFILE_MODE=sample, мс.",
+    "SLOW_CALLBACK_MS": "Поиск блокировок: если цикл событий занят одним синхронным вызовом дольше этого (мс), в лог пишется его стек; включается и режим отладки asyncio с предупреждениями о медленных колбэках. 0 — выключено. Из командной строки: main.py --slow-callback-ms 100.",
+    "PREFLIGHT_ENABLED": "Перед прогоном одновременно проверить вход в Telegram и доступ к чатам, ключи WooCommerce (всех магазинов) и Cloudinary. При ошибке прогон не начинается, в логе — что именно не так.",
+    "PREFLIGHT_TIMEOUT": "Сколько секунд ждать ответа сервиса при проверке перед прогоном.",
+    "RETRY_REASONS": "Для кнопки «Повторить неудачные»: какие причины повторять, через запятую (not_found, update_failed, exception, missing_comment_group, circuit_open, error). Пусто — все.",
+    "MEDIA_MAP_FILE": "Соответствие Cloudinary URL / хэша фото → id медиафайла WordPress. Известные фото прикрепляются по id, без повторного скачивания и нарезки миниатюр на сервере магазина."
 }
 
 class SettingsDialog(tk.Toplevel):
@@ -933,12 +3771,19 @@ class SettingsDialog(tk.Toplevel):
         self.var_strategy = tk.StringVar(value=STRATEGY_OPTIONS.get(self.cfg.get("UPDATE_STRATEGY","only_new"), "Только новые"))
         self.var_what = tk.StringVar(value=WHAT_OPTIONS.get(self.cfg.get("UPDATE_WHAT","both"), "Описание и фото"))
         self.var_stop_words = tk.StringVar(value=",".join(self.cfg.get("STOP_WORDS",[])))
+        self.var_product_priority = tk.StringVar(value=self.cfg.get("PRODUCT_PRIORITY", ""))
         self.var_sku_prefer = tk.BooleanVar(value=self.cfg.get("SKU_PREFER_SITE_FIELD", True))
         self.var_sku_n = tk.IntVar(value=self.cfg.get("SKU_TAKE_FIRST_N", 6))
         self.var_cloud_name = tk.StringVar(value=self.cfg.get("CLOUDINARY_CLOUD_NAME",""))
         self.var_cloud_key = tk.StringVar(value=self.cfg.get("CLOUDINARY_API_KEY",""))
         self.var_cloud_secret = tk.StringVar(value=self.cfg.get("CLOUDINARY_API_SECRET",""))
         self.var_verbose = tk.BooleanVar(value=self.cfg.get("VERBOSE_LOG", False))
+        self.var_metrics = tk.BooleanVar(value=self.cfg.get("METRICS_ENABLED", True))
+        self.var_checkpoint = tk.BooleanVar(value=self.cfg.get("CHECKPOINT_ENABLED", True))
+        self.var_history_mode = tk.StringVar(value=self.cfg.get("HISTORY_MODE", "off"))
+        self.var_photo_dedup = tk.BooleanVar(value=self.cfg.get("PHOTO_DEDUP_ENABLED", True))
+        self.var_skip_unchanged = tk.BooleanVar(value=self.cfg.get("SKIP_UNCHANGED_SOURCE", True))
+        self.var_format_mode = tk.StringVar(value=self.cfg.get("CLOUDINARY_FORMAT_MODE", "local"))
         self.var_operation_mode = tk.StringVar(value=self.cfg.get("OPERATION_MODE","comments"))
         self.var_operation_mode_display = tk.StringVar(value=OPERATION_MODE_OPTIONS.get(self.var_operation_mode.get()))
         self.var_additional_pos = tk.StringVar(value=self.cfg.get("ADDITIONAL_POSTS_POSITION","after"))
@@ -975,6 +3820,9 @@ class SettingsDialog(tk.Toplevel):
         add_row("UPDATE_WHAT", "Что обновлять", ttk.Combobox(frm, values=list(WHAT_OPTIONS.values()), textvariable=self.var_what, state="readonly", width=40))
 
         add_row("STOP_WORDS", "Стоп-слова (через запятую)", ttk.Entry(frm, textvariable=self.var_stop_words, width=60))
+        add_row("PRODUCT_PRIORITY", "Порядок товаров (через запятую)", ttk.Entry(frm, textvariable=self.var_product_priority, width=60))
+        self.var_retry_reasons = tk.StringVar(value=self.cfg.get("RETRY_REASONS", ""))
+        add_row("RETRY_REASONS", "Повторять причины (через запятую)", ttk.Entry(frm, textvariable=self.var_retry_reasons, width=60))
         add_row("SKU_PREFER_SITE_FIELD", "Предпочитать sku с сайта", ttk.Checkbutton(frm, variable=self.var_sku_prefer))
         add_row("SKU_TAKE_FIRST_N", "Взять первые N символов артикула (например 6)", ttk.Spinbox(frm, from_=0, to=50, textvariable=self.var_sku_n, width=8))
 
@@ -984,6 +3832,20 @@ class SettingsDialog(tk.Toplevel):
         add_row("CLOUDINARY_API_KEY", "Cloudinary API key", ttk.Entry(frm, textvariable=self.var_cloud_key, width=40))
         add_row("CLOUDINARY_API_SECRET", "Cloudinary API secret", ttk.Entry(frm, textvariable=self.var_cloud_secret, width=40))
         add_row("VERBOSE_LOG", "Подробный лог (отладка)", ttk.Checkbutton(frm, variable=self.var_verbose))
+        add_row("METRICS_ENABLED", "Сохранять метрики этапов", ttk.Checkbutton(frm, variable=self.var_metrics))
+        add_row("CHECKPOINT_ENABLED", "Продолжать прерванный прогон", ttk.Checkbutton(frm, variable=self.var_checkpoint))
+        add_row("PHOTO_DEDUP_ENABLED", "Убирать похожие фото", ttk.Checkbutton(frm, variable=self.var_photo_dedup))
+        add_row("SKIP_UNCHANGED_SOURCE", "Пропускать неизменившиеся посты", ttk.Checkbutton(frm, variable=self.var_skip_unchanged))
+        self.var_desc_fast = tk.BooleanVar(value=self.cfg.get("DESC_FAST_PATH", True))
+        add_row("DESC_FAST_PATH", "Быстрый режим «только описание»", ttk.Checkbutton(frm, variable=self.var_desc_fast))
+        add_row("CLOUDINARY_FORMAT_MODE", "Перекодирование фото (local/server)", ttk.Combobox(frm, values=["local", "server"], textvariable=self.var_format_mode, state="readonly", width=18))
+        add_row("HISTORY_MODE", "Локальная история Telegram (off/takeout)", ttk.Combobox(frm, values=["off", "takeout"], textvariable=self.var_history_mode, state="readonly", width=18))
+        self.var_preflight = tk.BooleanVar(value=self.cfg.get("PREFLIGHT_ENABLED", True))
+        add_row("PREFLIGHT_ENABLED", "Проверять доступы перед запуском", ttk.Checkbutton(frm, variable=self.var_preflight))
+        self.var_profile_mode = tk.StringVar(value=self.cfg.get("PROFILE_MODE", "off"))
+        add_row("PROFILE_MODE", "Профилирование (off/cprofile/sample)", ttk.Combobox(frm, values=list(PROFILE_MODES), textvariable=self.var_profile_mode, state="readonly", width=18))
+        self.var_slow_callback = tk.IntVar(value=int(self.cfg.get("SLOW_CALLBACK_MS", 0) or 0))
+        add_row("SLOW_CALLBACK_MS", "Порог блокировки цикла, мс (0 — выкл.)", ttk.Spinbox(frm, from_=0, to=10000, increment=50, textvariable=self.var_slow_callback, width=8))
 
         btns = ttk.Frame(frm)
         ttk.Button(btns, text="Сохранить", command=self._save).pack(side="left")
@@ -1052,6 +3914,8 @@ class SettingsDialog(tk.Toplevel):
         cfg["PHOTO_SOURCE_FORCED"] = self.var_photo_forced.get().strip()
         cfg["PHOTO_SOURCE_PRIORITY"] = self.var_photo_priority.get().strip()
         cfg["DESCRIPTION_SOURCE_PRIORITY"] = self.var_desc_priority.get().strip()
+        cfg["PRODUCT_PRIORITY"] = self.var_product_priority.get().strip()
+        cfg["RETRY_REASONS"] = self.var_retry_reasons.get().strip()
         cfg["UPDATE_STRATEGY"] = STRATEGY_OPTIONS_INV.get(self.var_strategy.get(), cfg.get("UPDATE_STRATEGY","only_new"))
         cfg["UPDATE_WHAT"] = WHAT_OPTIONS_INV.get(self.var_what.get(), cfg.get("UPDATE_WHAT","both"))
         sw = self.var_stop_words.get() or ""
@@ -1062,6 +3926,16 @@ class SettingsDialog(tk.Toplevel):
         cfg["CLOUDINARY_API_KEY"] = self.var_cloud_key.get().strip()
         cfg["CLOUDINARY_API_SECRET"] = self.var_cloud_secret.get().strip()
         cfg["VERBOSE_LOG"] = bool(self.var_verbose.get())
+        cfg["METRICS_ENABLED"] = bool(self.var_metrics.get())
+        cfg["CHECKPOINT_ENABLED"] = bool(self.var_checkpoint.get())
+        cfg["HISTORY_MODE"] = self.var_history_mode.get() or "off"
+        cfg["PHOTO_DEDUP_ENABLED"] = bool(self.var_photo_dedup.get())
+        cfg["SKIP_UNCHANGED_SOURCE"] = bool(self.var_skip_unchanged.get())
+        cfg["DESC_FAST_PATH"] = bool(self.var_desc_fast.get())
+        cfg["CLOUDINARY_FORMAT_MODE"] = self.var_format_mode.get() or "local"
+        cfg["PREFLIGHT_ENABLED"] = bool(self.var_preflight.get())
+        cfg["PROFILE_MODE"] = self.var_profile_mode.get() or "off"
+        cfg["SLOW_CALLBACK_MS"] = int(self.var_slow_callback.get())
         pos_display = self.var_additional_pos_display.get()
         cfg["ADDITIONAL_POSTS_POSITION"] = ADDITIONAL_POSTS_POS_INV.get(pos_display, cfg.get("ADDITIONAL_POSTS_POSITION","after"))
         save_settings(cfg)
@@ -1075,6 +3949,8 @@ class SyncWorker(threading.Thread):
         self.ask_input = ask_input_cb
         self.finish_cb = finish_cb
         self.stop_flag = False
+        self.report = None
+        self.report_paths = []
         self.pause_event = threading.Event()
         self.pause_event.set()
 
@@ -1115,10 +3991,11 @@ class SyncWorker(threading.Thread):
         try:
             os.chdir(APP_DIR)
             ulog("=== СИНХРОНИЗАЦИЯ ЗАПУЩЕНА ===")
-            asyncio.run(self._main())
+            run_profiled(self._main, self.cfg)
         except Exception as e:
             lg(f"ГЛАВНАЯ ОШИБКА: {e}\n{traceback.format_exc()}")
         finally:
+            RECORDER.stop()
             self._restore_input_hooks()
             sys.stdout, sys.stderr = old_out, old_err
             try:
@@ -1131,84 +4008,487 @@ class SyncWorker(threading.Thread):
         while not self.pause_event.is_set():
             await asyncio.sleep(0.5)
 
-    async def _main(self):
-        cfg = self.cfg.copy()
-        wcapi = None
-        if WC_API_Class:
+    async def _connect_telegram(self, cfg):
+        """Один клиент Telethon на весь прогон; при ошибке — None (товары подключаются сами, как раньше)."""
+        client = create_telegram_client(cfg)
+        if RECORDER.active:
+            client = RecordingTelegramClient(client, RECORDER)
+        client = CountingTelegramClient(client)
+        try:
+            with METRICS.span("telegram_connect"):
+                await client.start(phone=cfg.get("TG_PHONE"))
+            return client
+        except Exception as e:
+            lg(f"Ошибка подключения к Telegram: {e}")
+            try: await client.disconnect()
+            except Exception: pass
+            return None
+
+    async def _preflight(self, cfg, wcapi):
+        """
+        Проверка перед прогоном: вход в Telegram и доступ к чатам, ключи WooCommerce (всех магазинов)
+        и Cloudinary — одновременно. Возвращает (клиент Telegram или None, всё ли в порядке).
+        """
+        timeout = float(cfg.get("PREFLIGHT_TIMEOUT", 20) or 20)
+        extra = []
+        for shop in shop_configs(cfg)[1:]:
             try:
-                wcapi = WC_API_Class(
-                    url=cfg.get("WC_URL").rstrip("/"),
-                    consumer_key=cfg.get("WC_KEY"),
-                    consumer_secret=cfg.get("WC_SECRET"),
-                    version="wc/v3",
-                    timeout=60
-                )
-                lg("WC client created.", False)
+                extra.append((shop["WC_SHOP_NAME"], create_wc_client(shop)))
             except Exception as e:
-                lg(f"Ошибка создания WC клиента: {e}")
-                wcapi = None
+                lg(f"Магазин {shop['WC_SHOP_NAME']}: ошибка создания WC клиента: {e}")
+                extra.append((shop["WC_SHOP_NAME"], None))
+
+        async def telegram():
+            # вход может ждать код из окна ввода, поэтому время ограничено только для проверки чатов
+            client = await self._connect_telegram(cfg)
+            return client, await preflight_timed(preflight_telegram(client, cfg), timeout)
+
+        with METRICS.span("preflight"):
+            (client, tg), *checks = await asyncio.gather(
+                telegram(),
+                preflight_timed(preflight_woocommerce(wcapi), timeout),
+                preflight_timed(preflight_cloudinary(cfg), timeout),
+                *(preflight_timed(preflight_woocommerce(api), timeout) for _, api in extra),
+            )
+        for _, api in extra:
+            if isinstance(api, AsyncWooCommerce):
+                await api.close()
+        names = ["Telegram", "WooCommerce", "Cloudinary"] + [f"WooCommerce ({name})" for name, _ in extra]
+        results = list(zip(names, [tg] + checks))
+        ulog("Проверка перед запуском:")
+        for name, (ok, message) in results:
+            ulog(f"  {name}: {'OK' if ok else 'ОШИБКА'} — {message}")
+        return client, all(ok for _, (ok, _) in results)
+
+    def _record_result(self, result):
+        if result.get("review_reason"):
+            outcome = "review"
+        elif result.get("updated"):
+            outcome = "updated"
         else:
-            lg("woocommerce библиотека не установлена; обновления на сайт не будут работать.")
+            outcome = "failed"
+        METRICS.count_outcome(outcome)
+        if self.report is not None:
+            try:
+                self.report.add(result, outcome)
+            except Exception as e:
+                lg(f"Не удалось записать отчёт по товару {result.get('product_id')}: {e}")
 
-        all_products = get_all_products(wcapi)
-        updated_list = []
-        failed_list = []
-        review_list = []
-        updated_dict = load_updated_products(cfg.get("UPDATED_FILE","updated_products.json"))
+    async def _authorize_session(self, shard):
+        """Вход в дополнительный аккаунт здесь, пока есть окно для кода; процессы-сессии получают готовый файл сессии."""
+        client = create_telegram_client(shard, session=shard["TG_SESSION"])
+        try:
+            await client.start(phone=shard.get("TG_PHONE"))
+            return True
+        except Exception as e:
+            lg(f"Сессия {shard['TG_SESSION']}: вход не удался ({e}) — она не участвует в прогоне.")
+            return False
+        finally:
+            try: await client.disconnect()
+            except Exception: pass
 
-        for product in all_products:
+    async def _run_shops(self, cfg, shops, main_target, client, checkpoints, sku_cache, done_ids):
+        """Режим нескольких магазинов: каталоги всех магазинов, общий поиск и загрузка, запись в каждый магазин."""
+        targets = [main_target]
+        for shop in shops[1:]:
+            try:
+                wcapi = create_wc_client(shop)
+            except Exception as e:
+                lg(f"Магазин {shop['WC_SHOP_NAME']}: ошибка создания WC клиента: {e}")
+                continue
+            targets.append(ShopTarget(shop, wcapi))
+        catalogs = await asyncio.gather(*(load_catalog(t.wcapi, t.cfg) for t in targets[1:]))
+        for target, products in zip(targets[1:], catalogs):
+            target.products = products
+        ulog("Магазины: " + ", ".join(f"{t.name} — {len(t.products)} товаров" for t in targets))
+        groups = group_by_article(targets, cfg)
+        try:
+            for key, article, products in groups:
+                if self.stop_flag:
+                    ulog("Остановка синхронизации по запросу.")
+                    break
+                if key in done_ids:
+                    continue
+                await self._wait_if_paused()
+                with METRICS.product(key) as timings:
+                    try:
+                        results = await fan_out_article(article, products, targets, cfg, client, sku_cache)
+                    except Exception as e:
+                        results = [(targets[i], {"product_id": str(p.get("id")), "name": p.get("name",""), "shop": targets[i].name,
+                                                 "error": str(e), "review_reason": "exception"}) for i, p in products.items()]
+                for target, result in results:
+                    remember_outcome(target.updated_dict, result, target.cfg.get("UPDATED_FILE","updated_products.json"))
+                    result["stages"] = timings
+                    self._record_result(result)
+                if checkpoints:
+                    checkpoints.mark_done(key)
+                wait = int(cfg.get("PAUSE_BETWEEN_PRODUCTS", 15))
+                ulog(f"Ожидание {wait}s перед следующим товаром (можно приостановить).")
+                for _ in range(wait):
+                    if self.stop_flag: break
+                    await self._wait_if_paused()
+                    await asyncio.sleep(1)
+        finally:
+            for target in targets[1:]:
+                try:
+                    target.media_map.save()
+                except Exception as e:
+                    lg(f"Не удалось сохранить {target.media_map.path}: {e}")
+                if isinstance(target.wcapi, AsyncWooCommerce):
+                    await target.wcapi.close()
+
+    async def _run_description_only(self, cfg, products, wcapi, client, updated_dict, checkpoints, sku_cache, done_ids):
+        """Быстрый прогон «только описание»: без медиа, с короткой паузой между товарами, запись на сайт пачками."""
+        ulog("Режим «только описание»: фото не ищутся, описания отправляются пачками.")
+        batch = DescriptionBatch(wcapi, cfg.get("WC_BATCH_SIZE", 50))
+        updated_file = cfg.get("UPDATED_FILE", "updated_products.json")
+
+        async def flush():
+            results = await batch.flush()
+            if not results:
+                return
+            apply_description_results(results, updated_dict, cfg)
+            for result in results:
+                remember_outcome(updated_dict, result, updated_file)
+                self._record_result(result)
+                if checkpoints:
+                    checkpoints.mark_done(result["product_id"])
+
+        for product in products:
             if self.stop_flag:
                 ulog("Остановка синхронизации по запросу.")
                 break
+            if str(product.get("id")) in done_ids:
+                continue
             await self._wait_if_paused()
-            try:
-                result = await process_one_product(product, wcapi, cfg, updated_dict)
-            except Exception as e:
-                result = {"product_id": str(product.get("id")), "name": product.get("name",""), "error": str(e), "review_reason": "exception"}
-            if result.get("review_reason"):
-                review_list.append(result)
-            elif result.get("updated"):
-                updated_list.append(result)
-            else:
-                failed_list.append(result)
-            wait = int(cfg.get("PAUSE_BETWEEN_PRODUCTS", 15))
-            ulog(f"Ожидание {wait}s перед следующим товаром (можно приостановить).")
-            for _ in range(wait):
+            with METRICS.product(product.get("id")) as timings:
+                try:
+                    result, data = await prepare_description_only(product, cfg, updated_dict, client, sku_cache)
+                except Exception as e:
+                    result, data = {"product_id": str(product.get("id")), "name": product.get("name",""), "error": str(e), "review_reason": "exception"}, None
+            result["stages"] = timings
+            if data is None:
+                remember_outcome(updated_dict, result, updated_file)
+                self._record_result(result)
+                if checkpoints:
+                    checkpoints.mark_done(product.get("id"))
+            elif batch.add(result, data):
+                await flush()
+            # пачками уходит только запись на сайт; поиск поста — запрос к Telegram на каждый товар
+            for _ in range(int(cfg.get("DESC_FAST_PAUSE", 3))):
                 if self.stop_flag: break
                 await self._wait_if_paused()
                 await asyncio.sleep(1)
+        # при остановке уже подготовленные описания всё равно отправляем
+        await flush()
+
+    async def _run_shards(self, cfg, shards, products, updated_dict, checkpoints, media_map, sku_cache, history_path):
+        """
+        Параллельный прогон: каждая сессия Telegram — отдельный процесс со своим циклом событий.
+        Товары раздаются через общую очередь; результаты, записи updated_dict и отметки контрольной точки
+        пишет только этот (координирующий) процесс, поэтому общий журнал прогона не перезаписывается вразнобой.
+        """
+        import queue
+        import shutil
+        import multiprocessing
+        ctx = multiprocessing.get_context(cfg.get("SHARD_START_METHOD", "spawn"))
+        work = ctx.Queue(maxsize=len(shards) * 2)
+        events = ctx.Queue()
+        stop_event = ctx.Event()
+        pause_event = ctx.Event()
+        pause_event.set()
+
+        save_updated_products(updated_dict, cfg.get("UPDATED_FILE","updated_products.json"))
+        media_map.save()
+        if sku_cache:
+            sku_cache.save()
+        procs = []
+        shard_files = []
+        for i, shard in enumerate(shards):
+            if i > 0 and not await self._authorize_session(shard):
+                continue
+            shard = dict(shard, CHECKPOINT_ENABLED=False)
+            for key, default in (("UPDATED_FILE", "updated_products.json"), ("MEDIA_MAP_FILE", "wc_media_map.json"),
+                                 ("SKU_CACHE_FILE", "sku_message_cache.json")):
+                src = cfg.get(key, default)
+                shard[key] = shard_file(src, i)
+                if os.path.exists(src):
+                    shutil.copyfile(src, shard[key])
+                shard_files.append((key, shard[key]))
+            procs.append(ctx.Process(target=shard_process_main, daemon=True,
+                                     args=(i, shard, history_path, work, events, stop_event, pause_event)))
+        ulog(f"Параллельный прогон: сессий Telegram — {len(procs)}.")
+        for proc in procs:
+            proc.start()
+
+        async def put(item):
+            while True:
+                try:
+                    await asyncio.to_thread(work.put, item, True, 0.5)
+                    return True
+                except queue.Full:
+                    if stop_event.is_set() or not any(p.is_alive() for p in procs):
+                        return False
+
+        async def feed():
+            for product in products:
+                if self.stop_flag:
+                    ulog("Остановка синхронизации по запросу.")
+                    break
+                await self._wait_if_paused()
+                if not await put(product):
+                    break
+            for _ in procs:
+                await put(None)
+
+        feeder = asyncio.ensure_future(feed())
+        alive = len(procs)
+        while alive:
+            if self.stop_flag:
+                stop_event.set()
+            if self.is_paused():
+                pause_event.clear()
+            else:
+                pause_event.set()
+            try:
+                kind, index, *payload = await asyncio.to_thread(events.get, True, 0.5)
+            except queue.Empty:
+                if not any(p.is_alive() for p in procs):
+                    break
+                continue
+            if kind == "log":
+                sys.stdout.write(payload[0])
+            elif kind == "result":
+                result, entry = payload
+                pid = str(result.get("product_id"))
+                if entry is not None:
+                    updated_dict[pid] = entry
+                    save_updated_products(updated_dict, cfg.get("UPDATED_FILE","updated_products.json"))
+                self._record_result(result)
+                if checkpoints:
+                    checkpoints.mark_done(pid)
+            elif kind == "metrics":
+                METRICS.merge_raw(payload[0])
+            elif kind == "exit":
+                alive -= 1
+        stop_event.set()
+        await feeder
+        for proc in procs:
+            await asyncio.to_thread(proc.join, 5)
+
+        # соответствия фото и кэш артикулов, накопленные сессиями, сливаем в общие файлы
+        for key, path in shard_files:
+            if not os.path.exists(path):
+                continue
+            try:
+                if key == "MEDIA_MAP_FILE":
+                    other = MediaMap(path)
+                    media_map.by_hash.update(other.by_hash)
+                    media_map.by_url.update(other.by_url)
+                elif key == "SKU_CACHE_FILE" and sku_cache:
+                    sku_cache.entries.update(SkuMessageCache(path).entries)
+                os.remove(path)
+            except Exception as e:
+                lg(f"Не удалось объединить {path}: {e}")
+        media_map.save()
+
+    async def _main(self):
+        cfg = self.cfg.copy()
+        METRICS.reset()
+        configure_breakers(cfg)
+        if cfg.get("RECORD_CASSETTE"):
+            try:
+                ulog(f"Прогон записывается в кассету: {RECORDER.start(cfg['RECORD_CASSETTE'], cfg)}")
+            except Exception as e:
+                lg(f"Не удалось начать запись прогона: {e}")
+        wcapi = None
+        try:
+            wcapi = create_wc_client(cfg)
+            if wcapi is not None:
+                lg("WC client created.", False)
+        except Exception as e:
+            lg(f"Ошибка создания WC клиента: {e}")
+            wcapi = None
+
+        # каталог читается, пока подключается Telegram: оба ждут сеть, а не друг друга
+        catalog = asyncio.ensure_future(load_catalog(wcapi, cfg))
+        if cfg.get("PREFLIGHT_ENABLED", True):
+            client, ready = await self._preflight(cfg, wcapi)
+            if not ready:
+                catalog.cancel()
+                ulog("Запуск остановлен: исправьте настройки и запустите синхронизацию снова.")
+                if client is not None:
+                    try: await client.disconnect()
+                    except Exception: pass
+                if isinstance(wcapi, AsyncWooCommerce):
+                    await wcapi.close()
+                self.report = None
+                self.report_paths = []
+                RECORDER.stop()
+                return
+        else:
+            client = await self._connect_telegram(cfg) if wcapi is not None else None
+        all_products = await catalog
+        if client is not None and not all_products:
+            try: await client.disconnect()
+            except Exception: pass
+            client = None
+        self.report = None
+        self.report_paths = []
+        try:
+            self.report = RunReport(cfg.get("REPORT_DIR", "reports"))
+            self.report_paths = [self.report.csv_path, self.report.jsonl_path]
+        except Exception as e:
+            lg(f"Не удалось создать файл отчёта: {e}")
+        updated_dict = load_updated_products(cfg.get("UPDATED_FILE","updated_products.json"))
+        if cfg.get("PRODUCT_PRIORITY"):
+            all_products = order_products(all_products, cfg, updated_dict)
+            ulog(f"Очередь товаров упорядочена по: {cfg.get('PRODUCT_PRIORITY')}")
+        media_map = MediaMap(cfg.get("MEDIA_MAP_FILE", "wc_media_map.json"))
+        checkpoints = None
+        done_ids = set()
+        if cfg.get("CHECKPOINT_ENABLED", True):
+            checkpoints = CheckpointStore(cfg.get("CHECKPOINT_FILE", "checkpoint.json"))
+            done_ids = checkpoints.start_run(run_signature(cfg))
+            if done_ids:
+                ulog(f"Продолжаем прерванный прогон: {len(done_ids)} товаров уже обработано и будут пропущены.")
+        METRICS.set_total(sum(1 for p in all_products if str(p.get("id")) not in done_ids))
+
+        history = None
+        if client is not None and cfg.get("HISTORY_MODE", "off") == "takeout":
+            try:
+                history = HistoryStore(cfg.get("HISTORY_STORE_FILE", "tg_history.sqlite3"))
+                ulog("Выгрузка истории Telegram (takeout)...")
+                with METRICS.span("history_crawl"):
+                    added = await crawl_history(client, cfg, history)
+                ulog(f"История Telegram: новых сообщений {added}; поиск по товарам идёт по локальной копии.")
+                client = OfflineHistoryClient(client, history)
+                if cfg.get("SKU_BULK_MATCH", True):
+                    quiet = dict(cfg, VERBOSE_LOG=False)
+                    articles = [extract_site_article(p, quiet) for p in all_products]
+                    chat_ids = [entity_key(e) for e in (await resolve_entities(client, cfg)).values() if e is not None]
+                    with METRICS.span("sku_bulk_match"):
+                        matched = build_sku_index(history, chat_ids, articles)
+                    ulog(f"Артикулы сопоставлены с постами истории за один проход: найдено {matched}.")
+            except Exception as e:
+                lg(f"Выгрузка истории не удалась, работаем напрямую с Telegram: {e}")
+                if history is not None:
+                    history.close()
+                    history = None
+        sku_cache = SkuMessageCache(cfg.get("SKU_CACHE_FILE", "sku_message_cache.json")) if cfg.get("SKU_CACHE_ENABLED", True) else None
+        if client is not None and sku_cache and sku_cache.entries:
+            quiet = dict(cfg, VERBOSE_LOG=False)
+            articles = [extract_site_article(p, quiet) for p in all_products]
+            with METRICS.span("sku_cache_validate"):
+                valid, dropped = await sku_cache.validate(client, await resolve_entities(client, cfg), articles)
+            ulog(f"Кэш артикулов: актуальных записей {valid}, устаревших/удалённых {dropped}.")
+
+        shops = shop_configs(cfg)
+        shards = shard_configs(cfg) if client is not None and len(shops) == 1 and not RECORDER.active else []
+        if len(shops) > 1 and cfg.get("TG_SESSIONS"):
+            ulog("Несколько магазинов: прогон идёт одной сессией Telegram, TG_SESSIONS не используются.")
+        elif RECORDER.active and cfg.get("TG_SESSIONS"):
+            ulog("Запись прогона: работаем одной сессией Telegram, TG_SESSIONS не используются.")
+        if len(shards) > 1:
+            # файл основной сессии переходит процессу первой сессии — здесь клиент больше не нужен
+            try: await client.disconnect()
+            except Exception: pass
+            client = None
+            history_path = cfg.get("HISTORY_STORE_FILE", "tg_history.sqlite3") if history is not None else None
+            todo = [p for p in all_products if str(p.get("id")) not in done_ids]
+            await self._run_shards(cfg, shards, todo, updated_dict, checkpoints, media_map, sku_cache, history_path)
+        elif client is not None and len(shops) > 1:
+            main_target = ShopTarget(shops[0], wcapi, all_products, updated_dict, media_map)
+            await self._run_shops(cfg, shops, main_target, client, checkpoints, sku_cache, done_ids)
+        elif client is not None and description_only(cfg) and cfg.get("DESC_FAST_PATH", True):
+            await self._run_description_only(cfg, all_products, wcapi, client, updated_dict, checkpoints, sku_cache, done_ids)
+        else:
+            for product in all_products:
+                if self.stop_flag:
+                    ulog("Остановка синхронизации по запросу.")
+                    break
+                if str(product.get("id")) in done_ids:
+                    continue
+                await self._wait_if_paused()
+                with METRICS.product(product.get("id")) as timings:
+                    try:
+                        result = await process_one_product(product, wcapi, cfg, updated_dict, checkpoints, media_map, client, sku_cache)
+                    except Exception as e:
+                        result = {"product_id": str(product.get("id")), "name": product.get("name",""), "error": str(e), "review_reason": "exception"}
+                remember_outcome(updated_dict, result, cfg.get("UPDATED_FILE","updated_products.json"))
+                result["stages"] = timings
+                self._record_result(result)
+                if checkpoints:
+                    checkpoints.mark_done(product.get("id"))
+                wait = int(cfg.get("PAUSE_BETWEEN_PRODUCTS", 15))
+                ulog(f"Ожидание {wait}s перед следующим товаром (можно приостановить).")
+                for _ in range(wait):
+                    if self.stop_flag: break
+                    await self._wait_if_paused()
+                    await asyncio.sleep(1)
+
+        if checkpoints and not self.stop_flag:
+            checkpoints.finish_run()
+        if sku_cache:
+            try:
+                sku_cache.save()
+            except Exception as e:
+                lg(f"Не удалось сохранить кэш артикулов: {e}")
+        if client is not None:
+            try: await client.disconnect()
+            except Exception: pass
+        if history is not None:
+            history.close()
+        if isinstance(wcapi, AsyncWooCommerce):
+            await wcapi.close()
 
         # Summary report
         ulog("\n=== ОТЧЁТ ПО РАБОТЕ ===")
         ulog(f"Всего обработано: {len(all_products)}")
-        ulog(f"Успешно обновлено: {len(updated_list)}")
-        if updated_list:
-            ulog("Список обновлённых товаров (название — id):")
-            for r in updated_list:
-                ulog(f"  - {r.get('name','(без названия)')} — id={r.get('product_id')} (фото: {r.get('photos_count')})")
-        if failed_list:
-            ulog(f"Не удалось обновить: {len(failed_list)}")
-            for r in failed_list:
-                ulog(f"  - {r.get('name','(без названия)')} — id={r.get('product_id')} причина: {r.get('error') or 'обновление не прошло'}")
-        if review_list:
-            ulog(f"Требуют ручной проверки: {len(review_list)}")
-            for r in review_list:
-                reason = r.get("review_reason") or r.get("error") or "неизвестно"
-                ulog(f"  - {r.get('name','(без названия)')} — id={r.get('product_id')} причина: {reason}")
+        if self.report is not None:
+            self.report.close()
+            for line in self.report.summary_lines():
+                ulog(line)
+            ulog(f"Список товаров с итогами: {self.report.csv_path} (и {os.path.basename(self.report.jsonl_path)})")
+
+        stage_lines = METRICS.summary_lines()
+        if stage_lines:
+            ulog("Время по этапам (чистое, без вложенных этапов):")
+            for line in stage_lines:
+                ulog(line)
+        if cfg.get("METRICS_ENABLED", True):
+            try:
+                json_path, prom_path = METRICS.write_reports(cfg.get("METRICS_DIR", "reports"))
+                ulog(f"Метрики сохранены: {json_path}, {prom_path}")
+            except Exception as e:
+                lg(f"Не удалось сохранить метрики: {e}")
+
+        if RECORDER.active:
+            ulog(f"Кассета записана: {RECORDER.directory} ({RECORDER.count} вызовов)")
+            RECORDER.stop(METRICS.to_json()["outcomes"])
 
         ulog("=== КОНЕЦ ОТЧЁТА ===")
 
 class App(tk.Tk):
-    def __init__(self):
+    def __init__(self, overrides=None):
         super().__init__()
         self.title("WC — TG Sync")
-        self.geometry("980x600")
+        self.geometry("980x680")
         self.cfg = load_settings()
+        self.overrides = overrides or {}  # настройки из командной строки поверх settings.json
         self.worker = None
 
         top = ttk.Frame(self); top.pack(fill="x", padx=8, pady=6)
         ttk.Button(top, text="Настройки", command=self.open_settings).pack(side="left")
 
+        status = ttk.LabelFrame(self, text="Ход синхронизации"); status.pack(fill="x", padx=8, pady=(0,6))
+        self.progress_bar = ttk.Progressbar(status, mode="determinate", maximum=1)
+        self.progress_bar.pack(fill="x", padx=6, pady=(4,2))
+        self.progress_vars = [tk.StringVar(value="") for _ in range(4)]
+        for var in self.progress_vars:
+            ttk.Label(status, textvariable=var, anchor="w").pack(fill="x", padx=6)
+        self._progress_job = None
+
         text_frame = ttk.Frame(self); text_frame.pack(fill="both", expand=True, padx=8, pady=(0,6))
         self.txt = tk.Text(text_frame, wrap="word", state="disabled")
         self.txt.pack(side="left", fill="both", expand=True)
@@ -1218,9 +4498,11 @@ class App(tk.Tk):
 
         bottom = ttk.Frame(self); bottom.pack(fill="x", padx=8, pady=(0,8))
         self.btn_start = ttk.Button(bottom, text="Запустить синхронизацию", command=self.start_sync)
+        self.btn_retry = ttk.Button(bottom, text="Повторить неудачные", command=lambda: self.start_sync(retry_failed=True))
         self.btn_stop = ttk.Button(bottom, text="Стоп", command=self.stop_sync, state="disabled")
         self.btn_pause = ttk.Button(bottom, text="Пауза", command=self.toggle_pause, state="disabled")
-        self.btn_start.pack(side="left"); self.btn_stop.pack(side="left", padx=6); self.btn_pause.pack(side="left", padx=6)
+        self.btn_start.pack(side="left"); self.btn_retry.pack(side="left", padx=6)
+        self.btn_stop.pack(side="left", padx=6); self.btn_pause.pack(side="left", padx=6)
 
         builtins.input = self.gui_input
         getpass.getpass = self.gui_getpass
@@ -1260,14 +4542,46 @@ class App(tk.Tk):
         SettingsDialog(self, self.cfg)
         self.cfg = load_settings()
 
+    def log_link(self, path):
+        """Кликабельная ссылка на файл в окне лога."""
+        tag = f"link{abs(hash(path))}"
+        self.txt.configure(state="normal")
+        self.txt.insert("end", path + "\n", ("link", tag))
+        self.txt.tag_configure("link", foreground="blue", underline=True)
+        self.txt.tag_bind(tag, "<Button-1>", lambda e: open_path(path))
+        self.txt.tag_bind("link", "<Enter>", lambda e: self.txt.configure(cursor="hand2"))
+        self.txt.tag_bind("link", "<Leave>", lambda e: self.txt.configure(cursor=""))
+        self.txt.see("end")
+        self.txt.configure(state="disabled")
+
+    def _poll_progress(self):
+        """Панель хода обновляется по таймеру окна; поток синхронизации в окно ничего не шлёт."""
+        snap = progress_snapshot()
+        for var, line in zip(self.progress_vars, progress_lines(snap)):
+            var.set(line)
+        self.progress_bar.configure(maximum=max(1, snap["total"]), value=snap["processed"])
+        if self.worker and self.worker.is_alive():
+            self._progress_job = self.after(PROGRESS_REFRESH_MS, self._poll_progress)
+        else:
+            self._progress_job = None
+
     def _on_worker_finish(self):
+        if self._progress_job:
+            self.after_cancel(self._progress_job)
+        self._poll_progress()
         self.btn_start.configure(state="normal")
+        self.btn_retry.configure(state="normal")
         self.btn_stop.configure(state="disabled")
         self.btn_pause.configure(state="disabled")
         self.btn_pause.configure(text="Пауза")
+        paths = [p for p in getattr(self.worker, "report_paths", []) if os.path.exists(p)]
+        if paths:
+            self.log("\nОтчёт по товарам (нажмите, чтобы открыть):")
+            for p in paths:
+                self.log_link(os.path.abspath(p))
         self.log("\nСинхронизация завершена или остановлена. Можно запустить снова.\n")
 
-    def start_sync(self):
+    def start_sync(self, retry_failed=False):
         self.cfg = load_settings()
         if not self.cfg.get("TG_API_ID") or not self.cfg.get("TG_API_HASH") or not self.cfg.get("TG_PHONE"):
             messagebox.showwarning("Настройки", "Заполните TG_API_ID, TG_API_HASH и Телефон Telegram.")
@@ -1281,9 +4595,15 @@ class App(tk.Tk):
             return
         self.txt.configure(state="normal"); self.txt.delete("1.0","end"); self.txt.configure(state="disabled")
         finish_cb = lambda: self.after(0, self._on_worker_finish)
-        self.worker = SyncWorker(self.cfg, self.log, self.ask_input, finish_cb)
+        cfg = dict(self.cfg, **self.overrides)
+        cfg["RETRY_FAILED_ONLY"] = bool(retry_failed)
+        self.worker = SyncWorker(cfg, self.log, self.ask_input, finish_cb)
         self.worker.start()
+        if self._progress_job:
+            self.after_cancel(self._progress_job)
+        self._progress_job = self.after(PROGRESS_REFRESH_MS, self._poll_progress)
         self.btn_start.configure(state="disabled")
+        self.btn_retry.configure(state="disabled")
         self.btn_stop.configure(state="normal")
         self.btn_pause.configure(state="normal")
         self.btn_pause.configure(text="Пауза")
@@ -1313,5 +4633,17 @@ class App(tk.Tk):
         self.destroy()
 
 if __name__ == "__main__":
-    app = App()
+    import argparse
+    import multiprocessing
+    multiprocessing.freeze_support()  # процессы-сессии в собранном приложении
+    parser = argparse.ArgumentParser(description="WC — TG Sync")
+    parser.add_argument("--profile", choices=PROFILE_MODES, help="Профилирование прогонов (PROFILE_MODE)")
+    parser.add_argument("--slow-callback-ms", type=int, help="Порог блокировки цикла событий, мс (SLOW_CALLBACK_MS)")
+    args, _ = parser.parse_known_args()  # сборка приложения может добавить свои аргументы
+    overrides = {}
+    if args.profile:
+        overrides["PROFILE_MODE"] = args.profile
+    if args.slow_callback_ms is not None:
+        overrides["SLOW_CALLBACK_MS"] = args.slow_callback_ms
+    app = App(overrides)
     app.mainloop()
\ No newline at end of file
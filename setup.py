@@ -4,7 +4,7 @@ APP = ['main.py']  # <- замените, если ваш entry называет
 
 OPTIONS = {
     'argv_emulation': True,
-    'packages': ['PIL', 'cloudinary', 'woocommerce', 'telethon', 'requests'],
+    'packages': ['PIL', 'cloudinary', 'woocommerce', 'telethon', 'requests', 'aiohttp'],
     'plist': {
         'CFBundleIdentifier': 'com.yourname.wctgsync'
     }
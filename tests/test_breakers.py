@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""Предохранители сервисов и учёт ошибок Telegram при поиске поста товара."""
+
+import os
+import sys
+import time
+import asyncio
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+from benchmarks.stubs import SyntheticChat, FakeMessage, FakeTelegramClient
+
+GROUP_ID = -1001000000002
+MISSING_ID = -1009999999999
+
+
+def test_circuit_breaker_opens_after_threshold_and_recovers():
+    breaker = main.CircuitBreaker("test", threshold=3, cooldown=0.05)
+    for _ in range(2):
+        breaker.failure()
+    assert breaker.state == "closed" and breaker.allow()
+    breaker.failure()
+    assert breaker.state == "open"
+    assert breaker.blocked()
+    assert not breaker.allow()
+    with pytest.raises(main.CircuitOpenError):
+        breaker.check()
+
+    time.sleep(0.06)
+    assert not breaker.blocked()
+    assert breaker.allow()
+    assert breaker.state == "half_open"
+    # пробный запрос уже выдан — остальные ждут его результата
+    assert not breaker.allow()
+
+    breaker.failure()
+    assert breaker.state == "open"
+
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.success()
+    assert breaker.state == "closed" and breaker.failures == 0
+    assert breaker.status() == ("closed", 0.0)
+
+
+def test_circuit_breaker_success_resets_consecutive_failures():
+    breaker = main.CircuitBreaker("test", threshold=2, cooldown=60)
+    breaker.failure()
+    breaker.success()
+    breaker.failure()
+    assert breaker.state == "closed"
+    breaker.failure()
+    assert breaker.state == "open"
+    state, retry_in = breaker.status()
+    assert state == "open" and 0 < retry_in <= 60
+
+
+
+# --- fetch_telegram_source_guarded: ошибки получения чатов ---
+
+@pytest.fixture
+def breaker(monkeypatch):
+    breaker = main.CircuitBreaker("telegram", threshold=5, cooldown=60)
+    monkeypatch.setitem(main.BREAKERS, "telegram", breaker)
+    return breaker
+
+
+def group_client():
+    chat = SyntheticChat(GROUP_ID)
+    chat.add(FakeMessage(100, "ART1 куртка"))
+    return FakeTelegramClient(chat)
+
+
+def fetch(cfg):
+    result = main.new_product_result({"id": 1})
+    source = asyncio.run(main.fetch_telegram_source_guarded(group_client(), dict(main.DEFAULT_CONFIG, **cfg),
+                                                            "ART1", True, False, result))
+    return result, source
+
+
+def test_unused_channel_error_is_ignored_in_comments_mode(breaker):
+    result, source = fetch({"OPERATION_MODE": "comments", "COMMENT_GROUP_ID": GROUP_ID, "TG_CHANNEL_ID": MISSING_ID})
+    assert source[0] == "ART1 куртка" and not result.get("error")
+    assert breaker.failures == 0
+
+
+def test_unreachable_comment_group_is_missing_comment_group(breaker):
+    result, source = fetch({"OPERATION_MODE": "comments", "COMMENT_GROUP_ID": MISSING_ID, "TG_CHANNEL_ID": 0})
+    assert source is None and result["review_reason"] == "missing_comment_group" and not result.get("error")
+    assert breaker.failures == 1
+
+
+def test_manual_mode_falls_back_to_comment_group(breaker):
+    result, source = fetch({"OPERATION_MODE": "manual", "PHOTO_SOURCE_FORCED": "main",
+                            "COMMENT_GROUP_ID": GROUP_ID, "TG_CHANNEL_ID": MISSING_ID})
+    assert source[0] == "ART1 куртка" and result["review_reason"] is None
+    # канал, с которого режим начинает поиск, недоступен — это ошибка Telegram, хоть товар и нашёлся
+    assert breaker.failures == 1
+
+    result, source = fetch({"OPERATION_MODE": "manual", "PHOTO_SOURCE_FORCED": "comments",
+                            "COMMENT_GROUP_ID": GROUP_ID, "TG_CHANNEL_ID": MISSING_ID})
+    assert source[0] == "ART1 куртка" and breaker.failures == 0
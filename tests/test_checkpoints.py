@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""Контрольные точки прогона: продолжение после падения и запись товара без потери галереи."""
+
+import os
+import sys
+import asyncio
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+
+def test_store_resumes_unfinished_run(tmp_path):
+    path = str(tmp_path / "checkpoint.json")
+    store = main.CheckpointStore(path)
+    assert store.start_run("sig") == set()
+    store.mark_done(1)
+    store.mark_done("2")
+    store.update(3, stage="message_found", msg_id=10)
+    store.add_upload(3, "a.jpg", "https://cdn/a.jpg")
+
+    reopened = main.CheckpointStore(path)
+    assert reopened.start_run("sig") == {"1", "2"}
+    cp = reopened.get(3)
+    assert cp["stage"] == "message_found" and cp["msg_id"] == 10
+    assert cp["uploaded"] == {"a.jpg": "https://cdn/a.jpg"}
+
+    # get отдаёт копию: правка результата не меняет хранилище
+    cp["uploaded"]["b.jpg"] = "x"
+    assert "b.jpg" not in reopened.get(3)["uploaded"]
+
+    reopened.clear(3)
+    assert reopened.get(3) == {}
+
+
+def test_store_starts_over_after_finished_run(tmp_path):
+    path = str(tmp_path / "checkpoint.json")
+    store = main.CheckpointStore(path)
+    store.start_run("sig")
+    store.mark_done(1)
+    store.finish_run()
+    assert main.CheckpointStore(path).start_run("sig") == set()
+
+
+def test_store_drops_product_points_when_settings_change(tmp_path):
+    path = str(tmp_path / "checkpoint.json")
+    store = main.CheckpointStore(path)
+    store.start_run("desc-only")
+    store.mark_done(1)
+    store.update(2, stage="photos_downloaded", has_desc=True, photos=[])
+
+    reopened = main.CheckpointStore(path)
+    assert reopened.start_run("desc+photo") == set()
+    assert reopened.get(2) == {}
+
+
+def test_store_survives_corrupt_file(tmp_path):
+    path = tmp_path / "checkpoint.json"
+    path.write_text("{not json", encoding="utf-8")
+    store = main.CheckpointStore(str(path))
+    assert store.data == {"run": None, "products": {}}
+
+
+def test_resumable(tmp_path):
+    on_disk = tmp_path / "main_1.jpg"
+    on_disk.write_bytes(b"jpg")
+    gone = str(tmp_path / "reply_1_2.jpg")
+    cp = {"stage": "photos_downloaded", "has_desc": True, "want_photo": True,
+          "photos": [str(on_disk), gone], "uploaded": {}}
+
+    assert not main.checkpoint_resumable(dict(cp, stage="message_found"), True, False)
+    assert not main.checkpoint_resumable(dict(cp, has_desc=False), True, False)
+    assert main.checkpoint_resumable(cp, True, False)
+    # фото нет ни на диске, ни среди загруженных — без Telegram не продолжить
+    assert not main.checkpoint_resumable(cp, False, True)
+    cp["uploaded"] = {"reply_1_2.jpg": "https://cdn/reply.jpg"}
+    assert main.checkpoint_resumable(cp, True, True)
+    assert main.checkpoint_resumable(dict(cp, stage="wc_pending"), True, True)
+
+
+def test_description_only_point_does_not_resume_photo_update():
+    cp = {"stage": "photos_downloaded", "has_desc": True, "want_photo": False, "photos": []}
+    assert main.checkpoint_resumable(cp, True, False)
+    assert not main.checkpoint_resumable(cp, True, True)
+    # точки, сохранённые до появления want_photo, тоже не годятся для фото
+    assert not main.checkpoint_resumable({"stage": "wc_pending", "has_desc": True, "photos": []}, True, True)
+
+
+class FakeWooCommerce:
+    def __init__(self):
+        self.calls = []
+
+    def put(self, endpoint, data, params=None):
+        self.calls.append((endpoint, data))
+        return main.WCResponse(200, "{}", {})
+
+
+def test_write_product_update_keeps_gallery_without_new_photos(monkeypatch):
+    async def no_pause(_):
+        return None
+    monkeypatch.setattr(main.asyncio, "sleep", no_pause)
+    wcapi = FakeWooCommerce()
+    assert asyncio.run(main.write_product_update(7, {"description": "d"}, [], wcapi, True))
+    assert wcapi.calls == [("products/7", {"description": "d"})]
+
+    wcapi = FakeWooCommerce()
+    data = {"images": [{"src": "https://cdn/a.jpg"}]}
+    assert asyncio.run(main.write_product_update(7, data, ["https://cdn/a.jpg"], wcapi, True))
+    assert wcapi.calls == [("products/7", {"images": []}), ("products/7", data)]
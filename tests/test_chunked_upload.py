@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""Загрузка в Cloudinary по частям: повтор сбойной части и продолжение с сохранённого смещения."""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+
+class FakeCheckpoint:
+    def __init__(self):
+        self.saved = []
+
+    def set_chunked(self, name, state):
+        self.saved.append(dict(state) if state else None)
+
+
+@pytest.fixture
+def big_file(tmp_path):
+    path = tmp_path / "photo.jpg"
+    path.write_bytes(bytes(range(256)) * 40)  # 10240 байт — три части по 4096
+    return str(path)
+
+
+def new_state(path):
+    return {"upload_id": "up-1", "offset": 0, "size": os.path.getsize(path), "chunk_size": 4096, "public_id": "tg_x"}
+
+
+def fake_parts(monkeypatch, fail):
+    """cloudinary_call, который роняет части из fail (Content-Range → сколько раз) и пишет все вызовы."""
+    calls = []
+    monkeypatch.setattr(main.time, "sleep", lambda s: None)
+
+    def call(name, file, http_headers=None, **kwargs):
+        rng = http_headers["Content-Range"]
+        calls.append((rng, http_headers["X-Unique-Upload-Id"], len(file[1])))
+        if fail.get(rng):
+            fail[rng] -= 1
+            raise ConnectionError("обрыв")
+        return {"public_id": kwargs["public_id"], "secure_url": "https://res.test/x.jpg"}
+    monkeypatch.setattr(main, "cloudinary_call", call)
+    return calls
+
+
+def test_failed_part_is_resent_with_same_upload_id_and_range(monkeypatch, big_file):
+    calls = fake_parts(monkeypatch, {"bytes 4096-8191/10240": 2})
+    checkpoint = FakeCheckpoint()
+    res = main.upload_large_resumable(big_file, new_state(big_file), checkpoint)
+    assert res["secure_url"] == "https://res.test/x.jpg"
+    assert [c[0] for c in calls] == ["bytes 0-4095/10240"] + ["bytes 4096-8191/10240"] * 3 + ["bytes 8192-10239/10240"]
+    assert {c[1] for c in calls} == {"up-1"} and calls[-1][2] == 2048
+    assert [s and s["offset"] for s in checkpoint.saved] == [4096, 8192, None]
+
+
+def test_exhausted_part_keeps_offset_for_next_call(monkeypatch, big_file):
+    calls = fake_parts(monkeypatch, {"bytes 4096-8191/10240": 3})
+    checkpoint = FakeCheckpoint()
+    state = new_state(big_file)
+    with pytest.raises(ConnectionError):
+        main.upload_large_resumable(big_file, state, checkpoint)
+    assert state["offset"] == 4096 and checkpoint.saved == [dict(state)]
+    # следующая попытка не переотправляет первую часть
+    del calls[:]
+    main.upload_large_resumable(big_file, state, checkpoint)
+    assert [c[0] for c in calls] == ["bytes 4096-8191/10240", "bytes 8192-10239/10240"]
+    assert checkpoint.saved[-1] is None
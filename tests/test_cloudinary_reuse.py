@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""Постоянные public_id в Cloudinary: уже загруженный файл не загружается повторно."""
+
+import os
+import sys
+
+import pytest
+import cloudinary.exceptions
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+
+@pytest.fixture
+def cfg():
+    return dict(main.DEFAULT_CONFIG, CLOUDINARY_FORMAT_MODE="server", CLOUDINARY_DELIVERY_TRANSFORM="",
+                CLOUDINARY_STABLE_IDS=True, CLOUDINARY_CHUNKED_MB=0)
+
+
+@pytest.fixture
+def photo(tmp_path):
+    path = tmp_path / "photo.jpg"
+    path.write_bytes(b"\xff\xd8 jpeg bytes \xff\xd9")
+    return str(path)
+
+
+class Calls(list):
+    """Вызовы cloudinary_call по порядку; existing — ресурсы, которые уже есть в Cloudinary."""
+    def __init__(self):
+        super().__init__()
+        self.existing = {}
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    calls = Calls()
+    monkeypatch.setitem(main.BREAKERS, "cloudinary", main.CircuitBreaker("cloudinary"))
+
+    def call(name, *args, **kwargs):
+        calls.append((name, args, kwargs))
+        if name == "explicit":
+            if args[0] not in calls.existing:
+                raise cloudinary.exceptions.NotFound("Resource not found")
+            return calls.existing[args[0]]
+        return {"public_id": "tg_import/" + kwargs["public_id"], "secure_url": "https://res.test/new.jpg"}
+    monkeypatch.setattr(main, "cloudinary_call", call)
+    return calls
+
+
+def test_existing_resource_short_circuits_upload(cfg, photo, calls):
+    public_id = main.cloudinary_public_id(main.file_sha1(photo), cfg)
+    calls.existing[f"tg_import/{public_id}"] = {"public_id": f"tg_import/{public_id}", "secure_url": "https://res.test/old.jpg"}
+    assert main.upload_image_cloudinary(photo, cfg, delay=0) == "https://res.test/old.jpg"
+    assert [c[0] for c in calls] == ["explicit"]
+
+
+def test_missing_resource_is_uploaded_under_stable_id(cfg, photo, calls):
+    public_id = main.cloudinary_public_id(main.file_sha1(photo), cfg)
+    assert main.upload_image_cloudinary(photo, cfg, delay=0) == "https://res.test/new.jpg"
+    assert [c[0] for c in calls] == ["explicit", "upload"]
+    assert calls[1][2]["public_id"] == public_id and calls[1][2]["overwrite"] is False
+    assert main.BREAKERS["cloudinary"].state == "closed"
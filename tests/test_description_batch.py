@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""Быстрый режим «только описание»: отправка пачками через products/batch и пауза между поисками в Telegram."""
+
+import os
+import sys
+import json
+import asyncio
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+
+class FakeBatchApi:
+    """Синхронный клиент WooCommerce: отвечает на products/batch и запоминает тела запросов."""
+    def __init__(self, errors=None, status=200):
+        self.errors = errors or {}
+        self.status = status
+        self.payloads = []
+
+    def post(self, endpoint, data, params=None):
+        assert endpoint == "products/batch"
+        self.payloads.append(data)
+        update = [{"id": item["id"], "error": self.errors.get(item["id"])} if item["id"] in self.errors
+                  else {"id": item["id"]} for item in data["update"]]
+        return main.WCResponse(self.status, json.dumps({"update": update}), {})
+
+
+@pytest.fixture(autouse=True)
+def fresh_breakers(monkeypatch):
+    monkeypatch.setitem(main.BREAKERS, "woocommerce", main.CircuitBreaker("woocommerce"))
+
+
+def item(pid):
+    return {"product_id": str(pid), "name": f"Товар {pid}"}, {"description": f"Описание {pid}"}
+
+
+def test_batch_fills_up_to_size_and_flushes_once():
+    api = FakeBatchApi(errors={2: {"code": "woocommerce_rest_product_invalid_id", "message": "Неверный ID"}})
+    batch = main.DescriptionBatch(api, size=3)
+    assert [batch.add(*item(pid)) for pid in (1, 2, 3)] == [False, False, True]
+    results = asyncio.run(batch.flush())
+    assert api.payloads == [{"update": [{"description": f"Описание {pid}", "id": pid} for pid in (1, 2, 3)]}]
+    assert [(r["product_id"], bool(r.get("updated"))) for r in results] == [("1", True), ("2", False), ("3", True)]
+    assert results[1]["error"] == "Неверный ID" and results[1]["review_reason"] == "update_failed"
+    assert asyncio.run(batch.flush()) == [] and len(api.payloads) == 1
+
+
+def test_batch_http_error_fails_every_item():
+    batch = main.DescriptionBatch(FakeBatchApi(status=400), size=50)
+    for pid in (1, 2):
+        batch.add(*item(pid))
+    results = asyncio.run(batch.flush())
+    assert all(r["review_reason"] == "update_failed" and r["error"] == "products/batch: HTTP 400" for r in results)
+
+
+def test_batch_size_is_capped_by_woocommerce_limit():
+    assert main.DescriptionBatch(None, size=500).size == 100
+    assert main.DescriptionBatch(None, size=0).size == 1
+
+
+def test_description_only_run_pauses_between_lookups_and_batches_writes(monkeypatch, tmp_path):
+    cfg = dict(main.DEFAULT_CONFIG, UPDATED_FILE=str(tmp_path / "updated.json"), WC_BATCH_SIZE=2, DESC_FAST_PAUSE=2)
+    lookups, sleeps = [], []
+
+    async def prepare(product, cfg, updated_dict, client, sku_cache=None):
+        lookups.append((product["id"], len(sleeps)))
+        return item(product["id"])
+
+    async def sleep(seconds):
+        sleeps.append(seconds)
+
+    monkeypatch.setattr(main, "prepare_description_only", prepare)
+    monkeypatch.setattr(main.asyncio, "sleep", sleep)
+    api = FakeBatchApi()
+    worker = main.SyncWorker(cfg, lambda s: None, lambda prompt: "", None)
+    products = [{"id": pid, "name": f"Товар {pid}"} for pid in (1, 2, 3)]
+    asyncio.run(worker._run_description_only(cfg, products, api, None, {}, None, None, set()))
+    # перед каждым следующим поиском — пауза DESC_FAST_PAUSE
+    assert lookups == [(1, 0), (2, 2), (3, 4)]
+    assert [[u["id"] for u in p["update"]] for p in api.payloads] == [[1, 2], [3]]
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""Карта медиафайлов: известные фото уходят в WooCommerce по id вложения, остальные — по URL."""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+
+class FakeResponse:
+    def __init__(self, payload):
+        self.payload = payload
+
+    def json(self):
+        return self.payload
+
+
+def test_payload_prefers_known_ids(tmp_path):
+    media = main.MediaMap(str(tmp_path / "media_map.json"))
+    media.remember("https://cdn/a.jpg", media_id=11, file_hash="ha")
+    assert media.images_payload(["https://cdn/a.jpg", "https://cdn/b.jpg"]) == [
+        {"id": 11}, {"src": "https://cdn/b.jpg"}]
+    assert media.url_for_hash("ha") == "https://cdn/a.jpg"
+
+    media.remember_from_response(["https://cdn/a.jpg", "https://cdn/b.jpg"],
+                                 FakeResponse({"images": [{"id": 11}, {"id": 12}]}))
+    assert media.images_payload(["https://cdn/b.jpg"]) == [{"id": 12}]
+
+    # вложение удалили из медиатеки — снова отправляем по URL
+    media.forget([11])
+    assert media.images_payload(["https://cdn/a.jpg", "https://cdn/b.jpg"]) == [
+        {"src": "https://cdn/a.jpg"}, {"id": 12}]
+
+
+def test_roundtrip(tmp_path):
+    path = str(tmp_path / "media_map.json")
+    media = main.MediaMap(path)
+    media.remember("https://cdn/a.jpg", media_id=5, file_hash="ha")
+    media.remember_from_response(["https://cdn/x.jpg"], FakeResponse(None))
+    media.save()
+
+    loaded = main.MediaMap(path)
+    assert loaded.media_id("https://cdn/a.jpg") == 5
+    assert loaded.url_for_hash("ha") == "https://cdn/a.jpg"
+    assert loaded.media_id("https://cdn/x.jpg") is None
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""Несколько магазинов: один поиск в Telegram на артикул, запись и итог по каждому магазину отдельно."""
+
+import os
+import sys
+import asyncio
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+from benchmarks.stubs import SyntheticChat, FakeMessage, FakeTelegramClient
+
+GROUP_ID = -1001000000002
+
+
+class FakeShop:
+    """Синхронный клиент WooCommerce одного магазина: отвечает на PUT заданным статусом."""
+    def __init__(self, status=200):
+        self.status = status
+        self.calls = []
+
+    def put(self, endpoint, data, params=None):
+        self.calls.append((endpoint, data))
+        return main.WCResponse(self.status, "{}", {})
+
+
+@pytest.fixture(autouse=True)
+def fresh_breakers(monkeypatch):
+    for name in ("telegram", "woocommerce", "cloudinary"):
+        monkeypatch.setitem(main.BREAKERS, name, main.CircuitBreaker(name))
+
+
+def shop(tmp_path, name, status=200, updated=None):
+    cfg = dict(main.DEFAULT_CONFIG, WC_SHOP_NAME=name, UPDATED_FILE=str(tmp_path / f"{name}_updated.json"),
+               MEDIA_MAP_FILE=str(tmp_path / f"{name}_media.json"))
+    return main.ShopTarget(cfg, FakeShop(status), updated_dict=updated or {})
+
+
+def test_fan_out_article_reports_each_shop(tmp_path):
+    chat = SyntheticChat(GROUP_ID)
+    chat.add(FakeMessage(100, "ART1 куртка\nтёплая"))
+    client = FakeTelegramClient(chat)
+    cfg = dict(main.DEFAULT_CONFIG, OPERATION_MODE="comments", COMMENT_GROUP_ID=GROUP_ID, TG_CHANNEL_ID=0,
+               UPDATE_WHAT="description", UPDATE_STRATEGY="only_new", STOP_WORDS=[])
+    targets = [shop(tmp_path, "a"), shop(tmp_path, "b", updated={"12": {"desc": True}}), shop(tmp_path, "c", status=400)]
+    products = {0: {"id": 11, "name": "Куртка"}, 1: {"id": 12, "name": "Куртка"}, 2: {"id": 13, "name": "Куртка"}}
+
+    results = asyncio.run(main.fan_out_article("ART1", products, targets, cfg, client))
+
+    by_shop = {target.name: result for target, result in results}
+    assert [(t.name, r["product_id"]) for t, r in results] == [("a", "11"), ("b", "12"), ("c", "13")]
+    assert by_shop["a"]["updated"] and by_shop["a"]["desc_updated"] and not by_shop["a"]["review_reason"]
+    assert by_shop["b"]["review_reason"] == "only_new_already_updated" and not by_shop["b"].get("updated")
+    assert by_shop["c"]["review_reason"] == "update_failed" and not by_shop["c"].get("updated")
+    assert all(r["shop"] == name for name, r in by_shop.items())
+
+    # описание подготовлено один раз и ушло в оба магазина, которым оно нужно
+    (endpoint_a, body_a), = targets[0].wcapi.calls
+    (endpoint_c, body_c), = targets[2].wcapi.calls
+    assert (endpoint_a, endpoint_c) == ("products/11", "products/13")
+    assert body_a == body_c and "тёплая" in body_a["description"]
+    assert targets[1].wcapi.calls == []
+    assert targets[0].updated_dict["11"]["desc"] is True and "13" not in targets[2].updated_dict
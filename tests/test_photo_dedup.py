@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""Отсев почти одинаковых фото: перцептивные хэши и порог PHOTO_DEDUP_DISTANCE."""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+
+def make_photo(path, variant=0, size=(320, 240), quality=90):
+    from PIL import Image, ImageDraw
+    img = Image.new("RGB", size, (240, 240, 240))
+    draw = ImageDraw.Draw(img)
+    w, h = size
+    if variant == 0:
+        draw.rectangle([w * 0.1, h * 0.2, w * 0.45, h * 0.8], fill=(200, 30, 30))
+        draw.ellipse([w * 0.55, h * 0.1, w * 0.9, h * 0.6], fill=(20, 60, 180))
+    else:
+        for i in range(8):
+            draw.rectangle([0, h * i / 8, w, h * (i + 0.5) / 8], fill=(30, 30, 30))
+        draw.ellipse([w * 0.05, h * 0.5, w * 0.4, h * 0.95], fill=(250, 200, 0))
+    img.save(path, "JPEG", quality=quality)
+    return str(path)
+
+
+def distance(a, b):
+    return bin(a ^ b).count("1")
+
+
+@pytest.mark.parametrize("method", ["dhash", "phash"])
+def test_near_duplicates_within_threshold(tmp_path, method):
+    original = make_photo(tmp_path / "a.jpg")
+    resized = make_photo(tmp_path / "b.jpg", size=(640, 480), quality=60)
+    other = make_photo(tmp_path / "c.jpg", variant=1)
+
+    h = main.perceptual_hash(original, method)
+    assert 0 <= h < 2 ** 64
+    assert distance(h, main.perceptual_hash(resized, method)) <= main.DEFAULT_CONFIG["PHOTO_DEDUP_DISTANCE"]
+    assert distance(h, main.perceptual_hash(other, method)) > main.DEFAULT_CONFIG["PHOTO_DEDUP_DISTANCE"]
+
+
+def test_deduper_drops_only_near_duplicates(tmp_path):
+    dedup = main.PhotoDeduper("phash", main.DEFAULT_CONFIG["PHOTO_DEDUP_DISTANCE"])
+    first = make_photo(tmp_path / "a.jpg")
+    again = make_photo(tmp_path / "b.jpg", size=(640, 480), quality=60)
+    other = make_photo(tmp_path / "c.jpg", variant=1)
+
+    assert main.keep_photo(first, dedup)
+    assert not main.keep_photo(again, dedup)
+    assert not os.path.exists(again)
+    assert main.keep_photo(other, dedup)
+    assert dedup.dropped == 1
+    # нечитаемый файл не считается повтором
+    broken = tmp_path / "broken.jpg"
+    broken.write_bytes(b"not an image")
+    assert main.keep_photo(str(broken), dedup)
+    assert main.keep_photo(first, None)
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+"""Порядок очереди товаров по ключам PRODUCT_PRIORITY."""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+PRODUCTS = [
+    {"id": 1, "images": [{}], "total_sales": 5, "date_modified_gmt": "2024-01-01T00:00:00"},
+    {"id": 2, "images": [], "total_sales": 1, "date_modified_gmt": "2024-03-01T00:00:00"},
+    {"id": 3, "images": [{}], "total_sales": 9, "date_modified_gmt": "2024-02-01T00:00:00"},
+    {"id": 4, "images": [], "total_sales": 9, "date_modified_gmt": ""},
+]
+
+
+def ids(products):
+    return [p["id"] for p in products]
+
+
+def test_order_products_keeps_site_order_without_keys():
+    assert ids(main.order_products(PRODUCTS, {"PRODUCT_PRIORITY": ""}, {})) == [1, 2, 3, 4]
+    assert ids(main.order_products(PRODUCTS, {"PRODUCT_PRIORITY": "unknown"}, {})) == [1, 2, 3, 4]
+
+
+def test_order_products_by_priority_keys():
+    assert ids(main.order_products(PRODUCTS, {"PRODUCT_PRIORITY": "no_images"}, {})) == [2, 4, 1, 3]
+    assert ids(main.order_products(PRODUCTS, {"PRODUCT_PRIORITY": "best_selling"}, {})) == [3, 4, 1, 2]
+    assert ids(main.order_products(PRODUCTS, {"PRODUCT_PRIORITY": "recently_modified"}, {})) == [2, 3, 1, 4]
+    assert ids(main.order_products(PRODUCTS, {"PRODUCT_PRIORITY": "no_images, best_selling"}, {})) == [4, 2, 3, 1]
+    failed = {"3": {"failed": {"reason": "not_found"}}, "1": {"desc": True}}
+    assert ids(main.order_products(PRODUCTS, {"PRODUCT_PRIORITY": "previously_failed"}, failed)) == [3, 1, 2, 4]
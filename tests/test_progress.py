@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""Панель хода синхронизации: строки по снимку METRICS.progress() и состоянию предохранителей."""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+
+def snapshot(**changes):
+    snap = {
+        "total": 200, "processed": 50, "outcomes": {"updated": 45, "review": 4, "failed": 1},
+        "elapsed_s": 600.0, "per_min": 5.0, "eta_s": 1800.0,
+        "active": {"12": "download_media", "7": None}, "stages": {"download_media": 1},
+        "services": {"telegram": {"per_min": 30.0, "state": "closed", "retry_in": 0.0},
+                     "woocommerce": {"per_min": 4.4, "state": "open", "retry_in": 95.0},
+                     "cloudinary": {"per_min": 0.0, "state": "half_open", "retry_in": 0.0}},
+    }
+    snap.update(changes)
+    return snap
+
+
+def test_progress_lines():
+    head, result, current, services = main.progress_lines(snapshot())
+    assert head == "Обработано 50 из 200 (25%) · 5.0 товаров/мин · осталось ~30 мин 0 с · идёт 10 мин 0 с"
+    assert result == "Итоги: обновлено 45 · на проверку 4 · не удалось 1"
+    assert current == "Сейчас: 12 — download_media, 7 — между этапами · по этапам: download_media 1"
+    assert services == ("Сервисы: Telegram 30 запр./мин · "
+                        "WooCommerce 4 запр./мин (пауза после ошибок, ещё 1 мин 35 с) · "
+                        "Cloudinary 0 запр./мин (пробный запрос)")
+
+
+def test_progress_lines_before_start_and_many_active():
+    snap = snapshot(total=0, processed=0, outcomes={}, eta_s=None, per_min=0.0, elapsed_s=3.0, stages={},
+                    active={str(pid): "tg_search" for pid in range(6)}, services={})
+    head, result, current, services = main.progress_lines(snap, max_active=2)
+    assert head == "Обработано 0 · 0.0 товаров/мин · идёт 3 с"
+    assert result == "Итоги: обновлено 0 · на проверку 0 · не удалось 0"
+    assert current == "Сейчас: 0 — tg_search, 1 — tg_search и ещё 4"
+    assert services == "Сервисы: Telegram 0 запр./мин · WooCommerce 0 запр./мин · Cloudinary 0 запр./мин"
+
+
+def test_progress_snapshot_includes_breaker_state(monkeypatch):
+    breaker = main.CircuitBreaker("telegram", threshold=1, cooldown=60)
+    monkeypatch.setitem(main.BREAKERS, "telegram", breaker)
+    breaker.failure()
+    services = main.progress_snapshot()["services"]
+    assert services["telegram"]["state"] == "open" and 0 < services["telegram"]["retry_in"] <= 60
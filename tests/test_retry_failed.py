@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""Повтор неудачных товаров: пометка failed в updated_dict, выбор id по причинам и загрузка только этих товаров."""
+
+import os
+import sys
+import json
+import asyncio
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+from benchmarks.stubs import WooCommerceStub
+
+
+class RecordingStub(WooCommerceStub):
+    def __init__(self, products):
+        super().__init__(products)
+        self.includes = []
+
+    def handle(self, method, path, query, headers, body):
+        if query.get("include"):
+            self.includes.append(query["include"][0])
+        return super().handle(method, path, query, headers, body)
+
+def test_remember_outcome_marks_and_clears_failures(tmp_path):
+    path = str(tmp_path / "updated.json")
+    updated = {"1": {"desc": True}}
+    main.remember_outcome(updated, {"product_id": "1", "review_reason": "not_found"}, path)
+    main.remember_outcome(updated, {"product_id": "2", "error": "boom", "review_reason": None}, path)
+    # ручная проверка не из FAILURE_REASONS (например, нет фото в посте) неудачей не считается
+    main.remember_outcome(updated, {"product_id": "3", "review_reason": "no_photos"}, path)
+    assert updated["1"]["failed"]["reason"] == "not_found" and updated["1"]["desc"] is True
+    assert updated["2"]["failed"]["reason"] == "error" and "3" not in updated
+    with open(path, encoding="utf-8") as f:
+        assert set(json.load(f)) == {"1", "2"}
+
+    main.remember_outcome(updated, {"product_id": "1", "updated": True}, path)
+    assert updated["1"] == {"desc": True}
+
+
+def test_failed_product_ids_filters_by_reason():
+    updated = {
+        "1": {"failed": {"reason": "not_found"}},
+        "2": {"desc": True},
+        "3": {"failed": {"reason": "circuit_open"}},
+        "4": {"failed": {"reason": "error"}},
+        "5": "legacy",
+    }
+    assert main.failed_product_ids(updated) == ["1", "3", "4"]
+    assert main.failed_product_ids(updated, {"circuit_open", "error"}) == ["3", "4"]
+    assert main.failed_product_ids(updated, {"update_failed"}) == []
+
+
+def test_get_products_by_ids_fetches_in_parallel_batches():
+    products = [{"id": i, "name": f"Товар {i}", "images": []} for i in range(1, 11)]
+    with RecordingStub(products) as stub:
+        async def run():
+            client = main.AsyncWooCommerce(stub.url, "ck_1", "cs_1")
+            try:
+                return await main.get_products_by_ids(client, [9, 2, 5, 7, 42], batch=2)
+            finally:
+                await client.close()
+        found = asyncio.run(run())
+    assert sorted(stub.includes) == ["42", "5,7", "9,2"]
+    # несуществующий id просто не приходит
+    assert sorted(p["id"] for p in found) == [2, 5, 7, 9]
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""Замеры прогона: время этапов товара уходит в строку отчёта, в RunMetrics остаются только гистограммы."""
+
+import os
+import sys
+import csv
+import json
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+
+def test_product_timings_are_handed_out_and_not_kept():
+    metrics = main.RunMetrics()
+    with metrics.product(7) as timings:
+        with metrics.span("tg_search"):
+            pass
+        assert timings == {}
+    assert set(timings) == {"tg_search", "product_total"}
+    assert timings["product_total"] >= timings["tg_search"] >= 0
+    assert metrics.products == {} and metrics.active == {}
+    assert metrics.product_stages["product_total"].count == 1
+    assert "products" not in metrics.to_json() and "products" not in metrics.export_raw()
+
+
+def test_merge_raw_keeps_histograms():
+    worker, parent = main.RunMetrics(), main.RunMetrics()
+    for pid in (1, 2):
+        with worker.product(pid):
+            pass
+    parent.merge_raw(worker.export_raw())
+    assert parent.stages["product_total"].count == 2
+    assert parent.product_stages["product_total"].count == 2
+
+
+def test_report_line_carries_stage_timings(tmp_path):
+    report = main.RunReport(str(tmp_path))
+    stages = {"tg_search": 0.25, "product_total": 1.5}
+    report.add({"product_id": "7", "name": "Пальто", "updated": True, "stages": stages}, "updated")
+    report.close()
+    with open(report.jsonl_path, encoding="utf-8") as f:
+        assert json.loads(f.readline())["stages"] == stages
+    with open(report.csv_path, encoding="utf-8-sig", newline="") as f:
+        assert next(csv.DictReader(f))["seconds"] == "1.5"
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""Кэш артикул → пост Telegram: пакетная сверка, выброс удалённых и отредактированных постов."""
+
+import os
+import sys
+import asyncio
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+
+class Msg:
+    def __init__(self, msg_id, text, edit_date=None, grouped_id=None):
+        self.id = msg_id
+        self.text = text
+        self.edit_date = edit_date
+        self.grouped_id = grouped_id
+
+
+class Entity:
+    def __init__(self, entity_id):
+        self.id = entity_id
+
+
+class FakeClient:
+    """get_messages(entity, ids=...) по словарю {id: Msg}; запоминает запрошенные пачки."""
+    def __init__(self, messages):
+        self.messages = messages
+        self.requests = []
+
+    async def get_messages(self, entity, ids=None):
+        self.requests.append(ids)
+        if isinstance(ids, int):
+            return self.messages.get(ids)
+        return [self.messages.get(i) for i in ids]
+
+
+def filled_cache(tmp_path, messages, entity):
+    cache = main.SkuMessageCache(str(tmp_path / "sku.json"))
+    for article, msg in messages.items():
+        cache.store(article, msg, "comments", entity)
+    cache.save()
+    return main.SkuMessageCache(str(tmp_path / "sku.json"))
+
+
+def test_validate_keeps_unchanged_and_drops_deleted_or_edited(tmp_path):
+    group = Entity(5)
+    posts = {"a1": Msg(10, "A1 синий"), "b2": Msg(11, "B2 красный"), "c3": Msg(12, "C3 зелёный"),
+             "d4": Msg(13, "D4 не в каталоге")}
+    cache = filled_cache(tmp_path, posts, group)
+    assert set(cache.entries) == {"A1", "B2", "C3", "D4"}
+
+    client = FakeClient({10: Msg(10, "A1 синий"), 12: Msg(12, "C3 зелёный", edit_date=datetime(2024, 5, 1))})
+    valid, dropped = asyncio.run(cache.validate(client, {"comments": group, "main": None}, ["a1", "B2", "c3"]))
+
+    assert (valid, dropped) == (1, 2)
+    # одна пачка и только по артикулам каталога
+    assert len(client.requests) == 1 and sorted(client.requests[0]) == [10, 11, 12]
+    assert set(cache.entries) == {"A1", "D4"}
+    msg, source = asyncio.run(cache.get(client, "a1", {"comments": group}, ("comments",)))
+    assert msg.id == 10 and source == "comments"
+    # сверенное сообщение берётся из памяти, без нового запроса
+    assert len(client.requests) == 1
+
+
+def test_validate_batches_by_limit(tmp_path, monkeypatch):
+    monkeypatch.setattr(main.SkuMessageCache, "BATCH", 2)
+    group = Entity(5)
+    posts = {f"s{i}": Msg(i, f"S{i}") for i in range(5)}
+    cache = filled_cache(tmp_path, posts, group)
+    client = FakeClient({i: Msg(i, f"S{i}") for i in range(5)})
+    assert asyncio.run(cache.validate(client, {"comments": group}, list(posts))) == (5, 0)
+    assert [len(r) for r in client.requests] == [2, 2, 1]
+
+
+def test_get_drops_entry_for_other_source_or_changed_post(tmp_path):
+    group = Entity(5)
+    cache = filled_cache(tmp_path, {"a1": Msg(10, "A1")}, group)
+    client = FakeClient({10: Msg(10, "A1 — новая цена")})
+    assert asyncio.run(cache.get(client, "A1", {"comments": group}, ("main",))) is None
+    assert "A1" in cache.entries
+    assert asyncio.run(cache.get(client, "A1", {"comments": group}, ("comments",))) is None
+    assert "A1" not in cache.entries
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""Поиск артикулов в тексте поста: SkuMatcher находит то же, что регулярное выражение \b<артикул>\b."""
+
+import os
+import re
+import sys
+import random
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+def regex_matches(articles, text):
+    return {main.SkuMessageCache.key(a) for a in articles
+            if re.search(rf'\b{re.escape(a)}\b', text, re.IGNORECASE)}
+
+
+def test_sku_matcher_word_boundaries():
+    articles = ["AB1", "AB12", "b12", "X-5", "АРТ7", "7"]
+    matcher = main.SkuMatcher(articles)
+    cases = {
+        "Артикул AB12, цвет синий": {"AB12"},
+        "ab1 и ab12": {"AB1", "AB12"},
+        "XAB1 AB1_2 AB1x": set(),
+        "(X-5) арт7.": {"X-5", "АРТ7"},
+        "размер 7/AB1": {"7", "AB1"},
+        "": set(),
+    }
+    for text, expected in cases.items():
+        assert matcher.scan(text) == expected, text
+        assert regex_matches(articles, text) == expected, text
+
+
+def test_sku_matcher_equals_regex_search_on_random_texts():
+    rng = random.Random(7)
+    alphabet = "AB12XЯЖ-_ "
+    articles = sorted({"".join(rng.choice("AB12XЯЖ-") for _ in range(rng.randint(1, 4))) for _ in range(60)})
+    matcher = main.SkuMatcher(articles)
+    for _ in range(500):
+        text = "".join(rng.choice(alphabet + alphabet.lower()) for _ in range(rng.randint(0, 40)))
+        assert matcher.scan(text) == regex_matches(articles, text), text
+
+
+def test_sku_matcher_ignores_empty_articles():
+    matcher = main.SkuMatcher(["", "  ", None, "A1"])
+    assert matcher.keys == ["A1"]
+    assert matcher.scan("a1") == {"A1"}
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""Отпечатки поста Telegram: неизменный набор фото не скачивается и не загружается повторно."""
+
+import os
+import sys
+import asyncio
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+from benchmarks.stubs import SyntheticChat, FakeMessage, FakePhoto, FakeTelegramClient
+
+GROUP_ID = -1001000000002
+
+
+def build_chat(reply_keys):
+    """Основной пост 100 с артикулом ART1, текстовый ответ 101 и фото-ответы 102, 103, ... с картинками по ключам."""
+    chat = SyntheticChat(GROUP_ID)
+    chat.add(FakeMessage(100, "ART1 куртка"))
+    chat.add(FakeMessage(101, "есть все размеры", reply_to_msg_id=100))
+    for n, (photo_id, key) in enumerate(reply_keys, start=102):
+        chat.add(FakeMessage(n, "", photo=FakePhoto(photo_id, key), reply_to_msg_id=100))
+    chat.add(FakeMessage(200, "ART2 другой товар"))
+    return chat
+
+
+@pytest.fixture
+def cfg(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "DOWNLOAD_DIR", str(tmp_path))
+    return dict(main.DEFAULT_CONFIG, OPERATION_MODE="comments", COMMENT_GROUP_ID=GROUP_ID, TG_CHANNEL_ID=0,
+                MAX_PHOTOS=2, PHOTO_DEDUP_ENABLED=True, PHOTO_DEDUP_METHOD="phash", VERBOSE_LOG=False)
+
+
+def fetch(client, cfg, prev=None):
+    result = main.new_product_result({"id": 1})
+    source = asyncio.run(main.fetch_telegram_source(client, cfg, "ART1", False, True, result, prev=prev))
+    return result, source[1]
+
+
+def test_unchanged_photos_are_not_downloaded(cfg):
+    client = FakeTelegramClient(build_chat([(1, "a"), (2, "b"), (3, "c")]))
+    result, paths = fetch(client, cfg)
+    assert len(paths) == 2 and result["unchanged"] == []
+    downloads = client.stats["downloads"]
+
+    result, paths = fetch(client, cfg, prev=dict(result["fingerprint"]))
+    assert result["unchanged"] == ["photo"] and paths == []
+    assert client.stats["downloads"] == downloads
+
+
+def test_fingerprint_covers_photos_taken_to_replace_duplicates(cfg):
+    # новые ответы идут первыми: 104 и 103 — одна картинка, вместо повтора берётся 102
+    client = FakeTelegramClient(build_chat([(1, "z"), (2, "x"), (3, "x")]))
+    result, paths = fetch(client, cfg)
+    assert [os.path.basename(p) for p in paths] == ["reply_100_104.jpg", "reply_100_102.jpg"]
+    assert result["fingerprint"]["photo_ids"] == [3, 1]
+    prev = dict(result["fingerprint"])
+
+    # тот же пост: после отсева набор тот же — отмечен неизменным, файлы не остаются на диске
+    result, paths = fetch(client, cfg, prev)
+    assert result["unchanged"] == ["photo"] and paths == []
+    assert not any(name.endswith(".jpg") for name in os.listdir(main.DOWNLOAD_DIR))
+
+    # заменили фото, взятое вместо повтора, — это изменение
+    client = FakeTelegramClient(build_chat([(4, "y"), (2, "x"), (3, "x")]))
+    result, paths = fetch(client, cfg, prev)
+    assert result["unchanged"] == []
+    assert result["fingerprint"]["photo_ids"] == [3, 4] and len(paths) == 2
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+"""
+Запуск: `import main` не загружает тяжёлые зависимости, которые нужны только синхронизации.
+Время импорта зависит от машины, поэтому бюджет проверяется только по запросу:
+STARTUP_BUDGET_MS=120 python -m pytest tests/test_startup.py
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks import startup
+
+
+def test_import_main_is_lazy():
+    report = startup.run(startup.build_parser().parse_args(["--runs", "1"]))
+    assert report["eager_heavy"] == [], f"при импорте загружены: {', '.join(report['eager_heavy'])}"
+
+
+@pytest.mark.skipif(not os.environ.get("STARTUP_BUDGET_MS"), reason="бюджет времени импорта — только с STARTUP_BUDGET_MS")
+def test_import_main_within_budget():
+    budget = float(os.environ["STARTUP_BUDGET_MS"])
+    report = startup.run(startup.build_parser().parse_args(["--runs", "5"]))
+    assert report["median_ms"] <= budget, (
+        f"import main: медиана {report['median_ms']} мс больше бюджета {budget} мс; "
+        f"тяжёлые импорты: {report['top']}")
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""Асинхронный клиент WooCommerce: выбор авторизации, тело запросов и постраничная загрузка каталога."""
+
+import os
+import sys
+import json
+import asyncio
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+from benchmarks.stubs import WooCommerceStub
+
+
+class RecordingStub(WooCommerceStub):
+    def __init__(self, products):
+        super().__init__(products)
+        self.requests = []
+
+    def handle(self, method, path, query, headers, body):
+        self.requests.append((method, path, query, dict(headers)))
+        return super().handle(method, path, query, headers, body)
+
+
+class FakeSession:
+    """Сессия aiohttp без сети: запоминает аргументы request()."""
+    closed = False
+
+    def __init__(self):
+        self.calls = []
+
+    def request(self, method, url, **kwargs):
+        self.calls.append((method, str(url), kwargs))
+
+        class Response:
+            status = 200
+            headers = {}
+
+            async def __aenter__(self):
+                return self
+
+            async def __aexit__(self, *exc):
+                return False
+
+            async def text(self):
+                return "[]"
+
+        return Response()
+
+
+def catalog(n):
+    return [{"id": i, "name": f"Товар {i}", "images": []} for i in range(1, n + 1)]
+
+
+def test_https_uses_basic_auth_and_keeps_params():
+    client = main.AsyncWooCommerce("https://shop.test/", "ck_1", "cs_1")
+    client.session = FakeSession()
+    res = asyncio.run(client.put("products/5", {"description": "Пальто"}, params={"force": 1}))
+    assert res.status_code == 200 and res.json() == []
+    method, url, kwargs = client.session.calls[0]
+    assert (method, url) == ("PUT", "https://shop.test/wp-json/wc/v3/products/5")
+    assert kwargs["auth"].login == "ck_1" and kwargs["auth"].password == "cs_1"
+    assert kwargs["params"] == {"force": 1}
+    assert json.loads(kwargs["data"].decode("utf-8")) == {"description": "Пальто"}
+    assert kwargs["headers"]["content-type"].startswith("application/json")
+
+
+def test_http_signs_request_with_oauth():
+    with RecordingStub(catalog(3)) as stub:
+        async def run():
+            client = main.AsyncWooCommerce(stub.url, "ck_1", "cs_1")
+            try:
+                return await client.get("products", params={"page": 1, "per_page": 2})
+            finally:
+                await client.close()
+        res = asyncio.run(run())
+    assert res.status_code == 200 and [p["id"] for p in res.json()] == [1, 2]
+    method, path, query, headers = stub.requests[0]
+    assert (method, path) == ("GET", "/wp-json/wc/v3/products")
+    assert query["page"] == ["1"] and query["per_page"] == ["2"]
+    assert query["oauth_consumer_key"] == ["ck_1"] and query["oauth_signature"]
+    assert query["oauth_signature_method"] == ["HMAC-SHA256"]
+    assert "Authorization" not in headers
+
+
+def test_get_all_products_fetches_every_page():
+    with RecordingStub(catalog(250)) as stub:
+        async def run():
+            client = main.AsyncWooCommerce(stub.url, "ck_1", "cs_1")
+            try:
+                return await main.get_all_products(client)
+            finally:
+                await client.close()
+        products = asyncio.run(run())
+    assert [p["id"] for p in products] == list(range(1, 251))
+    assert sorted(q["page"][0] for _, _, q, _ in stub.requests) == ["1", "2", "3"]
+
+
+class PagedCatalog:
+    """Синхронный клиент, как woocommerce.API, без заголовка X-WP-TotalPages."""
+    def __init__(self, products):
+        self.products = products
+        self.pages = []
+
+    def get(self, endpoint, params=None):
+        page, per_page = params["page"], params["per_page"]
+        self.pages.append(page)
+        chunk = self.products[(page - 1) * per_page: page * per_page]
+        return main.WCResponse(200, json.dumps(chunk), {})
+
+
+def test_get_all_products_without_total_pages_header():
+    api = PagedCatalog(catalog(200))
+    products = asyncio.run(main.get_all_products(api))
+    assert len(products) == 200
+    # полная последняя страница — ещё один запрос, который возвращает пустой список
+    assert api.pages == [1, 2, 3]